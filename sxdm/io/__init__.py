@@ -1,2 +1,2 @@
-from . import bliss, spec, xsocs
+from . import bliss, edf, spec, xsocs
 from .utils import _get_chunk_indexes, _get_qspace_avg_chunk
@@ -19,7 +19,13 @@ from id01lib.io.bliss import (
     _check_detector,
 )
 
-from .utils import _get_chunk_indexes
+from .utils import (
+    _get_chunk_indexes,
+    _get_row_chunk_indexes,
+    _bin_pixels,
+    _bin_positions,
+    _iter_binned_frames,
+)
 
 
 @ioh5
@@ -220,14 +226,7 @@ def get_counter_sxdm(h5f, scan_no, counter, return_pi_motors=False):
     """
 
     sh = get_scan_shape(h5f, scan_no)
-    data = get_counter(h5f, scan_no, counter)
-
-    if data.size == sh[0] * sh[1]:
-        data = data.reshape(*sh)
-    else:
-        empty = np.zeros(sh).flatten()
-        empty[: data.size] = data
-        data = empty.reshape(*sh)
+    data = _reshape_counter(get_counter(h5f, scan_no, counter), sh)
 
     if return_pi_motors:
         m1, m2 = get_piezo_motor_positions(h5f, scan_no)
@@ -236,12 +235,59 @@ def get_counter_sxdm(h5f, scan_no, counter, return_pi_motors=False):
         return data
 
 
-def _get_frames_chunk(path_dset, path_in_h5, roi_dir_idxs, roi, idx_range):
+def _reshape_counter(data, sh):
+    """
+    Reshape the counter `data` to the scan shape `sh`, padding interrupted scans
+    with zeros.
+    """
+    if data.size == sh[0] * sh[1]:
+        return data.reshape(*sh)
+    else:
+        empty = np.zeros(sh).flatten()
+        empty[: data.size] = data
+        return empty.reshape(*sh)
+
+
+@ioh5
+def get_counters_sxdm(h5f, scan_nums, counters):
+    """
+    Retrieve the SXDM maps of several counters for several scans at once, opening
+    the file only once.
+
+    Parameters
+    ----------
+    h5f : str
+        Path to the HDF5 BLISS dataset containing the SXDM data.
+    scan_nums : list of str
+        The scan numbers, e.g. ["1.1", "2.1"]. All scans must have the same shape.
+    counters : list of str
+        The names of the counters.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (n_counters, n_scans, rows, columns).
+    """
+
+    shapes = [tuple(get_scan_shape(h5f, s)) for s in scan_nums]
+    if len(set(shapes)) > 1:
+        raise ValueError("The scans in scan_nums do not have the same shape.")
+
+    maps = np.zeros((len(counters), len(scan_nums), *shapes[0]))
+    for i, scan_no in enumerate(scan_nums):
+        for j, counter in enumerate(counters):
+            maps[j, i] = _reshape_counter(get_counter(h5f, scan_no, counter), shapes[0])
+
+    return maps
+
+
+def _get_frames_chunk(path_dset, path_in_h5, roi_dir_idxs, roi, idx_range, det_bin=1):
     """
     Return the q-space intensity array summed over the (flattened) sample positons
-    given by `idx_range`, which is a list of tuples.
+    given by `idx_range`, which is a list of tuples, binned by `det_bin` x
+    `det_bin` pixels.
     """
-    idx_list = [x for x in range(*idx_range, 1) if x in roi_dir_idxs]
+    idx_list = list(np.intersect1d(np.arange(*idx_range), roi_dir_idxs))
     if roi is not None:
         roi_sl = np.s_[idx_list, roi[0] : roi[1], roi[2] : roi[3]]
     else:
@@ -250,7 +296,7 @@ def _get_frames_chunk(path_dset, path_in_h5, roi_dir_idxs, roi, idx_range):
     with h5py.File(path_dset, "r") as h5f:
         arr = h5f[path_in_h5][roi_sl].sum(0)
 
-    return arr
+    return _bin_pixels(arr, det_bin)
 
 
 def get_sxdm_frame_sum(
@@ -262,6 +308,7 @@ def get_sxdm_frame_sum(
     pbar=True,
     path_data_h5="/{scan_no}/instrument/{detector}/data",
     roi=None,
+    det_bin=1,
 ):
     """Return the sum of all detector frames collected within an SXDM scan.
 
@@ -287,6 +334,9 @@ def get_sxdm_frame_sum(
         by default "/{scan_no}/instrument/{detector}/data"
     roi : list, optional
         List of [row_min, row_max, col_min, col_max], by default None
+    det_bin : int, optional
+        Bin the detector pixels by `det_bin` x `det_bin` blocks, dropping the rows
+        and columns left over, by default 1 (no binning)
 
     Returns
     -------
@@ -325,7 +375,14 @@ def get_sxdm_frame_sum(
         else:
             roi_dir_idxs = np.indices((sh,))[0]
 
-        pfun = partial(_get_frames_chunk, path_dset, path_data_h5, roi_dir_idxs, roi)
+        pfun = partial(
+            _get_frames_chunk,
+            path_dset,
+            path_data_h5,
+            roi_dir_idxs,
+            roi,
+            det_bin=det_bin,
+        )
 
         # set progress bar
         if pbar is True:
@@ -355,20 +412,30 @@ def get_sxdm_frame_sum(
         return np.stack(frame_sum_list).sum(0)
 
 
-def _calc_pos_sum_chunk(path_dset, path_in_h5, roi_rec_sl, idx_range):
+def _calc_pos_sum_chunk(
+    path_dset, path_in_h5, roi_rec_sl, idx_range, pos_bin=1, map_width=1
+):
     """
     Calculate the direct space intensity of a 4D SXDM dataset:
     * for the direct space indexes in the range `idx_range`;
     * within the reciprocal space slice `roi_rec_sl`;
-    * masked in direct space where `mask_direct` is True.
+    * masked in direct space where `mask_direct` is True;
+    * binned by `pos_bin` x `pos_bin` positions of maps `map_width` wide.
 
     Returns a `numpy.masked_array`.
     """
     i0, i1 = idx_range
 
-    roi_slice = (slice(i0, i1, None), *roi_rec_sl)  # 3D
     with h5py.File(path_dset, "r") as h5f:
-        arr = h5f[path_in_h5][roi_slice].sum(axis=(1, 2))
+        if pos_bin == 1:
+            roi_slice = (slice(i0, i1, None), *roi_rec_sl)  # 3D
+            arr = h5f[path_in_h5][roi_slice].sum(axis=(1, 2))
+        else:
+            blocks = _iter_binned_frames(
+                h5f[path_in_h5], idx_range, roi_rec_sl, width=pos_bin * map_width
+            )
+            arr = np.concatenate([b.sum(axis=(1, 2)) for b in blocks])
+            arr = _bin_positions(arr, map_width, pos_bin)
 
     return arr
 
@@ -381,6 +448,7 @@ def get_sxdm_pos_sum(
     n_proc=None,
     pbar=True,
     path_data_h5="/{scan_no}/instrument/{detector}/data",
+    pos_bin=1,
 ):
     """Obtain the sum of scattered intensity integrated over the detector space for
     an SXDM scan.
@@ -404,6 +472,10 @@ def get_sxdm_pos_sum(
     path_data_h5 : str, optional
         Path within the .hdf5 BLISS dataset where to look for the raw data,
         by default "/{scan_no}/instrument/{detector}/data"
+    pos_bin : int, optional
+        Bin the map by `pos_bin` x `pos_bin` positions, dropping the rows and
+        columns left over, by default 1 (no binning). The result is then a
+        flattened map of shape `(rows // pos_bin, cols // pos_bin)`.
 
     Returns
     -------
@@ -430,7 +502,13 @@ def get_sxdm_pos_sum(
         n_proc = os.cpu_count()
 
     # list of idx ranges [(i0, i1), (i0, i1), ...]
-    idxs_list = _get_chunk_indexes(path_dset, path_data_h5, n_proc=n_proc)
+    if pos_bin == 1:
+        idxs_list = _get_chunk_indexes(path_dset, path_data_h5, n_proc=n_proc)
+        map_width = 1
+    else:
+        map_shape = get_scan_shape(path_dset, scan_no)
+        idxs_list = _get_row_chunk_indexes(map_shape, pos_bin, n_proc)
+        map_width = map_shape[1]
 
     # recipocal space slice from mask
     if mask_detector is not None:
@@ -441,7 +519,14 @@ def get_sxdm_pos_sum(
 
     # call function with everything except the index ranges
     # the function returns a direct space map
-    pfun = partial(_calc_pos_sum_chunk, path_dset, path_data_h5, roi_rec_sl)
+    pfun = partial(
+        _calc_pos_sum_chunk,
+        path_dset,
+        path_data_h5,
+        roi_rec_sl,
+        pos_bin=pos_bin,
+        map_width=map_width,
+    )
 
     # set progress bar
     if pbar is True:
@@ -608,3 +693,137 @@ def get_sxdm_frame_sum_multi(
         fint_tot = np.load(path_save_framesum)
 
     return fint_tot
+
+
+def _calc_sums_chunk(path_dset, roi, args):
+    """
+    Return the sum of the frames `idx_range` of the dataset `path_in_h5` of
+    `path_dset`, excluding those where `mask` is True, and the sums of all of them
+    over the detector pixels, along with `args`.
+    """
+    path_in_h5, idx_range, mask = args[1:]
+    if roi is not None:
+        roi_sl = np.s_[slice(*idx_range), roi[0] : roi[1], roi[2] : roi[3]]
+    else:
+        roi_sl = np.s_[slice(*idx_range), ...]
+
+    with h5py.File(path_dset, "r") as h5f:
+        arr = h5f[path_in_h5][roi_sl]
+
+    fsum = arr.sum(0) if mask is None else arr[~mask].sum(0)
+
+    return args, fsum, arr.sum(axis=(1, 2))
+
+
+def get_sxdm_sums_multi(
+    path_dset,
+    scan_nums=None,
+    mask_sample=None,
+    detector=None,
+    n_proc=None,
+    pbar=True,
+    path_data_h5="/{scan_no}/instrument/{detector}/data",
+    block_size=64e6,
+    roi=None,
+):
+    """
+    Return the frame sum and the sum over the detector pixels of each of several
+    SXDM scans, computed from a single read of their frames.
+
+    The frames of all the scans are split into blocks of about `block_size`
+    bytes, reduced by a single pool of `n_proc` processes.
+
+    Parameters
+    ----------
+    path_dset : str
+        Path to the .hdf5 BLISS dataset.
+    scan_nums : list of str, optional
+        The scan numbers, e.g. ["1.1", "2.1"]. Defaults to all the SXDM scans.
+    mask_sample : np.ndarray or list of np.ndarray, optional
+        Sample positions excluded from the frame sums, where True, as in
+        `get_sxdm_frame_sum`. Either one array with the shape of the SXDM scans
+        (or flat), used for all of them, or one per scan as a list (or a 3D array).
+        By default None.
+    detector : str, optional
+        Alias of the detector used for the SXDM scans, by default None
+    n_proc : int, optional
+        Number of processes to spawn for parallel computation, by default None
+    pbar : bool, optional
+        Spawn a progress bar, by default True
+    path_data_h5 : str, optional
+        Path within the .hdf5 BLISS dataset where to look for the raw data,
+        by default "/{scan_no}/instrument/{detector}/data"
+    block_size : float, optional
+        Approximate size in bytes of the blocks of frames read at once.
+    roi : list, optional
+        Detector region of interest as [row_min, row_max, col_min, col_max]. Only
+        this region of the frames is read. By default None
+
+    Returns
+    -------
+    frame_sums : np.ndarray
+        Array of shape (n_scans, det_rows, det_columns), or that of `roi`.
+    pos_sums : list of np.ndarray
+        The map of the intensity summed over the detector of each scan, padded with
+        zeros for interrupted scans.
+    """
+
+    if scan_nums is None:
+        scan_nums = get_sxdm_scan_numbers(path_dset)
+
+    if mask_sample is None or isinstance(mask_sample, (list, tuple)):
+        masks_sample = mask_sample
+    elif np.ndim(mask_sample) == 3:
+        masks_sample = list(mask_sample)
+    else:
+        masks_sample = [mask_sample] * len(scan_nums)
+    if masks_sample is not None and len(masks_sample) != len(scan_nums):
+        raise ValueError("mask_sample must be a single mask or one mask per scan")
+
+    tasks, map_shapes = [], []
+    with h5py.File(path_dset, "r") as h5f:
+        detlist = get_detector_aliases(h5f, scan_nums[0])
+        if detector is None:
+            detector = detlist[0]
+        if detector not in detlist:
+            raise ValueError(
+                f"Detector {detector} not in data file. "
+                f"Available detectors are: {detlist}."
+            )
+
+        for i, scan_no in enumerate(scan_nums):
+            path_in_h5 = path_data_h5.format(scan_no=scan_no, detector=detector)
+            dset = h5f[path_in_h5]
+            frame_shape, dtype = dset.shape[1:], dset.dtype
+            map_shapes.append(get_scan_shape(h5f, scan_no))
+
+            mask = None
+            if masks_sample is not None:
+                # frames beyond the scan map, if any, are excluded too
+                mask = np.ones(max(dset.shape[0], np.prod(map_shapes[-1])), "bool")
+                mask[: masks_sample[i].size] = np.ravel(masks_sample[i])
+
+            step = max(1, int(block_size // (np.prod(frame_shape) * dtype.itemsize)))
+            for i0 in range(0, dset.shape[0], step):
+                i1 = min(i0 + step, dset.shape[0])
+                mask_block = None if mask is None else mask[i0:i1]
+                tasks.append((i, path_in_h5, (i0, i1), mask_block))
+
+    if roi is not None:
+        frame_shape = (roi[1] - roi[0], roi[3] - roi[2])
+    frame_sums = np.zeros((len(scan_nums), *frame_shape))
+    pos_sums = [np.zeros(np.prod(sh)) for sh in map_shapes]
+
+    pfun = partial(_calc_sums_chunk, path_dset, roi)
+    with mp.Pool(processes=n_proc) as p:
+        results = p.imap_unordered(pfun, tasks)
+        for (i, _, (i0, i1), _), fsum, psum in tqdm(
+            results, total=len(tasks), disable=not pbar
+        ):
+            frame_sums[i] += fsum
+            n = min(i1, pos_sums[i].size) - i0
+            pos_sums[i][i0 : i0 + max(n, 0)] = psum[: max(n, 0)]
+
+    pos_sums = [s.reshape(sh) for s, sh in zip(pos_sums, map_shapes)]
+
+    return frame_sums, pos_sums
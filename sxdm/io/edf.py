@@ -0,0 +1,338 @@
+"""
+Lazy, random-access reading of the detector frames stored in (gzipped) EDF files.
+"""
+
+import os
+import json
+import bisect
+import warnings
+import zlib
+
+import numpy as np
+
+# EDF DataType -> numpy type
+_EDF_TYPES = {
+    "UnsignedByte": "u1",
+    "SignedByte": "i1",
+    "UnsignedShort": "u2",
+    "SignedShort": "i2",
+    "UnsignedInteger": "u4",
+    "SignedInteger": "i4",
+    "UnsignedLong": "u4",
+    "SignedLong": "i4",
+    "Unsigned64": "u8",
+    "Signed64": "i8",
+    "FloatValue": "f4",
+    "Float": "f4",
+    "DoubleValue": "f8",
+    "Double": "f8",
+}
+
+# version of the frame index format
+_INDEX_VERSION = 1
+
+
+class EdfFrames(object):
+    """
+    Lazy reader of the frames of an EDF file, gzipped or not.
+
+    Frames are only decompressed when accessed, with `numpy`-like indexing:
+    ``frames[i]`` returns frame `i`, ``frames[i0:i1]`` or ``frames[[i, j]]`` a
+    stack of frames and ``frames[:, r0:r1, c0:c1]`` a region of interest of the
+    frames, which only holds that region in memory.
+
+    Gzip streams cannot be read from an arbitrary position: while decompressing,
+    the state of the decompressor is saved every `spacing` uncompressed bytes, so
+    that any frame is then decompressed from the closest of these seek points
+    instead of from the start of the file. The offset, shape and type of the
+    frames are stored in the `index_path` JSON file once the whole file has been
+    read, so that the number and shape of the frames are known straight away the
+    next time the file is opened.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the .edf or .edf.gz file.
+    index_path : str, optional
+        Path to the frame index file. Defaults to `filename` + ".index.json". If
+        it cannot be written, the index is only kept in memory.
+    spacing : int, optional
+        Uncompressed bytes between two seek points. Default is 4 MB.
+
+    Attributes
+    ----------
+    shape : tuple
+        (n_frames, rows, columns).
+    dtype : numpy.dtype
+        Type of the frames.
+
+    Examples
+    --------
+    >>> frames = EdfFrames("/path/to/file.edf.gz")
+    >>> frame = frames[100]
+    >>> roi_sum = frames[:, 10:20, 30:40].sum(axis=(1, 2))
+    """
+
+    def __init__(self, filename, index_path=None, spacing=2**22):
+        self.filename = filename
+        self.index_path = f"{filename}.index.json" if index_path is None else index_path
+        self.spacing = spacing
+
+        with open(filename, "rb") as f:
+            self._gzipped = f.read(2) == b"\x1f\x8b"
+        stat = os.stat(filename)
+        self._stat = [stat.st_mtime, stat.st_size]
+
+        # frame table: uncompressed data offset, shape and type of each frame
+        self._offsets, self._shapes, self._dtypes = [], [], []
+        self._next_header = 0
+        self._complete = False
+        self._load_index()
+
+        self._reset_stream()
+
+    def __getstate__(self):
+        # file handle and decompressors cannot be pickled, rebuilt when needed
+        state = self.__dict__.copy()
+        for key in ("_f", "_dobj", "_ckpts", "_buf"):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_stream()
+
+    def __len__(self):
+        self._index_frames()
+        return len(self._offsets)
+
+    @property
+    def shape(self):
+        if len(self._offsets) == 0:
+            self._index_frames(1)
+        return (len(self), *self._shapes[0])
+
+    @property
+    def dtype(self):
+        if len(self._offsets) == 0:
+            self._index_frames(1)
+        return self._dtypes[0]
+
+    @property
+    def ndim(self):
+        return 3
+
+    def __iter__(self):
+        for i in self._get_indexes(slice(None)):
+            yield self._read_frame(i)
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        idx, frame_sl = key[0], key[1:]
+
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            self._index_frames(idx + 1)
+            if idx >= len(self._offsets):
+                raise IndexError(f"Frame index {idx} out of range")
+            return self._read_frame(idx)[frame_sl]
+
+        frames = [self._read_frame(i)[frame_sl] for i in self._get_indexes(idx)]
+        if len(frames) == 0:
+            return np.zeros((0, *np.empty(self.shape[1:])[frame_sl].shape), self.dtype)
+        return np.stack(frames)
+
+    def _get_indexes(self, idx):
+        """
+        Yield the frame indexes selected by `idx`. Forward slices are indexed as
+        they are read, so that reading them decompresses the file only once.
+        """
+        step = 1 if not isinstance(idx, slice) or idx.step is None else idx.step
+        if (
+            not isinstance(idx, slice)
+            or step < 1
+            or any(i is not None and i < 0 for i in (idx.start, idx.stop))
+        ):
+            yield from np.arange(len(self))[idx]
+            return
+
+        i = 0 if idx.start is None else idx.start
+        while idx.stop is None or i < idx.stop:
+            self._index_frames(i + 1)
+            if i >= len(self._offsets):
+                break
+            yield i
+            i += step
+
+    def _read_frame(self, i):
+        """
+        Return frame `i`, which must be indexed already.
+        """
+        dtype = self._dtypes[i]
+        size = int(np.prod(self._shapes[i])) * dtype.itemsize
+        data = self._read(self._offsets[i], size)
+        if len(data) < size:
+            raise EOFError(f"Frame {i} of {self.filename} is truncated")
+        return np.frombuffer(data, dtype=dtype).reshape(self._shapes[i])
+
+    def _index_frames(self, n=None):
+        """
+        Parse the frame headers until `n` frames (or all of them if None) are
+        indexed.
+        """
+        while not self._complete and (n is None or len(self._offsets) < n):
+            off = self._next_header
+            header, data_offset = self._read_header(off)
+            if header is None:
+                self._complete = True
+                self._save_index()
+                break
+
+            shape = (int(header["Dim_2"]), int(header["Dim_1"]))
+            little = header.get("ByteOrder", "LowByteFirst") == "LowByteFirst"
+            dtype = np.dtype(_EDF_TYPES[header["DataType"]])
+            dtype = dtype.newbyteorder("<" if little else ">")
+            size = int(header.get("Size", dtype.itemsize * shape[0] * shape[1]))
+
+            self._offsets.append(data_offset)
+            self._shapes.append(shape)
+            self._dtypes.append(dtype)
+            self._next_header = data_offset + size
+
+    def _read_header(self, off):
+        """
+        Return the EDF header starting at uncompressed offset `off` as a dict, and
+        the offset of the data following it. Returns None, None at the end of the
+        file.
+        """
+        n = 512
+        while True:
+            text = self._read(off, n)
+            end = text.find(b"}\n")
+            if end >= 0 or len(text) < n:
+                break
+            n *= 2
+
+        if end < 0 or not text.lstrip().startswith(b"{"):
+            return None, None
+
+        header = {}
+        for item in text[:end].decode(errors="replace").lstrip("{").split(";"):
+            if "=" in item:
+                k, v = item.split("=", 1)
+                header[k.strip()] = v.strip()
+
+        return header, off + end + 2
+
+    def _reset_stream(self):
+        """
+        Forget the decompression state, e.g. after unpickling.
+        """
+        self._f = None
+        self._ckpts = [(0, 0, None)]  # (compressed, uncompressed offset, state)
+        self._ckpts_uout = [0]
+        self._dobj = None
+        self._cin = 0
+        self._buf = bytearray()
+        self._buf_start = 0
+        self._eof = False
+
+    def _read(self, start, size):
+        """
+        Return `size` uncompressed bytes from offset `start` (fewer at the end of
+        the file).
+        """
+        if self._f is None:
+            self._f = open(self.filename, "rb")
+
+        if not self._gzipped:
+            self._f.seek(start)
+            return self._f.read(size)
+
+        buf_end = self._buf_start + len(self._buf)
+
+        # restart from the closest seek point if behind or far ahead of the stream
+        i = bisect.bisect_right(self._ckpts_uout, start) - 1
+        if (
+            self._dobj is None
+            or start < self._buf_start
+            or self._ckpts_uout[i] > buf_end
+        ):
+            cin, uout, state = self._ckpts[i]
+            self._dobj = zlib.decompressobj(31) if state is None else state.copy()
+            self._cin = cin
+            self._buf = bytearray()
+            self._buf_start = uout
+            self._eof = False
+
+        while self._buf_start + len(self._buf) < start + size and not self._eof:
+            self._feed()
+            # only keep what is still needed
+            drop = min(start - self._buf_start, len(self._buf))
+            if drop > 0:
+                del self._buf[:drop]
+                self._buf_start += drop
+
+        i0 = start - self._buf_start
+        return bytes(self._buf[i0 : i0 + size])
+
+    def _feed(self, block=2**16):
+        """
+        Decompress the next `block` compressed bytes, saving a seek point every
+        `self.spacing` uncompressed bytes.
+        """
+        self._f.seek(self._cin)
+        chunk = self._f.read(block)
+        if not chunk:
+            self._eof = True
+            return
+
+        data = self._dobj.decompress(chunk)
+        self._cin += len(chunk)
+
+        # concatenated gzip members
+        if self._dobj.eof:
+            unused = self._dobj.unused_data
+            self._cin -= len(unused)
+            self._dobj = zlib.decompressobj(31)
+            if len(unused) == 0 and not self._f.read(1):
+                self._eof = True
+
+        self._buf += data
+        buf_end = self._buf_start + len(self._buf)
+        if buf_end >= self._ckpts_uout[-1] + self.spacing:
+            self._ckpts.append((self._cin, buf_end, self._dobj.copy()))
+            self._ckpts_uout.append(buf_end)
+
+    def _load_index(self):
+        """
+        Load the frame index if it was saved for this very file.
+        """
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if index.get("version") != _INDEX_VERSION or index["stat"] != self._stat:
+            return
+
+        self._offsets = index["offsets"]
+        self._shapes = [tuple(s) for s in index["shapes"]]
+        self._dtypes = [np.dtype(d) for d in index["dtypes"]]
+        self._complete = True
+
+    def _save_index(self):
+        index = dict(
+            version=_INDEX_VERSION,
+            stat=self._stat,
+            offsets=self._offsets,
+            shapes=self._shapes,
+            dtypes=[d.str for d in self._dtypes],
+        )
+        try:
+            with open(self.index_path, "w") as f:
+                json.dump(index, f)
+        except OSError as err:
+            warnings.warn(f"Could not save the frame index {self.index_path}: {err}")
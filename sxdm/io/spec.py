@@ -4,19 +4,33 @@ Read SXDM data, i.e. the output of pscan commands on ID01.
 
 import re
 import os
+import glob
 import time
+import hashlib
 import warnings
+import collections
+import multiprocessing as mp
 
+import h5py
+import hdf5plugin
 import numpy as np
 import silx.io
 import xrayutilities as xu
 
+from functools import partial
+from numpy.linalg import LinAlgError
 from silx.io.specfile import SpecFile, Scan, SfErrColNotFound  # TODO use silx.io
 from tqdm.notebook import tqdm
 
 from id01lib import xrd
 from silx.math import fit
 
+from .edf import EdfFrames
+
+# q-space coordinates computed by PiezoScan.calc_qspace_coordinates, keyed by geometry
+_QSPACE_COORDS_CACHE_SIZE = 8
+_qspace_coords_cache = collections.OrderedDict()
+
 
 class FastSpecFile(SpecFile):
     """
@@ -31,6 +45,11 @@ class FastSpecFile(SpecFile):
     ----------
     filename : str
         Path to the _fast_xxxxx.spec file to read.
+    cache_path : str, optional
+        Path to a .npz file where the counters of all the scans are saved the first
+        time they are read (see `get_counters`), and read from as long as the
+        _fast_xxxxx.spec file is not modified. Default is None, i.e. the counters
+        are only cached in memory.
 
     Attributes
     ----------
@@ -44,6 +63,8 @@ class FastSpecFile(SpecFile):
         Indexes of the scans contained within the _fast_xxxx.spec file. Use one of
         such ``n.m`` indexes to slice the `FastSpecFile` instance obtaining a
         `PiezoScan` instance.
+    get_counters : dict
+        The counters of all the scans, as ``{key: {counter: np.ndarray}}``.
 
     Returns
     -------
@@ -58,15 +79,50 @@ class FastSpecFile(SpecFile):
     >>> pscan = fsf['10.2']
     """
 
-    def __new__(cls, filename):
+    def __new__(cls, filename, cache_path=None):
         return super(FastSpecFile, cls).__new__(cls, filename)
 
-    def __init__(self, filename):
+    def __init__(self, filename, cache_path=None):
         if not isinstance(filename, str):
             self.filename = filename.decode()
         else:
             self.filename = filename
 
+        self.cache_path = cache_path
+        self._counters = None
+
+    def get_counters(self):
+        """
+        Return the counters of all the scans as ``{key: {counter: np.ndarray}}``.
+
+        The counter columns are read once for all the scans and then kept in memory,
+        and in the `cache_path` .npz file if given, so that `PiezoScan.get_roidata`
+        and `PiezoScan.get_piezo_coordinates` do not parse the scans again.
+        """
+        if self._counters is not None:
+            return self._counters
+
+        stat = os.stat(self.filename)
+        stat = np.array([stat.st_mtime, stat.st_size])
+
+        if self.cache_path is not None:
+            self._counters = _load_counters_cache(self.cache_path, stat)
+            if self._counters is not None:
+                return self._counters
+
+        counters = {}
+        for index, key in enumerate(self.keys()):
+            labels = self.labels(index)
+            data = np.asarray(self.data(index), dtype="float64")
+            data = data.reshape(-1, len(labels)).T
+            counters[key] = {label: col for label, col in zip(labels, data)}
+        self._counters = counters
+
+        if self.cache_path is not None:
+            _save_counters_cache(self.cache_path, stat, counters)
+
+        return self._counters
+
     def __str__(self):
         fname = os.path.basename(self.filename)
 
@@ -169,8 +225,13 @@ class PiezoScan(Scan):
     get_edf_filename()
         Returns the full path to the .edf.gz file containing the detector frames
         collected as part of the scan.
-    get_detector_frames()
-        TODO
+    get_h5_filename()
+        Returns the full path to the .h5 copy of the detector frames written by
+        `transcode_pscans`.
+    get_detector_frames(lazy=False)
+        Returns the detector frames as a (n_points, rows, columns) array, or as a
+        lazy `sxdm.io.edf.EdfFrames` reader (`h5py.Dataset` if transcoded) if
+        `lazy` is True. The .h5 copy of the frames is read if it exists.
     get_detcalib()
         Returns the output of the SPEC `det_calib` command, i.e. the detector
         distance, central pixel, pixels per degree, and incident beam energy.
@@ -180,6 +241,9 @@ class PiezoScan(Scan):
         TODO
     fit_gaussian()
         TODO
+    fit_gaussian_map()
+        Fits a Gaussian to the qy and qz projections of the frames at every scan
+        position, returning the area, centre and FWHM maps.
     """
 
     motordef = dict(pix="adcY", piy="adcX", piz="adcZ")
@@ -237,9 +301,17 @@ class PiezoScan(Scan):
 
         return "\n".join(table)
 
+    def _get_column(self, counter):
+        # read from the counters cached by the FastSpecFile, if any
+        try:
+            counters = self._specfile.get_counters()
+            return counters[f"{self.number}.{self.order}"][counter].copy()
+        except (AttributeError, KeyError):
+            return self.data_column_by_name(counter)
+
     def get_roidata(self, counter):
         try:
-            data = self.data_column_by_name(counter)
+            data = self._get_column(counter)
         except SfErrColNotFound as err:
             msg = '"{0}" is not a valid counter; available '.format(counter)
             msg += "counters are: {0}".format(self.labels)
@@ -255,7 +327,7 @@ class PiezoScan(Scan):
 
     def get_piezo_coordinates(self):
         motor1, motor2 = [
-            self.data_column_by_name(self.motordef[x]).reshape(self.shape)
+            self._get_column(self.motordef[x]).reshape(self.shape)
             for x in self.piezo_motor_names
         ]
         return motor1, motor2
@@ -314,13 +386,47 @@ class PiezoScan(Scan):
         )
         return edf_path
 
-    def get_detector_frames(self, img_dir=None, entry_name="scan_0"):
+    def get_h5_filename(self, img_dir=None, h5_dir=None):
+        edf_path = self._get_edf_path(img_dir)
+        if h5_dir is None:
+            h5_dir = os.path.dirname(edf_path)
+
+        fname = os.path.basename(edf_path)
+        for ext in (".gz", ".edf"):
+            if fname.endswith(ext):
+                fname = fname[: -len(ext)]
+
+        return os.path.join(h5_dir, fname + ".h5")
+
+    def _get_edf_path(self, img_dir=None):
         edf_path_raw = self.get_edf_filename()
         if img_dir is None:
-            edf_path = edf_path_raw
+            return edf_path_raw
         else:
             edf_fname = os.path.basename(edf_path_raw)
-            edf_path = os.path.join(img_dir, edf_fname)
+            return os.path.join(img_dir, edf_fname)
+
+    def get_detector_frames(
+        self, img_dir=None, entry_name="scan_0", lazy=False, h5_dir=None
+    ):
+        # prefer the copy written by transcode_pscans
+        h5_path = self.get_h5_filename(img_dir, h5_dir)
+        if os.path.isfile(h5_path):
+            h5f = h5py.File(h5_path, "r")
+            dset = h5f[f"{self.number}.{self.order}/measurement/image"]
+            if lazy:
+                self.frames = dset  # keeps the file open
+            else:
+                self.frames = dset[()]
+                h5f.close()
+            return self.frames
+
+        edf_path = self._get_edf_path(img_dir)
+
+        # frames are only decompressed when accessed
+        if lazy:
+            self.frames = EdfFrames(edf_path)
+            return self.frames
 
         # decompress edf file and load to memory
         t0 = time.time()
@@ -332,14 +438,6 @@ class PiezoScan(Scan):
             self.frames = edf_h5[f"{entry_name}/image/data"][...]
         print("Done in {:.2f}s".format(time.time() - t0))
 
-        # write to hdf5
-        # try:
-        #     os.remove('temp_frames.h5')
-        # except FileNotFoundError:
-        #     pass
-        # with h5py.File('temp_frames.h5', 'a') as h5f:
-        #     h5f.create_dataset('frames', data=self.frames)
-
         return self.frames
 
     def get_detcalib(self):
@@ -375,10 +473,17 @@ class PiezoScan(Scan):
         ipdir=(1, 0, 0),
         ndir=(0, 0, 1),
         ignore_mpx_motors=True,
+        cache=True,
+        cache_dir=None,
     ):
         """
         ID01-specific function to calculate reciprocal space coordinates of a scan.
 
+        The coordinates are memoised in memory, and in `cache_dir` on disk if given,
+        keyed by the angles, the central pixel, the detector distance, the energy,
+        the detector and the sample orientation, so that the pscans of a
+        `FastSpecFile` sharing the same geometry are only computed once.
+
         Parameters
         ----------
         cen_pix : 2-tuple(int)
@@ -409,6 +514,12 @@ class PiezoScan(Scan):
             Wether to correct for mpxy, mpxz (not necessary if loading the detector
             calibration)
 
+        cache : bool
+            Use and update the in-memory and on-disk caches. Default is True.
+
+        cache_dir : str
+            Directory of the on-disk cache. Default is None, i.e. memory only.
+
         Returns
         -------
         qx, qy, qz : numpy.ndarray
@@ -493,23 +604,62 @@ class PiezoScan(Scan):
                 pos = 0.0
             self._angles[a] = pos - self.qconversion_motors_offsets[a]
 
-        # Init the experiment class feeding it the geometry
-        hxrd = xu.HXRD(ipdir, ndir, en=nrj, qconv=self.geometry.getQconversion())
-
-        # init XU detector class
-        hxrd.Ang2Q.init_area(
-            *det.directions,
-            cch1=cpy,
-            cch2=cpx,
-            Nch1=det.pixnum[0],
-            Nch2=det.pixnum[1],
-            pwidth1=det.pixsize[0],
-            pwidth2=det.pixsize[1],
-            distance=detdist,
+        qconv = self.geometry.getQconversion()
+        key = _get_qspace_coords_key(
+            angles=[float(a) for a in self._angles.values()],
+            cen_pix=(float(cpy), float(cpx)),
+            distance=float(detdist),
+            energy=float(nrj),
+            directions=list(det.directions),
+            pixnum=[int(n) for n in det.pixnum],
+            pixsize=[float(x) for x in det.pixsize],
+            ipdir=[float(x) for x in ipdir],
+            ndir=[float(x) for x in ndir],
+            qconv=str(qconv),
         )
+        path_cache = None
+        if cache_dir is not None:
+            path_cache = os.path.join(cache_dir, f"qspace_coords_{key}.npy")
+
+        if cache and key in _qspace_coords_cache:
+            _qspace_coords_cache.move_to_end(key)
+            q_array = _qspace_coords_cache[key]
+        elif cache and path_cache is not None and os.path.isfile(path_cache):
+            q_array = np.load(path_cache)
+            q_array.flags.writeable = False
+        else:
+            # Init the experiment class feeding it the geometry
+            hxrd = xu.HXRD(ipdir, ndir, en=nrj, qconv=qconv)
+
+            # init XU detector class
+            hxrd.Ang2Q.init_area(
+                *det.directions,
+                cch1=cpy,
+                cch2=cpx,
+                Nch1=det.pixnum[0],
+                Nch2=det.pixnum[1],
+                pwidth1=det.pixsize[0],
+                pwidth2=det.pixsize[1],
+                distance=detdist,
+            )
+
+            # Calculate q space values
+            q_array = np.stack(hxrd.Ang2Q.area(*self._angles.values()))
+            q_array.flags.writeable = False  # shared by all pscans when cached
+
+            if cache and path_cache is not None:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    np.save(path_cache, q_array)
+                except OSError as err:
+                    warnings.warn(f"Could not cache q-space coordinates on disk: {err}")
 
-        # Calculate q space values
-        qx, qy, qz = hxrd.Ang2Q.area(*self._angles.values())
+        if cache:
+            _qspace_coords_cache[key] = q_array
+            while len(_qspace_coords_cache) > _QSPACE_COORDS_CACHE_SIZE:
+                _qspace_coords_cache.popitem(last=False)
+
+        qx, qy, qz = q_array
 
         self.qx = qx
         self.qy = qy
@@ -522,11 +672,19 @@ class PiezoScan(Scan):
 
         return qx, qy, qz
 
-    def calc_coms(self, roi=None, qspace=False, calc_std=False):
+    def calc_coms(
+        self, roi=None, qspace=False, calc_std=False, n_proc=None, block_size=2**26
+    ):
         """
         Calculate the centre of mass (COM) of the intensity in a detector frame for
         each scan position.
 
+        The COMs and STDs are computed from the zeroth, first and second moments of
+        the frames, obtained by blocks of frames with a matrix product against the
+        pixel (or q-space) coordinates. If the frames are not loaded yet, they are
+        read lazily (see `get_detector_frames`), so that only a block of frames is
+        held in memory at once.
+
         Parameters
         ----------
         roi : list, optional
@@ -539,6 +697,12 @@ class PiezoScan(Scan):
         calc_std : bool, optional
             Compute the peak standard deviations (more or less the peak width).
             if qspace==True, the STDs are calculated in q-space coordinates.
+        n_proc : int, optional
+            Number of processes reading the frames, each one a range of scan
+            positions. Default is a single process. Only useful when reading the
+            frames is the bottleneck, e.g. from the .h5 copy of the frames.
+        block_size : int, optional
+            Bytes of frames processed at once by each process. Default is 64 MB.
 
         Returns
         -------
@@ -557,103 +721,190 @@ class PiezoScan(Scan):
             roi = np.s_[roi[2] : roi[3], roi[0] : roi[1]]
         else:
             roi = np.s_[:, :]
-        roi = slice(None, None, None), *roi
 
         # Get frames - shape = (n_points, detX, detY)
         try:
             frames = self.frames
         except AttributeError:
-            frames = self.get_detector_frames()
-        y, z = np.indices(frames.shape[1:])[roi]
-        frames = frames[roi]
+            frames = self.get_detector_frames(lazy=True)
 
         if qspace:
             try:
-                qx, qy, qz = [q[roi[1:]] for q in (self.qx, self.qy, self.qz)]
-
-                coms = np.zeros((frames.shape[0], 3))
-                if calc_std:
-                    stds = np.zeros((frames.shape[0], 3))
-
-                for index in tqdm(range(frames.shape[0])):
-                    prob = frames[index] / frames[index].sum()
-                    qcoms = [np.sum(prob * q) for q in (qx, qy, qz)]
-                    coms[index, :] = qcoms
-
-                    if calc_std:
-                        qstds = [
-                            np.sqrt(np.sum(prob * (q - qcom) ** 2.0))
-                            for q, qcom in zip((qx, qy, qz), qcoms)
-                        ]
-                        stds[index, :] = qstds
-
-                cqx, cqy, cqz = coms.reshape(*self.shape, 3).T
-                if calc_std:
-                    stdqx, stdqy, stdqz = stds.reshape(*self.shape, 3).T
-
-                if calc_std:
-                    return cqx, cqy, cqz, stdqx, stdqy, stdqz
-                else:
-                    return cqx, cqy, cqz
-
+                pos = [q[roi] for q in (self.qx, self.qy, self.qz)]
             except AttributeError:
                 emsg = "Q-space coordinates not found. Please run the"
                 emsg += "`calc_qspace_coordinates` method before using"
                 emsg += "`qspace=True` in this function."
                 print(emsg)
+                return
         else:
-            coms = np.zeros((frames.shape[0], 2))
-            if calc_std:
-                stds = np.zeros((frames.shape[0], 2))
-
-            for index in tqdm(range(frames.shape[0])):
-                cy, cz = [
-                    (
-                        np.sum(frames[index] * pos, axis=(0, 1))
-                        / frames[index].sum(axis=(0, 1))
-                    )
-                    for pos in (y, z)
-                ]
-                coms[index, :] = cy, cz
-
-                if calc_std:
-                    prob = frames[index] / frames[index].sum()
-                    std = [
-                        np.sqrt(np.sum(prob * (pos - com) ** 2.0))
-                        for pos, com in zip((y, z), (cy, cz))
-                    ]
-                    stds[index, :] = std
-
-            cy, cz = coms.reshape(*self.shape, 2).T
-            if calc_std:
-                stdy, stdz = stds.reshape(*self.shape, 2).T
-
-            if calc_std:
-                return cy, cz, stdy, stdz
-            else:
-                return cy, cz
+            pos = np.indices(frames.shape[1:])[(slice(None), *roi)]
+        coords, offsets = _get_com_coords(pos, calc_std)
 
-    # def _calc_projections(self, roi=None, **qspace_kwargs):
+        # moments of each frame - shape = (n_points, n_coords)
+        n_frames = frames.shape[0]
+        frame_size = coords.shape[0] * 8
+        block = max(1, int(block_size // frame_size))
+        indexes = _get_frame_ranges(n_frames, n_proc)
 
-    #     '''
-    #     see the docstring of calc_qspace_coordinates for **qspace_kwargs
-    #     '''
+        pfun = partial(
+            _calc_moments_chunk, _get_frames_source(frames), roi, coords, block
+        )
+        if len(indexes) == 1:
+            moments = pfun(indexes[0], pbar=True)
+        else:
+            with mp.Pool(processes=n_proc) as p:
+                moments = np.concatenate(
+                    list(tqdm(p.imap(pfun, indexes), total=len(indexes)))
+                )
 
-    #     try:
-    #         frames = self.frames
-    #     except AttributeError:
-    #         frames = self.get_detector_frames()
+        return _moments_to_coms(moments, offsets, calc_std, self.shape)
 
-    #     if roi is not None:
-    #         roi = np.s_[roi[2]:roi[3], roi[0]:roi[1]]
-    #     else:
-    #         roi = np.s_[:,:]
-    #     roi = slice(None,None,None), *roi
+    def reduce_frames(
+        self,
+        frame_sum=True,
+        rois=None,
+        coms=False,
+        com_roi=None,
+        qspace=False,
+        calc_std=False,
+        img_dir=None,
+        block_size=2**26,
+    ):
+        """
+        Compute several reductions of the detector frames in a single pass over
+        them, decompressing the EDF file block by block (see `get_detector_frames`)
+        if the frames are not loaded, so that only a block of frames is held in
+        memory at once.
 
-    #     return frames[roi].sum(0), frames[roi].sum(1)
+        Parameters
+        ----------
+        frame_sum : bool, optional
+            Compute the sum of all the frames. Default is True.
+        rois : dict, optional
+            ROIs as ``{name: [x_min, x_max, y_min, y_max]}``, e.g. the output of
+            `get_roipos`, whose intensity map is computed.
+        coms : bool, optional
+            Compute the COM maps, as `calc_coms`. Default is False.
+        com_roi : list, optional
+            Detector ROI of the COMs, as the `roi` of `calc_coms`.
+        qspace : bool, optional
+            Compute the COMs in q-space coordinates, as in `calc_coms`.
+        calc_std : bool, optional
+            Also compute the STDs, as in `calc_coms`.
+        img_dir : str, optional
+            Directory of the EDF file, if not the one saved in the SPEC file.
+        block_size : int, optional
+            Bytes of frames held in memory at once. Default is 64 MB.
 
-    def fit_gaussian(self, index, roi=None, **qspace_kwargs):
-        # roi
+        Returns
+        -------
+        dict
+            With keys "frame_sum" (2D array), "rois" (``{name: map}``, with the
+            shape of `get_roidata`) and "coms" (as returned by `calc_coms`), for the
+            requested reductions. Positions without a frame, e.g. in interrupted
+            scans, are 0 in the ROI maps and NaN in the COM maps.
+        """
+
+        try:
+            frames = self.frames
+        except AttributeError:
+            frames = self.get_detector_frames(img_dir=img_dir, lazy=True)
+
+        if com_roi is not None:
+            com_roi = np.s_[com_roi[2] : com_roi[3], com_roi[0] : com_roi[1]]
+        else:
+            com_roi = np.s_[:, :]
+
+        if coms and qspace:
+            try:
+                qcoords = [q[com_roi] for q in (self.qx, self.qy, self.qz)]
+            except AttributeError:
+                emsg = "Q-space coordinates not found. Please run the "
+                emsg += "`calc_qspace_coordinates` method before using "
+                emsg += "`qspace=True` in this function."
+                raise ValueError(emsg)
+
+        rois = {} if rois is None else rois
+        rois = {k: np.s_[:, r[2] : r[3], r[0] : r[1]] for k, r in rois.items()}
+
+        n_points = self.shape[0] * self.shape[1]
+        roi_maps = {k: np.zeros(n_points) for k in rois}
+        out = dict()
+
+        # the number of frames is only known once the EDF file has been read
+        j, block = 0, 1
+        with tqdm(total=n_points) as pbar:
+            while j < n_points:
+                data = np.asarray(frames[j : j + block], dtype="float64")
+                if data.shape[0] == 0:
+                    break
+                n = data.shape[0]
+
+                if j == 0:
+                    block = max(1, int(block_size // data[0].nbytes))
+                    if frame_sum:
+                        out["frame_sum"] = np.zeros(data.shape[1:])
+                    if coms:
+                        if qspace:
+                            pos = qcoords
+                        else:
+                            pos = np.indices(data.shape[1:])[(slice(None), *com_roi)]
+                        coords, offsets = _get_com_coords(pos, calc_std)
+                        moments = np.full((n_points, coords.shape[1]), np.nan)
+
+                if frame_sum:
+                    out["frame_sum"] += data.sum(0)
+                for k, roi in rois.items():
+                    roi_maps[k][j : j + n] = data[roi].sum(axis=(1, 2))
+                if coms:
+                    roi_data = data[(slice(None), *com_roi)].reshape(n, -1)
+                    moments[j : j + n] = roi_data @ coords
+
+                j += n
+                pbar.update(n)
+
+        if rois:
+            out["rois"] = {k: m.reshape(self.shape) for k, m in roi_maps.items()}
+        if coms:
+            out["coms"] = _moments_to_coms(moments, offsets, calc_std, self.shape)
+
+        return out
+
+    def _calc_projections(self, roi=None, n_proc=None, block_size=2**26):
+        """
+        Return the projections of the frames onto the detector columns and rows,
+        (n_points, n_columns) and (n_points, n_rows), computed in a single pass over
+        the frames.
+        """
+        if roi is not None:
+            roi = np.s_[roi[2] : roi[3], roi[0] : roi[1]]
+        else:
+            roi = np.s_[:, :]
+
+        try:
+            frames = self.frames
+        except AttributeError:
+            frames = self.get_detector_frames(lazy=True)
+
+        n_frames = frames.shape[0]
+        frame_size = np.empty(frames.shape[1:], dtype="float64")[roi].nbytes
+        block = max(1, int(block_size // frame_size))
+        indexes = _get_frame_ranges(n_frames, n_proc)
+
+        pfun = partial(_calc_projections_chunk, _get_frames_source(frames), roi, block)
+        if len(indexes) == 1:
+            return pfun(indexes[0], pbar=True)
+
+        with mp.Pool(processes=n_proc) as p:
+            res = list(tqdm(p.imap(pfun, indexes), total=len(indexes)))
+
+        return tuple(np.concatenate(r) for r in zip(*res))
+
+    def _get_projection_axes(self, roi=None, **qspace_kwargs):
+        """
+        Return the qy and qz axes of the projections of `_calc_projections`.
+        """
         if roi is not None:
             roi = np.s_[roi[2] : roi[3], roi[0] : roi[1]]
         else:
@@ -666,42 +917,469 @@ class PiezoScan(Scan):
             _, qy, qz = self.calc_qspace_coordinates(**qspace_kwargs)
         qy, qz = qy[roi], qz[roi]
 
-        gridder = xu.gridder2d.Gridder2D(*qy.shape)
+        # the projections onto the columns (rows) are plotted against qy (qz)
+        gridder = xu.gridder2d.Gridder2D(qy.shape[1], qy.shape[0])
         gridder(qy, qz, np.empty(qy.shape))
-        qyy, qzz = gridder.xaxis, gridder.yaxis
+
+        return gridder.xaxis, gridder.yaxis
+
+    def fit_gaussian(self, index, roi=None, **qspace_kwargs):
+        qyy, qzz = self._get_projection_axes(roi, **qspace_kwargs)
+
+        # roi
+        if roi is not None:
+            roi = np.s_[roi[2] : roi[3], roi[0] : roi[1]]
+        else:
+            roi = np.s_[:, :]
 
         # frames
         try:
             frames = self.frames
         except AttributeError:
-            frames = self.get_detector_frames()
+            frames = self.get_detector_frames(lazy=True)
 
-        roi = slice(None, None, None), *roi
-        py, pz = frames[roi].sum(1)[index], frames[roi].sum(2)[index]
+        frame = np.asarray(frames[index][roi], dtype="float64")
+        py, pz = frame.sum(0), frame.sum(1)
 
         p = {"qy": None, "qz": None}
         for name, ax, proj in zip(["qy", "qz"], [qyy, qzz], [py, pz]):
-            # load profile
-            x, y = ax, proj.astype("float64")
-
-            # estimate and subtract background
-            bg = fit.snip1d(y, len(y))
-            y -= bg
-
-            # guess initial params
-            area = y.sum() * (x[-1] - x[0]) / len(x)
-            mu = x[y.argmax()]
-            fwhm = 2.3 * area / (y.max() * np.sqrt(2 * np.pi))
-
-            # area, centroid, fwhm
-            params, cov, info = fit.leastsq(
-                fit.sum_agauss,
-                x,
-                y,
-                p0=[area, mu, fwhm],
-                #                                     sigma=np.sqrt(y),
-                full_output=True,
-            )
-            p[name] = params
+            p[name] = _fit_gaussian_profile(ax, proj)
+
+        return p
+
+    def fit_gaussian_map(
+        self, roi=None, n_proc=None, block_size=2**26, **qspace_kwargs
+    ):
+        """
+        Fit a Gaussian to the qy and qz projections of the frames of every scan
+        position.
+
+        The projections of all the frames are computed in a single pass over the
+        frames, then fitted in parallel, as in `fit_gaussian`, against the same qy
+        and qz axes.
+
+        Parameters
+        ----------
+        roi : list, optional
+            Detector frame region of interest specified as [x_min, x_max, y_min, y_max].
+            Default: full detector.
+        n_proc : int, optional
+            Number of processes for the fits. Default is the number of CPUs.
+        block_size : int, optional
+            Bytes of frames processed at once when computing the projections.
+            Default is 64 MB.
+        **qspace_kwargs
+            Passed to `calc_qspace_coordinates` if the q-space coordinates have not
+            been computed yet.
+
+        Returns
+        -------
+        dict
+            With keys "qy" and "qz", each holding a (3, rows, columns) array of the
+            area, centre and FWHM maps of the Gaussian. Failed fits are NaN.
+        """
+
+        qyy, qzz = self._get_projection_axes(roi, **qspace_kwargs)
+        py, pz = self._calc_projections(roi, block_size=block_size)
+
+        p = {"qy": None, "qz": None}
+        with mp.Pool(processes=n_proc) as pool:
+            for name, ax, proj in zip(["qy", "qz"], [qyy, qzz], [py, pz]):
+                pfun = partial(_fit_gaussian_profile, ax)
+                chunksize = max(1, len(proj) // (4 * (n_proc or os.cpu_count())))
+                res = list(
+                    tqdm(pool.imap(pfun, proj, chunksize=chunksize), total=len(proj))
+                )
+                p[name] = np.stack(res, axis=1).reshape(3, *self.shape)
 
         return p
+
+
+def _load_counters_cache(cache_path, stat):
+    """
+    Return the counters saved by `_save_counters_cache`, or None if `cache_path`
+    does not exist or was saved for another version of the SPEC file.
+    """
+    try:
+        npz = np.load(cache_path)
+    except (OSError, ValueError):
+        return None
+
+    with npz:
+        if not np.array_equal(npz["__stat__"], stat):
+            return None
+
+        # scans without counters have no array
+        counters = {key: {} for key in npz["__keys__"].tolist()}
+        for name in npz.files:
+            if not name.startswith("__"):
+                key, counter = name.split("::", 1)
+                counters[key][counter] = npz[name]
+
+    return counters
+
+
+def _save_counters_cache(cache_path, stat, counters):
+    """
+    Save the `counters` of `FastSpecFile.get_counters` to the .npz `cache_path`,
+    with the modification time and size `stat` of the SPEC file.
+    """
+    arrays = {
+        f"{key}::{counter}": col
+        for key, cols in counters.items()
+        for counter, col in cols.items()
+    }
+    try:
+        with open(cache_path, "wb") as f:
+            np.savez(f, __stat__=stat, __keys__=np.array(list(counters)), **arrays)
+    except OSError as err:
+        warnings.warn(f"Could not save the counters cache {cache_path}: {err}")
+
+
+def _get_qspace_coords_key(**params):
+    """
+    Return a hash identifying the q-space coordinates computed by
+    `PiezoScan.calc_qspace_coordinates` from the geometry `params`.
+    """
+    sha = hashlib.sha1()
+    for key in sorted(params):
+        sha.update(f"{key}={params[key]!r}".encode())
+
+    return sha.hexdigest()
+
+
+def clear_qspace_coords_cache(cache_dir=None):
+    """
+    Empty the in-memory cache of q-space coordinates used by
+    `PiezoScan.calc_qspace_coordinates` and, if `cache_dir` is given, delete the
+    coordinates cached on disk there.
+    """
+    _qspace_coords_cache.clear()
+
+    if cache_dir is not None:
+        for path in glob.glob(f"{cache_dir}/qspace_coords_*.npy"):
+            os.remove(path)
+
+
+def _get_frames_source(frames):
+    """
+    Return what the processes of `_calc_moments_chunk` need to read `frames`: the
+    file and dataset names for an `h5py.Dataset`, else `frames` itself.
+    """
+    if isinstance(frames, h5py.Dataset):
+        return frames.file.filename, frames.name
+    return frames
+
+
+def _get_frame_ranges(n_frames, n_proc):
+    """
+    Split `n_frames` in `n_proc` contiguous (i0, i1) ranges.
+    """
+    if n_proc is None or n_proc == 1:
+        return [(0, n_frames)]
+
+    step = int(np.ceil(n_frames / n_proc))
+    return [(i, min(i + step, n_frames)) for i in range(0, n_frames, step)]
+
+
+def _iter_frame_blocks(source, roi, block, idx_range, pbar=False):
+    """
+    Yield the offset within `idx_range` and the float64 data of the blocks of
+    `block` frames of `source` (see `_get_frames_source`), restricted to `roi`.
+    """
+    i0, i1 = idx_range
+    h5f = None
+    if isinstance(source, tuple):
+        h5f = h5py.File(source[0], "r")
+        frames = h5f[source[1]]
+    else:
+        frames = source
+
+    try:
+        for j in tqdm(range(i0, i1, block), disable=not pbar):
+            data = frames[(slice(j, min(j + block, i1)), *roi)]
+            yield j - i0, np.asarray(data, dtype="float64")
+    finally:
+        if h5f is not None:
+            h5f.close()
+
+
+def _calc_moments_chunk(source, roi, coords, block, idx_range, pbar=False):
+    """
+    Return the moments ``frame @ coords`` of the frames `idx_range` of `source`,
+    restricted to `roi`, reading `block` frames at a time.
+    """
+    moments = np.empty((idx_range[1] - idx_range[0], coords.shape[1]))
+    for j, data in _iter_frame_blocks(source, roi, block, idx_range, pbar):
+        moments[j : j + data.shape[0]] = data.reshape(data.shape[0], -1) @ coords
+
+    return moments
+
+
+def _calc_projections_chunk(source, roi, block, idx_range, pbar=False):
+    """
+    Return the projections onto the columns and rows of the frames `idx_range` of
+    `source`, restricted to `roi`, reading `block` frames at a time.
+    """
+    py, pz = [], []
+    for _, data in _iter_frame_blocks(source, roi, block, idx_range, pbar):
+        py.append(data.sum(1))
+        pz.append(data.sum(2))
+
+    return np.concatenate(py), np.concatenate(pz)
+
+
+def _get_com_coords(pos, calc_std):
+    """
+    Return the (n_pixels, n_coords) matrix whose product with the flattened frames
+    gives their moments against the pixel coordinates `pos`, and the offsets
+    subtracted from the coordinates.
+    """
+    # coordinates relative to their mean, to limit round-off errors on the STDs
+    pos = [p.astype("float64").ravel() for p in pos]
+    offsets = np.array([p.mean() for p in pos])
+    pos = [p - o for p, o in zip(pos, offsets)]
+    coords = [np.ones_like(pos[0]), *pos]
+    if calc_std:
+        coords += [p**2 for p in pos]
+
+    return np.stack(coords, axis=1), offsets
+
+
+def _moments_to_coms(moments, offsets, calc_std, shape):
+    """
+    Return the COM (and STD) maps of `PiezoScan.calc_coms` from the (n_points,
+    n_coords) `moments` of the frames against the coordinates of
+    `PiezoScan._get_com_coords`.
+    """
+    n_dim = len(offsets)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rel_coms = moments[:, 1 : n_dim + 1] / moments[:, :1]
+        coms = rel_coms + offsets
+        if calc_std:
+            var = moments[:, n_dim + 1 :] / moments[:, :1] - rel_coms**2
+            stds = np.sqrt(np.clip(var, 0, None))
+
+    coms = coms.reshape(*shape, n_dim).T
+    if calc_std:
+        stds = stds.reshape(*shape, n_dim).T
+        return (*coms, *stds)
+    else:
+        return tuple(coms)
+
+
+def _fit_gaussian_profile(x, y):
+    """
+    Fit a Gaussian to the profile `y` after subtracting its SNIP background.
+    Returns the area, centre and FWHM, NaN if the fit fails.
+    """
+    y = np.array(y, dtype="float64")
+
+    # estimate and subtract background
+    bg = fit.snip1d(y, len(y))
+    y -= bg
+
+    # guess initial params
+    area = y.sum() * (x[-1] - x[0]) / len(x)
+    mu = x[y.argmax()]
+    fwhm = 2.3 * area / (y.max() * np.sqrt(2 * np.pi))
+
+    # area, centroid, fwhm
+    try:
+        params, cov, info = fit.leastsq(
+            fit.sum_agauss, x, y, p0=[area, mu, fwhm], full_output=True
+        )
+    except (TypeError, ValueError, LinAlgError):
+        return np.full(3, np.nan)
+
+    return params
+
+
+def _transcode_edf(detector, chunks, block_size, args):
+    """
+    Write the frames of the EDF file `edf_path` and the counters of a pscan to the
+    .h5 file `path_h5`, with the layout of a BLISS scan. The file is first written
+    with a temporary name, so that an interrupted transcoding is never read.
+    """
+    edf_path, path_h5, key, command, date, counters = args
+
+    frames = EdfFrames(edf_path)
+    n_frames = len(frames)
+    chunks = (1, *frames.shape[1:]) if chunks is None else chunks
+    frame_size = np.prod(frames.shape[1:]) * frames.dtype.itemsize
+    block = max(1, int(block_size // frame_size))
+
+    path_tmp = path_h5 + ".tmp"
+    with h5py.File(path_tmp, "w") as h5f:
+        scan = h5f.create_group(key)
+        scan["title"] = command
+        scan["start_time"] = date
+        scan.attrs["NX_class"] = "NXentry"
+        scan.attrs["source"] = os.path.abspath(edf_path)
+
+        det = scan.create_group(f"instrument/{detector}")
+        det.attrs["NX_class"] = "NXdetector"
+        dset = det.create_dataset(
+            "data",
+            shape=frames.shape,
+            dtype=frames.dtype.newbyteorder("="),
+            chunks=chunks,
+            **hdf5plugin.Bitshuffle(nelems=0, cname="lz4"),
+        )
+        for i0 in range(0, n_frames, block):
+            dset[i0 : i0 + block] = frames[i0 : i0 + block]
+
+        meas = scan.create_group("measurement")
+        meas["image"] = h5py.SoftLink(dset.name)
+        if detector != "image":
+            meas[detector] = h5py.SoftLink(dset.name)
+        for name, data in counters.items():
+            meas[name.replace("/", "_")] = data
+
+    os.replace(path_tmp, path_h5)
+
+    return path_h5
+
+
+def transcode_pscans(
+    fast_specfile,
+    scan_keys=None,
+    img_dir=None,
+    h5_dir=None,
+    detector="maxipix",
+    chunks=None,
+    overwrite=False,
+    n_proc=None,
+    block_size=2**26,
+):
+    """
+    Convert the .edf.gz detector frames of the pscans of a `FastSpecFile` to
+    chunked, bitshuffle-lz4 compressed .h5 files, so that they are decompressed
+    only once.
+
+    Each pscan is written to its own .h5 file (see `PiezoScan.get_h5_filename`),
+    one pscan per process, with the layout of a BLISS scan: the frames are stored
+    in ``/{key}/instrument/{detector}/data``, linked from ``/{key}/measurement``
+    together with the SPEC counters, so that the BLISS functions, e.g.
+    `sxdm.io.bliss.get_sxdm_frame_sum`, can read them.
+    `PiezoScan.get_detector_frames` then reads this copy instead of the EDF file.
+
+    Parameters
+    ----------
+    fast_specfile : FastSpecFile or str
+        The _fast_xxxxx.spec file, or its path.
+    scan_keys : list, optional
+        The ``"n.m"`` keys of the pscans to transcode. Default is all of them.
+    img_dir : str, optional
+        Directory of the EDF files, if not the one saved in the SPEC file.
+    h5_dir : str, optional
+        Directory of the .h5 files. Default is the directory of the EDF files.
+    detector : str, optional
+        Name of the detector in the .h5 files, by default "maxipix".
+    chunks : tuple, optional
+        Chunk shape of the frames. Default is one frame per chunk, as in BLISS.
+    overwrite : bool, optional
+        Transcode again the pscans already transcoded, by default False.
+    n_proc : int, optional
+        Number of processes. Default is the number of CPUs.
+    block_size : int, optional
+        Bytes of frames held in memory by each process. Default is 64 MB.
+
+    Returns
+    -------
+    list
+        Paths of the .h5 files.
+    """
+
+    if isinstance(fast_specfile, str):
+        fast_specfile = FastSpecFile(fast_specfile)
+    if scan_keys is None:
+        scan_keys = fast_specfile.keys()
+    if h5_dir is not None:
+        os.makedirs(h5_dir, exist_ok=True)
+
+    # the SPEC file is read here, workers only get paths and arrays
+    args, paths = [], []
+    for key in scan_keys:
+        pscan = fast_specfile[key]
+        path_h5 = pscan.get_h5_filename(img_dir, h5_dir)
+        paths.append(path_h5)
+        if os.path.isfile(path_h5) and not overwrite:
+            continue
+
+        counters = {name: col for name, col in zip(pscan.labels, pscan.data)}
+        edf_path = pscan._get_edf_path(img_dir)
+        args.append((edf_path, path_h5, key, pscan.command, pscan.datetime, counters))
+
+    pfun = partial(_transcode_edf, detector, chunks, block_size)
+    with mp.Pool(processes=n_proc) as p:
+        for _ in tqdm(p.imap_unordered(pfun, args), total=len(args)):
+            pass
+
+    return paths
+
+
+def read_spec_headers(filename, chunk_size=2**26):
+    """
+    Read the scan headers of a SPEC file without parsing its data.
+
+    Only the ``#S`` and ``#D`` lines are looked for, with a regular expression run
+    on blocks of `chunk_size` bytes, which is much faster than opening the file
+    with `FastSpecFile` on large files.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the SPEC file.
+    chunk_size : int, optional
+        Number of bytes read at once. Default is 64 MB.
+
+    Returns
+    -------
+    dict
+        With keys:
+
+        - n_scans: the number of scans.
+        - keys: the ``"n.m"`` keys of the scans, as in `FastSpecFile.keys()`.
+        - commands: the ``#S`` line of each scan, as in `PiezoScan.command`.
+        - dates: the ``#D`` line of each scan, as in `PiezoScan.datetime`.
+        - shapes: the 2D shape of each scan, as in `PiezoScan.shape`, or None if
+          it cannot be read from the command.
+    """
+
+    pattern = re.compile(rb"^#([SD]) (.*?)\r?$", re.M)
+    keys, commands, dates, shapes = [], [], [], []
+    orders = {}
+
+    tail = b""
+    with open(filename, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+
+            # only parse whole lines, keeping the last partial line for later
+            data = tail + chunk
+            if chunk:
+                cut = data.rfind(b"\n") + 1
+                data, tail = data[:cut], data[cut:]
+
+            for m in pattern.finditer(data):
+                line = m.group(2).decode(errors="replace").strip()
+                if m.group(1) == b"S":
+                    number = line.split()[0]
+                    orders[number] = orders.get(number, 0) + 1
+                    keys.append("{}.{}".format(number, orders[number]))
+                    commands.append(line)
+                    dates.append(None)
+                    try:
+                        shapes.append((int(line.split()[9]), int(line.split()[5])))
+                    except (IndexError, ValueError):
+                        shapes.append(None)
+                elif len(commands) > 0 and dates[-1] is None:
+                    dates[-1] = line  # the file header #D is not a scan date
+
+            if not chunk:
+                break
+
+    return dict(
+        n_scans=len(keys), keys=keys, commands=commands, dates=dates, shapes=shapes
+    )
@@ -1,5 +1,7 @@
 import h5py
 import os
+import shutil
+import numpy as np
 
 from id01lib.io.bliss import ioh5
 
@@ -27,12 +29,11 @@ def _get_chunk_indexes(path_h5, path_in_h5, n_proc=None):
     else:
         ncpu = n_proc
 
-    chunk_size = map_shape_flat // ncpu
-    last_chunk = chunk_size + map_shape_flat % chunk_size
+    chunk_size = max(map_shape_flat // ncpu, 1)
 
     c0 = [x for x in range(0, map_shape_flat - chunk_size + 1, chunk_size)]
     c1 = [x for x in c0.copy()[1:]]
-    c1.append(c1[-1] + last_chunk)
+    c1.append(map_shape_flat)
 
     indexes = list(zip(c0, c1))
 
@@ -57,7 +58,7 @@ def _get_chunk_indexes_detector(path_h5, path_in_h5, n_chunks=3, roi=None):
     if n_chunks is None:
         n_chunks = os.cpu_count()
     elif n_chunks == 1:
-        return [(0, det_shape[0], det_shape[1])]
+        return [[(roi[0], roi[1])], [(roi[2], roi[3])]]
 
     chunk_size = [d // n_chunks for d in det_shape]
 
@@ -85,3 +86,148 @@ def _get_qspace_avg_chunk(path_h5, path_in_h5, idx_mask, idx_range):
         chunk = chunk.sum(0)
 
     return chunk
+
+
+def _read_qspace_sparse(h5f, idx_range):
+    """
+    Read the sparse q-space data of the (flattened) sample positions in
+    `idx_range` from the open q-space file `h5f`. Returns the number of stored
+    voxels per position, their flat q-space indexes and their intensity.
+    """
+    i0, i1 = idx_range
+    grp = h5f["Data/qspace_sparse"]
+
+    indptr = grp["indptr"][i0 : i1 + 1]
+    indices = grp["indices"][indptr[0] : indptr[-1]]
+    values = grp["data"][indptr[0] : indptr[-1]]
+
+    return np.diff(indptr), indices, values
+
+
+def _get_qspace_avg_chunk_sparse(path_h5, idx_mask, idx_range):
+    """
+    Sparse counterpart of `_get_qspace_avg_chunk`: return the flattened q-space
+    intensity array summed over the sample positions given by `idx_range`.
+    """
+    i0, i1 = idx_range
+    with h5py.File(path_h5, "r") as h5f:
+        n_vox = int(np.prod(h5f["Data/qspace_sparse"].attrs["shape"][1:]))
+        counts, indices, values = _read_qspace_sparse(h5f, idx_range)
+
+    keep = np.repeat(np.array([idx_mask[x] for x in range(i0, i1)], bool), counts)
+    chunk = np.bincount(indices[keep], weights=values[keep], minlength=n_vox)
+
+    return chunk
+
+
+def _bin_pixels(arr, k, func=np.sum):
+    """
+    Bin the last two (detector) dimensions of `arr` by `k` x `k` blocks with
+    `func`, dropping the rows and columns left over.
+    """
+    if k == 1:
+        return arr
+
+    *sh, h, w = arr.shape
+    h, w = h // k * k, w // k * k
+    arr = arr[..., :h, :w].reshape(*sh, h // k, k, w // k, k)
+
+    return func(arr, axis=(-3, -1))
+
+
+def _bin_positions(arr, map_width, m, func=np.sum):
+    """
+    Bin the first (flattened sample position) dimension of `arr`, made of whole
+    rows of `map_width` positions, by `m` x `m` map blocks with `func`, dropping
+    the rows and columns left over.
+    """
+    if m == 1:
+        return arr
+
+    n_rows = arr.shape[0] // map_width // m
+    w = map_width // m * m
+    arr = arr[: n_rows * m * map_width].reshape(n_rows, m, map_width, *arr.shape[1:])
+    arr = arr[:, :, :w].reshape(n_rows, m, w // m, m, *arr.shape[3:])
+
+    return func(arr, axis=(1, 3)).reshape(n_rows * (w // m), *arr.shape[4:])
+
+
+def _get_row_chunk_indexes(map_shape, m=1, n_proc=None):
+    """
+    Return a list of (i0, i1) ranges of (flattened) sample positions made of whole
+    blocks of `m` map rows, so that they can be binned by `_bin_positions`. The map
+    rows left over by the binning are dropped.
+    """
+    n_rows, width = map_shape[0] // m, map_shape[1]
+    n_proc = os.cpu_count() if n_proc is None else n_proc
+    step = max(1, -(-n_rows // n_proc))
+
+    return [
+        (r * m * width, min(r + step, n_rows) * m * width)
+        for r in range(0, n_rows, step)
+    ]
+
+
+def _iter_binned_frames(dset, idx_range, det_sl=(), det_bin=1, pos_bin=1, width=1):
+    """
+    Yield the frames `dset[i0:i1][(slice(None), *det_sl)]` binned by `det_bin` x
+    `det_bin` pixels and `pos_bin` x `pos_bin` map positions (maps `width`
+    positions wide), reading `pos_bin` map rows at a time.
+    """
+    i0, i1 = idx_range
+    step = pos_bin * width
+
+    for b0 in range(i0, i1, step):
+        frames = dset[(slice(b0, min(b0 + step, i1)), *det_sl)]
+        frames = _bin_pixels(frames, det_bin)
+
+        yield _bin_positions(frames, width, pos_bin)
+
+
+def _get_shard_dir(path_out, clear=False):
+    """
+    Return the directory holding the shard files of `path_out`, created if needed.
+    If `clear` is True, shards left by a previous run are deleted first.
+    """
+    shard_dir = f"{os.path.splitext(path_out)[0]}_shards"
+    if clear and os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+
+    return shard_dir
+
+
+def _write_shard(path_shard, path_in_h5, data, **kwargs):
+    """
+    Write `data` to the dataset `path_in_h5` of its own shard file `path_shard`,
+    with `kwargs` passed to `create_dataset`. Returns `path_shard`.
+    """
+    with h5py.File(path_shard, "w") as h5f:
+        h5f.create_dataset(path_in_h5, data=data, **kwargs)
+
+    return path_shard
+
+
+def _create_virtual_dataset(h5f, path_in_h5, shape, dtype, shards, fillvalue=0):
+    """
+    Create (replacing any existing one) the virtual dataset `path_in_h5` of `h5f`
+    stitching together the shard files written by `_write_shard`. `shards` is a
+    list of (path_shard, path_in_shard, sel) tuples, `sel` being the region of the
+    virtual dataset the whole shard dataset maps to. Regions not covered by any
+    shard read as `fillvalue`.
+
+    Shards are referenced relative to the directory of `h5f`, so the two can be
+    moved together.
+    """
+    layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+    dirname = os.path.dirname(os.path.abspath(h5f.filename))
+    for path_shard, path_in_shard, sel in shards:
+        with h5py.File(path_shard, "r") as f:
+            sh_shard = f[path_in_shard].shape
+        source = os.path.relpath(os.path.abspath(path_shard), dirname)
+        layout[sel] = h5py.VirtualSource(source, path_in_shard, shape=sh_shard)
+
+    if path_in_h5 in h5f:
+        del h5f[path_in_h5]
+
+    return h5f.create_virtual_dataset(path_in_h5, layout, fillvalue=fillvalue)
@@ -1,11 +1,245 @@
+import os
+import time
+import tempfile
+import collections
 import numpy as np
 import multiprocessing as mp
 import h5py
+import hdf5plugin
 
 from tqdm.notebook import tqdm
 from functools import partial
+from xsocs.util import project
 
-from .utils import _get_chunk_indexes, _get_qspace_avg_chunk, ioh5
+from .utils import (
+    _get_chunk_indexes,
+    _get_qspace_avg_chunk,
+    _get_qspace_avg_chunk_sparse,
+    _read_qspace_sparse,
+    ioh5,
+)
+
+
+@ioh5
+def is_qspace_sparse(h5f):
+    """
+    Return True if the q-space file `h5f` stores the q-space intensity in the
+    sparse `Data/qspace_sparse` format rather than as a dense `Data/qspace` array.
+    """
+    return "Data/qspace_sparse" in h5f
+
+
+@ioh5
+def get_qspace_shape(h5f):
+    """
+    Return the (n_positions, nx, ny, nz) shape of the q-space intensity stored in
+    the q-space file `h5f`, be it dense or sparse.
+    """
+    if "Data/qspace_sparse" in h5f:
+        return tuple(int(x) for x in h5f["Data/qspace_sparse"].attrs["shape"])
+    else:
+        return h5f["Data/qspace"].shape
+
+
+@ioh5
+def get_qspace_axes(h5f):
+    """
+    Return the names of the q-space axes of the q-space file `h5f`: ("pitch",
+    "roll", "radial") if it was gridded in spherical coordinates, ("qx", "qy",
+    "qz") otherwise.
+    """
+    if "Data/pitch" in h5f:
+        return ("pitch", "roll", "radial")
+    else:
+        return ("qx", "qy", "qz")
+
+
+@ioh5
+def get_qspace_position(h5f, idx):
+    """
+    Return the 3D q-space intensity at the (flattened) sample position `idx` of the
+    q-space file `h5f`, be it dense or sparse.
+    """
+    if "Data/qspace_sparse" in h5f:
+        shape = get_qspace_shape(h5f)[1:]
+        _, indices, values = _read_qspace_sparse(h5f, (idx, idx + 1))
+
+        arr = np.zeros(np.prod(shape), dtype=values.dtype)
+        arr[indices] = values
+
+        return arr.reshape(shape)
+    else:
+        return h5f["Data/qspace"][idx]
+
+
+def _get_roi_key(roi):
+    """
+    Return a hashable key for the q-space ROI `roi` (a tuple of slices), or None
+    if it cannot be hashed, e.g. if it holds index arrays.
+    """
+    roi = roi if isinstance(roi, tuple) else (roi,)
+    key = tuple((s.start, s.stop, s.step) if isinstance(s, slice) else s for s in roi)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class QSpaceReader(object):
+    """
+    Reader of the q-space file output by XSOCS, for repeated access to the q-space
+    intensity of single sample positions, e.g. when browsing a map.
+
+    The file is kept open, `Data/histo` and the q-space axes are read once, and
+    the most recently accessed volumes and projections are kept in memory, so that
+    going back to a position does not read the file again.
+
+    Parameters
+    ----------
+    path_qspace : str
+        Path to the q-space file, dense or sparse.
+    cache_size : int, optional
+        Number of volumes, and of sets of projections, kept in memory.
+
+    Attributes
+    ----------
+    shape : tuple
+        (n_positions, nx, ny, nz).
+    axes : tuple of str
+        The names of the q-space axes, see `get_qspace_axes`.
+    qx, qy, qz : numpy.ndarray
+        The q-space axes, i.e. pitch, roll and radial for a file gridded in
+        spherical coordinates.
+
+    Examples
+    --------
+    >>> with QSpaceReader("/path/to/qspace.h5") as reader:
+    ...     proj_x, proj_y, proj_z = reader.projections(100, bin_norm=True)
+    """
+
+    def __init__(self, path_qspace, cache_size=32):
+        self.path_qspace = path_qspace
+        self.cache_size = cache_size
+
+        self._h5f = None
+        self._histo = None
+        self._volumes = collections.OrderedDict()
+        self._projs = collections.OrderedDict()
+
+        h5f = self._get_file()
+        self.shape = get_qspace_shape(h5f)
+        self.axes = get_qspace_axes(h5f)
+        self.qx, self.qy, self.qz = [h5f[f"Data/{x}"][...] for x in self.axes]
+
+    def __getstate__(self):
+        # the file handle cannot be pickled, reopened when needed
+        state = self.__dict__.copy()
+        state.update(
+            _h5f=None,
+            _volumes=collections.OrderedDict(),
+            _projs=collections.OrderedDict(),
+        )
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def close(self):
+        """
+        Close the file and empty the caches.
+        """
+        if self._h5f is not None:
+            self._h5f.close()
+            self._h5f = None
+        self.clear_cache()
+
+    def clear_cache(self):
+        """
+        Forget the volumes and projections kept in memory.
+        """
+        self._volumes.clear()
+        self._projs.clear()
+
+    @property
+    def histo(self):
+        """
+        The number of detector pixels contributing to each q-space bin.
+        """
+        if self._histo is None:
+            self._histo = self._get_file()["Data/histo"][...]
+            self._histo.flags.writeable = False
+        return self._histo
+
+    def _get_file(self):
+        if self._h5f is None:
+            self._h5f = h5py.File(self.path_qspace, "r")
+        return self._h5f
+
+    def _cache(self, cache, key, value):
+        cache[key] = value
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def volume(self, idx):
+        """
+        Return the 3D q-space intensity at the (flattened) sample position `idx`.
+        The returned array is read-only, as it is shared with the cache.
+        """
+        idx = int(idx)
+        if idx in self._volumes:
+            self._volumes.move_to_end(idx)
+            return self._volumes[idx]
+
+        vol = get_qspace_position(self._get_file(), idx)
+        vol.flags.writeable = False
+
+        return self._cache(self._volumes, idx, vol)
+
+    def projections(self, idx, qspace_roi=None, bin_norm=False):
+        """
+        Return the projections of the q-space intensity at the (flattened) sample
+        position `idx` onto the qx, qy and qz axes, computed from a single read.
+
+        Parameters
+        ----------
+        idx : int
+            The (flattened) sample position.
+        qspace_roi : tuple of slice, optional
+            Slices of the 3D q-space array to project. Defaults to all of it.
+        bin_norm : bool, optional
+            Whether to normalise the projections by the number of detector pixels
+            contributing to each bin, i.e. by `Data/histo`.
+
+        Returns
+        -------
+        projections : tuple of numpy.ndarray
+            The projections onto qx, qy and qz.
+        """
+        if qspace_roi is None:
+            qspace_roi = np.s_[:, :, :]
+
+        roi_key = _get_roi_key(qspace_roi)
+        key = (int(idx), roi_key, bool(bin_norm))
+        if roi_key is not None and key in self._projs:
+            self._projs.move_to_end(key)
+            return self._projs[key]
+
+        histo = self.histo[qspace_roi] if bin_norm else None
+        projs = tuple(project(self.volume(idx)[qspace_roi], hits=histo))
+        for p in projs:
+            p.flags.writeable = False
+
+        if roi_key is None:
+            return projs
+        return self._cache(self._projs, key, projs)
 
 
 def get_qspace_avg(path_qspace, n_proc=None, mask_direct=None):
@@ -14,25 +248,318 @@ def get_qspace_avg(path_qspace, n_proc=None, mask_direct=None):
     The data file `path_qspace` is a q-space file produced by XSOCS.
     """
 
-    with h5py.File(path_qspace, "r") as h5f:
-        sh = h5f["Data/qspace"].shape[:1]
+    sh = get_qspace_shape(path_qspace)
+    sparse = is_qspace_sparse(path_qspace)
 
-    indexes = _get_chunk_indexes(path_qspace, "Data/qspace", n_proc)
+    path_in_h5 = "Data/qspace_sum" if sparse else "Data/qspace"
+    indexes = _get_chunk_indexes(path_qspace, path_in_h5, n_proc)
 
-    mask = mask_direct.flatten() if mask_direct is not None else np.ones(sh)
-    idx_mask = {idx: val for idx, val in zip(np.indices(sh)[0], mask.flatten())}
+    mask = mask_direct.flatten() if mask_direct is not None else np.ones(sh[:1])
+    idx_mask = {idx: val for idx, val in zip(np.indices(sh[:1])[0], mask.flatten())}
+
+    if sparse:
+        pfun = partial(_get_qspace_avg_chunk_sparse, path_qspace, idx_mask)
+    else:
+        pfun = partial(_get_qspace_avg_chunk, path_qspace, "Data/qspace", idx_mask)
 
     qspace_avg_list = []
     with mp.Pool(processes=n_proc) as p:
-        pfun = partial(_get_qspace_avg_chunk, path_qspace, "Data/qspace", idx_mask)
         for res in tqdm(p.imap(pfun, indexes), total=len(indexes)):
             qspace_avg_list.append(res)
 
     qspace_avg = np.stack(qspace_avg_list).sum(0)
+    if sparse:
+        qspace_avg = qspace_avg.reshape(sh[1:])
 
     return qspace_avg
 
 
+def _get_compression_kwargs(compression):
+    """
+    Return the `h5py.Group.create_dataset` keyword arguments for `compression`.
+    """
+    if compression is None:
+        return {}
+    elif compression == "bitshuffle":
+        return dict(**hdf5plugin.Bitshuffle(nelems=0, cname="lz4"))
+    elif compression == "gzip":
+        return dict(compression="gzip", compression_opts=4, shuffle=True)
+    elif compression == "lzf":
+        return dict(compression="lzf", shuffle=True)
+    else:
+        raise ValueError(
+            "compression must be one of 'bitshuffle', 'gzip', 'lzf' or None"
+        )
+
+
+def _get_qspace_chunks(chunks, shape, itemsize):
+    """
+    Resolve `chunks` (a tuple or one of the presets 'position' and 'slab') to a
+    chunk shape valid for a dataset of shape `shape`.
+    """
+    vol_size = int(np.prod(shape[1:]))
+
+    if chunks == "position":
+        chunks = (1, *shape[1:])
+    elif chunks == "slab":
+        # ~4 MB chunks made of whole q-space volumes
+        chunks = (max(1, int(4e6 // (vol_size * itemsize))), *shape[1:])
+    elif isinstance(chunks, str):
+        raise ValueError("chunks must be 'position', 'slab' or a tuple of 4 ints")
+
+    if len(chunks) != len(shape):
+        raise ValueError(f"chunks must have {len(shape)} dimensions")
+
+    return tuple(int(min(max(c, 1), s)) for c, s in zip(chunks, shape))
+
+
+def _copy_qspace_dset(
+    dset, h5f_out, chunks, compression, max_mem, n_positions=None, pbar=False
+):
+    """
+    Copy the first `n_positions` of the dense q-space dataset `dset` to
+    `h5f_out["Data/qspace"]`, reading and writing blocks of whole output chunks
+    along the position axis so that no more than ~`max_mem` bytes are held at once.
+    """
+    n_pos = dset.shape[0] if n_positions is None else min(n_positions, dset.shape[0])
+    shape = (n_pos, *dset.shape[1:])
+    chunks = _get_qspace_chunks(chunks, shape, dset.dtype.itemsize)
+
+    out = h5f_out.require_group("Data").create_dataset(
+        "qspace",
+        shape=shape,
+        dtype=dset.dtype,
+        chunks=chunks,
+        **_get_compression_kwargs(compression),
+    )
+    for k, v in dset.attrs.items():
+        out.attrs[k] = v
+
+    vol_size = np.prod(shape[1:]) * dset.dtype.itemsize
+    block = max(1, int(max_mem // vol_size) // chunks[0]) * chunks[0]
+
+    blocks = range(0, n_pos, block)
+    for i0 in tqdm(blocks, disable=not pbar):
+        i1 = min(i0 + block, n_pos)
+        out[i0:i1] = dset[i0:i1]
+
+    return out
+
+
+def rechunk_qspace(
+    path_qspace,
+    path_out,
+    chunks="position",
+    compression="bitshuffle",
+    max_mem=256e6,
+    overwrite=False,
+):
+    """
+    Write a copy of the q-space file `path_qspace` with `Data/qspace` stored with
+    a different chunk shape and compression. All other datasets, groups and
+    attributes are copied as they are.
+
+    The data is streamed through memory in blocks of whole output chunks along
+    the sample position axis, so arbitrarily large files can be rechunked.
+
+    Parameters
+    ----------
+    path_qspace : str
+        Path to the (dense) q-space file, e.g. as written by XSOCS.
+    path_out : str
+        Path to the rechunked copy.
+    chunks : str or tuple, optional
+        Chunk shape of the (n_positions, nx, ny, nz) `Data/qspace` dataset. Either a
+        tuple, 'position' for one chunk per sample position, best for
+        position-by-position access (`Inspect5DQspace`, `calc_coms_qspace3d`), or
+        'slab' for ~4 MB chunks of several whole positions, best for reading
+        large blocks of positions (`calc_roi_sum`, `get_qspace_avg`). Use
+        `benchmark_qspace_chunks` to pick one for a given workload.
+    compression : str or None, optional
+        One of 'bitshuffle' (bitshuffle-lz4, default), 'gzip', 'lzf' or None.
+    max_mem : float, optional
+        Approximate maximum number of bytes of q-space data held in memory.
+    overwrite : bool, optional
+        Whether to overwrite `path_out` if it exists.
+
+    Returns
+    -------
+    chunks : tuple
+        The chunk shape of `Data/qspace` in `path_out`.
+    """
+    if os.path.abspath(path_qspace) == os.path.abspath(path_out):
+        raise ValueError("path_out must differ from path_qspace")
+    if os.path.isfile(path_out) and not overwrite:
+        raise FileExistsError(f"{path_out} exists, set overwrite=True")
+    if is_qspace_sparse(path_qspace):
+        raise ValueError("Rechunking of sparse q-space files is not supported")
+
+    t0 = time.time()
+    with h5py.File(path_qspace, "r") as h5f, h5py.File(path_out, "w") as h5f_out:
+        for k, v in h5f.attrs.items():
+            h5f_out.attrs[k] = v
+
+        # copy everything but Data/qspace
+        for name, obj in h5f.items():
+            if name != "Data":
+                h5f.copy(obj, h5f_out, name)
+        data_out = h5f_out.create_group("Data")
+        for k, v in h5f["Data"].attrs.items():
+            data_out.attrs[k] = v
+        for name, obj in h5f["Data"].items():
+            if name != "qspace":
+                h5f.copy(obj, data_out, name)
+
+        dset = _copy_qspace_dset(
+            h5f["Data/qspace"], h5f_out, chunks, compression, max_mem, pbar=True
+        )
+        chunks = dset.chunks
+
+    print(
+        f"Rechunked {path_qspace} with chunks {chunks} in {(time.time() - t0) / 60:.2f}m"
+    )
+
+    return chunks
+
+
+def _time_qspace_reads(path_h5, pattern, n_reads, rng):
+    """
+    Return the median time (s) of `n_reads` reads of `Data/qspace` in `path_h5`
+    following the access `pattern`.
+    """
+    times = []
+    with h5py.File(path_h5, "r") as h5f:
+        dset = h5f["Data/qspace"]
+        n_pos = dset.shape[0]
+        n_slab = max(1, n_pos // 4)
+        roi = tuple(slice(s // 4, s - s // 4) for s in dset.shape[1:])
+
+        for _ in range(n_reads):
+            if pattern == "position":
+                sl = (rng.integers(n_pos), ...)
+            else:
+                i0 = rng.integers(n_pos - n_slab + 1)
+                sl = (slice(i0, i0 + n_slab), ...)
+                if pattern == "roi":
+                    sl = (sl[0], *roi)
+
+            t0 = time.perf_counter()
+            dset[sl]
+            times.append(time.perf_counter() - t0)
+
+    return float(np.median(times))
+
+
+def benchmark_qspace_chunks(
+    path_qspace,
+    workload="mixed",
+    chunk_candidates=None,
+    compression="bitshuffle",
+    n_positions=256,
+    n_reads=16,
+    tmp_dir=None,
+    seed=0,
+):
+    """
+    Benchmark chunk shapes of `Data/qspace` for a given access workload and
+    recommend one to pass to `rechunk_qspace`.
+
+    The first `n_positions` of `path_qspace` are written to a temporary file for
+    each candidate chunk shape, then read back following the access patterns of
+    the workload:
+
+    - 'position': one whole q-space volume at a random position, as read by
+      `Inspect5DQspace` and `calc_coms_qspace3d`;
+    - 'slab': a contiguous block of positions, whole volumes, as read by
+      `calc_roi_sum` and `get_qspace_avg`;
+    - 'roi': a contiguous block of positions, central q-space sub-volume, as read
+      by `calc_roi_sum` with a box-shaped reciprocal space mask.
+
+    Parameters
+    ----------
+    path_qspace : str
+        Path to the (dense) q-space file.
+    workload : str or dict, optional
+        One of 'position', 'slab', 'roi', 'mixed' (equal weights of 'position'
+        and 'slab') or a dict of {pattern: weight}.
+    chunk_candidates : list of tuple or str, optional
+        The chunk shapes to try. Defaults to a few shapes ranging from one
+        position per chunk to several tens.
+    compression : str or None, optional
+        The compression used for all candidates, see `rechunk_qspace`.
+    n_positions : int, optional
+        Number of sample positions written for each candidate.
+    n_reads : int, optional
+        Number of timed reads per access pattern and candidate.
+    tmp_dir : str, optional
+        Directory for the temporary files. Defaults to the system's.
+    seed : int, optional
+        Seed of the random positions read.
+
+    Returns
+    -------
+    chunks : tuple
+        The recommended chunk shape.
+    results : list of dict
+        For each candidate its 'chunks', 'size' on disk in bytes and the median
+        read time in seconds of each access pattern.
+
+    Notes
+    -----
+    Freshly written files are likely in the OS page cache, hence the timings
+    mostly reflect the decompression and chunk cache overheads rather than the
+    storage throughput.
+    """
+    if workload == "mixed":
+        workload = {"position": 1, "slab": 1}
+    elif isinstance(workload, str):
+        workload = {workload: 1}
+    if not set(workload).issubset({"position", "slab", "roi"}):
+        raise ValueError("workload patterns must be 'position', 'slab' or 'roi'")
+
+    with h5py.File(path_qspace, "r") as h5f:
+        shape = h5f["Data/qspace"].shape
+        itemsize = h5f["Data/qspace"].dtype.itemsize
+    shape = (min(n_positions, shape[0]), *shape[1:])
+
+    if chunk_candidates is None:
+        half = tuple(-(-s // 2) for s in shape[1:])
+        chunk_candidates = ["position", (4, *shape[1:]), "slab", (16, *half)]
+    candidates = []
+    for c in chunk_candidates:
+        c = _get_qspace_chunks(c, shape, itemsize)
+        if c not in candidates:
+            candidates.append(c)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        for i, chunks in enumerate(candidates):
+            path_tmp = f"{tmp}/qspace_{i}.h5"
+            with h5py.File(path_qspace, "r") as h5f, h5py.File(path_tmp, "w") as h5o:
+                _copy_qspace_dset(
+                    h5f["Data/qspace"], h5o, chunks, compression, 256e6, shape[0]
+                )
+
+            res = dict(chunks=chunks, size=os.path.getsize(path_tmp))
+            rng = np.random.default_rng(seed)
+            for pattern in workload:
+                res[pattern] = _time_qspace_reads(path_tmp, pattern, n_reads, rng)
+            results.append(res)
+
+    # score each candidate by its weighted slowdown relative to the best one
+    best = {p: min(r[p] for r in results) for p in workload}
+    for r in results:
+        r["score"] = sum(w * r[p] / best[p] for p, w in workload.items())
+    chunks = min(results, key=lambda r: r["score"])["chunks"]
+
+    for r in results:
+        timings = ", ".join(f"{p}: {r[p] * 1e3:.1f}ms" for p in workload)
+        print(f"{str(r['chunks']):>24} {r['size'] / 1e6:8.1f}MB {timings}")
+    print(f"Recommended chunks: {chunks}")
+
+    return chunks, results
+
+
 @ioh5
 def get_piezo_motorpos(h5f):
     """
@@ -1,4 +1,5 @@
-from . import colors, utils
+from . import animation, colors, utils
+from .animation import AnimationWriter, get_shared_clims
 from .utils import (
     add_hsv_colorbar,
     add_colorbar,
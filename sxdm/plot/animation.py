@@ -0,0 +1,317 @@
+"""
+Streaming writers of animations of SXDM maps and detector frames.
+"""
+
+import io
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+
+import numpy as np
+import matplotlib as mpl
+
+from PIL import Image, GifImagePlugin
+
+_FORMATS = {".gif": "gif", ".png": "apng", ".apng": "apng", ".mp4": "mp4"}
+
+
+def get_shared_clims(arrays, clims=(None, None), log=False):
+    """
+    Return colour limits shared by all the `arrays`, computed in a single pass
+    over them, e.g. to give all the frames of an animation the same colour scale.
+
+    Parameters
+    ----------
+    arrays : iterable of numpy.ndarray
+        The data of each frame, e.g. a generator reading them one at a time.
+    clims : list, optional
+        Colour limits, only the None ones are computed. Defaults to [None, None].
+    log : bool, optional
+        If True, only the positive values are considered, for a logarithmic
+        colour scale.
+
+    Returns
+    -------
+    clims : list
+        The [min, max] colour limits.
+    """
+    vmin, vmax = np.inf, -np.inf
+    if None in clims:
+        for arr in arrays:
+            arr = np.ma.compressed(np.ma.masked_invalid(arr))
+            if log:
+                arr = arr[arr > 0]
+            if arr.size > 0:
+                vmin, vmax = min(vmin, arr.min()), max(vmax, arr.max())
+
+    vmin, vmax = [None if np.isinf(v) else float(v) for v in (vmin, vmax)]
+
+    return [
+        vmin if clims[0] is None else clims[0],
+        vmax if clims[1] is None else clims[1],
+    ]
+
+
+def _to_rgb(frame):
+    """
+    Return `frame`, a PIL image or an (rows, columns, 3 or 4) uint8 array, as an
+    RGB PIL image.
+    """
+    if isinstance(frame, np.ndarray):
+        frame = Image.fromarray(frame)
+    return frame.convert("RGB")
+
+
+def _png_chunk(chunk_type, data):
+    return (
+        struct.pack(">I", len(data))
+        + chunk_type
+        + data
+        + struct.pack(">I", zlib.crc32(chunk_type + data))
+    )
+
+
+def _read_png_chunks(png):
+    """
+    Yield the (type, data) chunks of the PNG file `png` (bytes).
+    """
+    pos = 8
+    while pos < len(png):
+        (length,) = struct.unpack(">I", png[pos : pos + 4])
+        yield png[pos + 4 : pos + 8], png[pos + 8 : pos + 8 + length]
+        pos += length + 12
+
+
+class AnimationWriter(object):
+    """
+    Writer of animations encoding the frames as they are appended, so that only a
+    small window of frames is ever held in memory.
+
+    The format follows the extension of `path`:
+
+    - '.gif': GIF with a palette of 255 colours optimised for the first `window`
+      frames and shared by all of them; only the pixels differing from the
+      previous frame are stored.
+    - '.png' or '.apng': animated PNG, lossless.
+    - '.mp4': H.264 / MPEG-4 video, encoded by the ffmpeg executable set in
+      ``matplotlib.rcParams["animation.ffmpeg_path"]``, which must be available.
+
+    All the frames must have the size of the first one.
+
+    Parameters
+    ----------
+    path : str
+        Path to the output file.
+    duration : float, optional
+        Duration of each frame in milliseconds. Defaults to 500.
+    loop : int, optional
+        Number of times GIF and APNG animations are played, 0 for forever.
+    window : int, optional
+        Number of frames buffered to optimise the GIF palette.
+
+    Examples
+    --------
+    >>> with AnimationWriter("maps.gif", duration=200) as writer:
+    ...     for frame in frames:  # PIL images or uint8 RGB(A) arrays
+    ...         writer.append(frame)
+    """
+
+    def __init__(self, path, duration=500, loop=0, window=8):
+        ext = os.path.splitext(path)[1].lower()
+        if ext not in _FORMATS:
+            raise ValueError(f"path must end with one of {list(_FORMATS)}")
+
+        self.path = path
+        self.fmt = _FORMATS[ext]
+        self.duration = duration
+        self.loop = loop
+        self.window = window
+        self.n_frames = 0
+
+        self._size = None
+        self._buffer = []  # GIF frames waiting for the palette
+        self._palette = None
+        self._prev = None
+        self._seq = 0
+        self._actl_pos = None
+        self._proc = None
+
+        if self.fmt == "mp4":
+            ffmpeg = shutil.which(mpl.rcParams["animation.ffmpeg_path"])
+            if ffmpeg is None:
+                raise RuntimeError(
+                    "No ffmpeg executable found, install it or set "
+                    "matplotlib.rcParams['animation.ffmpeg_path'], or use .gif / .png"
+                )
+            self._ffmpeg = ffmpeg
+        else:
+            self._f = open(path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def append(self, frame):
+        """
+        Encode `frame`, a PIL image or an (rows, columns, 3 or 4) uint8 array.
+        """
+        frame = _to_rgb(frame)
+        if self._size is None:
+            self._size = frame.size
+        elif frame.size != self._size:
+            raise ValueError(
+                f"Frame of size {frame.size} differs from the first one {self._size}"
+            )
+
+        if self.fmt == "gif":
+            self._buffer.append(frame)
+            if self._palette is not None or len(self._buffer) >= self.window:
+                self._flush_gif()
+        elif self.fmt == "apng":
+            self._write_apng(frame)
+        else:
+            self._write_mp4(frame)
+
+        self.n_frames += 1
+
+    def close(self):
+        """
+        Encode the frames left and finalise the file.
+        """
+        if self.fmt == "gif":
+            if len(self._buffer) > 0:
+                self._flush_gif()
+            if not self._f.closed:
+                self._f.write(b";")
+                self._f.close()
+        elif self.fmt == "apng":
+            if not self._f.closed:
+                self._f.write(_png_chunk(b"IEND", b""))
+                if self._actl_pos is not None:
+                    # now that the number of frames is known
+                    self._f.seek(self._actl_pos)
+                    actl = struct.pack(">II", self.n_frames, self.loop)
+                    self._f.write(_png_chunk(b"acTL", actl))
+                self._f.close()
+        elif self._proc is not None:
+            self._proc.stdin.close()
+            if self._proc.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to write {self.path}")
+            self._proc = None
+
+    def _flush_gif(self):
+        """
+        Write the buffered GIF frames, computing the palette first if needed.
+        """
+        if self._palette is None:
+            self._init_gif()
+
+        for frame in self._buffer:
+            idx = np.array(frame.quantize(palette=self._palette, dither=0))
+            idx[idx >= self._n_colors] = 0  # padding of the palette, same colour
+            idx += 1  # 0 is the transparent index
+
+            # only keep the bounding box of the pixels that changed
+            box = (0, 0, *self._size)
+            if self._prev is not None:
+                changed = idx != self._prev
+                rows, cols = np.any(changed, axis=1), np.any(changed, axis=0)
+                if changed.any():
+                    r0, r1 = np.where(rows)[0][[0, -1]]
+                    c0, c1 = np.where(cols)[0][[0, -1]]
+                    box = (c0, r0, c1 + 1, r1 + 1)
+                else:
+                    box = (0, 0, 1, 1)
+                idx_out = np.where(changed, idx, 0).astype("u1")
+            else:
+                idx_out = idx
+            self._prev = idx
+
+            idx_out = idx_out[box[1] : box[3], box[0] : box[2]]
+            im = Image.frombytes("P", idx_out.shape[::-1], idx_out.tobytes())
+            im.putpalette(self._gif_palette)
+            data = GifImagePlugin.getdata(
+                im, offset=box[:2], duration=self.duration, transparency=0, disposal=1
+            )
+            self._f.write(b"".join(data))
+
+        self._buffer = []
+
+    def _init_gif(self):
+        """
+        Compute the palette shared by all the frames from the buffered ones and
+        write the GIF header.
+        """
+        stack = np.vstack([np.asarray(f) for f in self._buffer])
+        quant = Image.fromarray(stack).quantize(colors=255, dither=0)
+        colors = np.array(quant.getpalette(), dtype="u1").reshape(-1, 3)[:255]
+        self._n_colors = len(colors)
+
+        # pad with the first colour, so that padding indexes can be mapped to 0
+        padded = np.concatenate([colors, np.repeat(colors[:1], 256 - len(colors), 0)])
+        self._palette = Image.new("P", (1, 1))
+        self._palette.putpalette(padded.ravel().tolist())
+
+        gif_palette = np.zeros((256, 3), dtype="u1")
+        gif_palette[0] = (255, 0, 255)  # transparent
+        gif_palette[1 : len(colors) + 1] = colors
+        self._gif_palette = gif_palette.ravel().tolist()
+
+        width, height = self._size
+        self._f.write(
+            b"GIF89a"
+            + struct.pack("<HHBBB", width, height, 0xF7, 0, 0)
+            + gif_palette.tobytes()
+            + b"!\xff\x0bNETSCAPE2.0\x03\x01"
+            + struct.pack("<H", self.loop)
+            + b"\x00"
+        )
+
+    def _write_apng(self, frame):
+        """
+        Write `frame` as the next APNG frame, taking its compressed data from a
+        PNG encoding of it.
+        """
+        buffer = io.BytesIO()
+        frame.save(buffer, format="png")
+        chunks = list(_read_png_chunks(buffer.getvalue()))
+        data = b"".join(d for t, d in chunks if t == b"IDAT")
+
+        if self.n_frames == 0:
+            self._f.write(b"\x89PNG\r\n\x1a\n")
+            self._f.write(_png_chunk(b"IHDR", dict(chunks)[b"IHDR"]))
+            self._actl_pos = self._f.tell()
+            self._f.write(_png_chunk(b"acTL", struct.pack(">II", 0, self.loop)))
+
+        width, height = self._size
+        fctl = struct.pack(
+            ">IIIIIHHBB", self._seq, width, height, 0, 0, int(self.duration), 1000, 0, 0
+        )
+        self._f.write(_png_chunk(b"fcTL", fctl))
+        self._seq += 1
+
+        if self.n_frames == 0:
+            self._f.write(_png_chunk(b"IDAT", data))
+        else:
+            self._f.write(_png_chunk(b"fdAT", struct.pack(">I", self._seq) + data))
+            self._seq += 1
+
+    def _write_mp4(self, frame):
+        """
+        Pipe `frame` to the ffmpeg process, started at the first frame.
+        """
+        if self._proc is None:
+            width, height = self._size
+            cmd = [self._ffmpeg, "-y", "-loglevel", "error"]
+            cmd += ["-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}"]
+            cmd += ["-framerate", f"{1000 / self.duration}", "-i", "-"]
+            # yuv420p (readable by most players) needs even dimensions
+            cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"]
+            cmd += [self.path]
+            self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+        self._proc.stdin.write(frame.tobytes())
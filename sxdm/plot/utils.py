@@ -6,27 +6,36 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.font_manager as fm
 import matplotlib as mpl
-import gif
+import io
 import os
+import h5py
+import multiprocessing as mp
+import collections
 
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.axes_grid1.anchored_artists import AnchoredSizeBar
 from matplotlib.patches import FancyArrowPatch, Rectangle, ArrowStyle
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
 
 from tqdm.notebook import tqdm
 
+from .animation import AnimationWriter, get_shared_clims, _FORMATS
+
 from ..io.bliss import (
     get_piezo_motor_names,
     get_roidata,
-    get_sxdm_frame_sum,
     get_detector_aliases,
-    get_sxdm_pos_sum,
+    get_sxdm_sums_multi,
     get_counter,
     get_positioner,
     get_sxdm_scan_numbers,
-    get_scan_shape,
 )
 
+# extension of the files written by the animation generators, for each format
+_ANIMATION_EXTS = {"gif": ".gif", "apng": ".png", "mp4": ".mp4"}
+
 
 def add_hsv_colorbar(
     tiltmag,
@@ -393,6 +402,119 @@ def add_directions(
         ax.add_artist(abox)
 
 
+def _read_gif_scans(path_dset, scan_nos, counter, moving_motor):
+    """
+    Return, for each scan of `scan_nos`, the names of the piezo motors, the extent
+    of the map, the map of `counter` (None if missing) and the position of
+    `moving_motor` (None if not a str), opening `path_dset` only once.
+    """
+    scans = []
+    with h5py.File(path_dset, "r") as h5f:
+        for scan_no in scan_nos:
+            m0name, m1name = get_piezo_motor_names(h5f, scan_no)
+            try:
+                m0, m1 = [get_counter(h5f, scan_no, m) for m in (m0name, m1name)]
+            except KeyError:  # handle old version of BLISS datasets
+                m0, m1 = [
+                    get_counter(h5f, scan_no, f"{m}_position") for m in (m0name, m1name)
+                ]
+
+            try:
+                dint = get_roidata(h5f, scan_no, counter)
+            except KeyError:
+                dint = None
+
+            if isinstance(moving_motor, str):
+                moving_mot = get_positioner(h5f, scan_no, moving_motor)
+            else:
+                moving_mot = None
+
+            scans.append(
+                dict(
+                    scan_no=scan_no,
+                    motor_names=(m0name, m1name),
+                    extent=[m0.min(), m0.max(), m1.min(), m1.max()],
+                    dint=dint,
+                    moving_mot=moving_mot,
+                )
+            )
+
+    return scans
+
+
+def _fig_to_png(fig):
+    """
+    Return the figure `fig`, drawn by the Agg backend, as PNG bytes.
+    """
+    FigureCanvasAgg(fig)
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+
+    return buffer.getvalue()
+
+
+def _write_animation(render, frame_args, path, duration, n_proc=None):
+    """
+    Render `render(args)` for each of `frame_args` in a pool of `n_proc` processes
+    and write the frames, in order, to the animation `path` as they come, holding
+    no more than two frames per process in memory.
+    """
+    n_proc = os.cpu_count() if n_proc is None else n_proc
+
+    pending = collections.deque()
+    with mp.Pool(processes=n_proc) as p, AnimationWriter(path, duration) as writer:
+        for args in tqdm(frame_args):
+            pending.append(p.apply_async(render, (args,)))
+            if len(pending) >= 2 * n_proc:
+                writer.append(Image.open(io.BytesIO(pending.popleft().get())))
+        while pending:
+            writer.append(Image.open(io.BytesIO(pending.popleft().get())))
+
+
+def _render_gif_sxdm_sums_frame(args):
+    """
+    Render a frame of `gif_sxdm_sums` as PNG bytes.
+    """
+    scan, fint, path_dset, moving_motor, clim_sample, clim_detector = args
+    m0name, m1name = scan["motor_names"]
+
+    fig = Figure(figsize=(6, 3), layout="tight", dpi=120)
+    ax = fig.subplots(1, 2)
+
+    _ = ax[0].imshow(
+        scan["dint"],
+        cmap="viridis",
+        extent=scan["extent"],
+        norm=mpl.colors.LogNorm(*clim_sample),
+        origin="lower",
+    )
+    _ = ax[1].imshow(
+        fint,
+        norm=mpl.colors.LogNorm(*clim_detector),
+        origin="upper",
+        cmap="inferno",
+    )
+
+    for a in ax:
+        _ = add_colorbar(a, a.get_images()[0])
+
+    ax[0].set_title("Sum over (detx, dety)")
+    ax[0].set_xlabel(f"{m0name} (um)")
+    ax[0].set_ylabel(f"{m1name} (um)")
+
+    ax[1].set_title(f"Sum over ({m0name}, {m1name})")
+    ax[1].set_xlabel("detx (pix)")
+    ax[1].set_ylabel("dety (pix)")
+
+    title = f"{os.path.basename(path_dset)} #{scan['scan_no']}"
+    title += f"@ {moving_motor}$={scan['moving_mot']:.3f}$"
+
+    fig.subplots_adjust(hspace=-0.5)
+    fig.suptitle(title, y=0.94)
+
+    return _fig_to_png(fig)
+
+
 def gif_sxdm_sums(
     path_dset,
     path_out=None,
@@ -402,11 +524,17 @@ def gif_sxdm_sums(
     clim_sample=[None, None],
     clim_detector=[None, None],
     detector=None,
+    n_proc=None,
+    shared_clims=True,
+    fmt="gif",
 ):
     """
     Generate a GIF for a series of SXDM scans showing data integrated in direct (sample)
     and reciprocal (detector) space.
 
+    The frame sums of all the scans are computed in a single pass over their
+    frames and the GIF frames are rendered in parallel and written as they come.
+
     Parameters
     ----------
     path_dset : str
@@ -426,12 +554,27 @@ def gif_sxdm_sums(
         Color limit range for the detector plot. Defaults to [None, None].
     detector : str or None, optional
         Detector alias. If None, the first detector found is used. Defaults to None.
+    n_proc : int or None, optional
+        Number of processes reading the data and rendering the frames. Defaults to
+        the number of CPUs.
+    shared_clims : bool, optional
+        If True, the None limits of `clim_sample` and `clim_detector` are those of
+        all the scans, so that all frames share the same colour scales. Otherwise
+        each frame is scaled to its own data. Defaults to True.
+    fmt : str, optional
+        Format of the animation, 'gif', 'apng' or 'mp4' (if ffmpeg is installed),
+        see `sxdm.plot.animation.AnimationWriter`. Defaults to 'gif'.
 
     Returns
     -------
     None
     """
 
+    if fmt not in _ANIMATION_EXTS:
+        raise ValueError(
+            f"Unknown format: {fmt}. Should be one of {list(_ANIMATION_EXTS)}."
+        )
+
     if path_out is None:
         path_out = os.path.abspath(".")
 
@@ -443,70 +586,65 @@ def gif_sxdm_sums(
     else:
         det = detector
 
-    @gif.frame
-    def plot_sxdm_sums(scan_no):
-        fint = get_sxdm_frame_sum(path_dset, scan_no, detector=det, pbar=False)
-        try:
-            dint = get_roidata(path_dset, scan_no, f"{det}_int")
-        except KeyError:
-            dint = get_sxdm_pos_sum(path_dset, scan_no, detector=det, pbar=False)
-            map_shape = get_scan_shape(path_dset, scan_no)
-            dint = dint.reshape(map_shape)
-
-        fig, ax = plt.subplots(1, 2, figsize=(6, 3), layout="tight", dpi=120)
-
-        m0name, m1name = get_piezo_motor_names(path_dset, scan_no)
-        try:
-            m0, m1 = [
-                get_counter(path_dset, scan_no, f"{m}_position")
-                for m in (m0name, m1name)
-            ]
-        except KeyError:
-            m0, m1 = [get_counter(path_dset, scan_no, f"{m}") for m in (m0name, m1name)]
-        pi_ext = [m0.min(), m0.max(), m1.min(), m1.max()]
-
-        _ = ax[0].imshow(
-            dint,
-            cmap="viridis",
-            extent=pi_ext,
-            norm=mpl.colors.LogNorm(*clim_sample),
-            origin="lower",
-        )
-        _ = ax[1].imshow(
-            fint,
-            norm=mpl.colors.LogNorm(*clim_detector),
-            origin="upper",
-            cmap="inferno",
-        )
+    scans = _read_gif_scans(path_dset, scan_nos, f"{det}_int", moving_motor)
+    fints, dints = get_sxdm_sums_multi(
+        path_dset, scan_nos, detector=det, n_proc=n_proc, pbar=False
+    )
+    for scan, dint in zip(scans, dints):
+        if scan["dint"] is None:
+            scan["dint"] = dint
 
-        for a in ax:
-            _ = add_colorbar(a, a.get_images()[0])
+    if shared_clims:
+        clim_sample = get_shared_clims((s["dint"] for s in scans), clim_sample, True)
+        clim_detector = get_shared_clims(fints, clim_detector, log=True)
 
-        ax[0].set_title("Sum over (detx, dety)")
-        ax[0].set_xlabel(f"{m0name} (um)")
-        ax[0].set_ylabel(f"{m1name} (um)")
+    frame_args = [
+        (scan, fint, path_dset, moving_motor, clim_sample, clim_detector)
+        for scan, fint in zip(scans, fints)
+    ]
+    _write_animation(
+        _render_gif_sxdm_sums_frame,
+        frame_args,
+        f"{path_out}/macro_{os.path.basename(path_dset)}_framesums"
+        f"{_ANIMATION_EXTS[fmt]}",
+        time_between_frames,
+        n_proc,
+    )
 
-        ax[1].set_title(f"Sum over ({m0name}, {m1name})")
-        ax[1].set_xlabel("detx (pix)")
-        ax[1].set_ylabel("dety (pix)")
 
-        moving_mot = get_positioner(path_dset, scan_no, moving_motor)
-        title = f"{os.path.basename(path_dset)} #{scan_no}"
-        title += f"@ {moving_motor}$={moving_mot:.3f}$"
+def _render_gif_sxdm_frame(args):
+    """
+    Render a frame of `gif_sxdm` as PNG bytes.
+    """
+    scan, path_dset, detector_roi, moving_motor, norm, clims, fig_kwargs, cmap = args
+    m0name, m1name = scan["motor_names"]
 
-        fig.subplots_adjust(hspace=-0.5)
-        fig.suptitle(title, y=0.94)
+    fig = Figure(**(fig_kwargs or {}))
+    ax = fig.subplots(1, 1)
 
-    frames = []
-    for s in tqdm(scan_nos):
-        frames.append(plot_sxdm_sums(s))
+    if norm == "lin":
+        norm_mpl = mpl.colors.Normalize(*clims)
+    elif norm == "log":
+        norm_mpl = mpl.colors.LogNorm(*clims)
 
-    gif.save(
-        frames,
-        f"{path_out}/macro_{os.path.basename(path_dset)}_framesums.gif",
-        duration=time_between_frames,
+    im = ax.imshow(
+        scan["dint"], cmap=cmap, extent=scan["extent"], norm=norm_mpl, origin="lower"
     )
 
+    _ = add_colorbar(ax, im)
+
+    ax.set_title("Sum over (detx, dety)")
+    ax.set_xlabel(f"{m0name} (um)")
+    ax.set_ylabel(f"{m1name} (um)")
+
+    title = f"{os.path.basename(path_dset)} #{scan['scan_no']} | {detector_roi}"
+    if isinstance(moving_motor, str):
+        title += f"@ {moving_motor}$={scan['moving_mot']:.3f}$"
+
+    ax.set_title(title)
+
+    return _fig_to_png(fig)
+
 
 def gif_sxdm(
     path_dset,
@@ -520,10 +658,16 @@ def gif_sxdm(
     detector=None,
     fig_kwargs=None,
     cmap="viridis",
+    n_proc=None,
+    shared_clims=True,
+    fmt=None,
 ):
     """
     Generate a GIF from a series of SXDM scans plotting a selected detector ROI counter.
 
+    The counters and motor positions of all the scans are read at once and the GIF
+    frames are rendered in parallel and written as they come.
+
     Parameters
     ----------
     path_dset : str
@@ -553,13 +697,38 @@ def gif_sxdm(
     cmap : str, optional
         Matplotlib colormap name to use for the plot. Defaults to 'viridis'.
     outfile : str, optional
-        Full path for the output GIF file. If None, saves in current directory with
-        auto-generated name based on dataset and ROI. Defaults to None.
+        Full path for the output file, with the extension of `fmt`. If None, saves
+        in current directory with auto-generated name based on dataset and ROI.
+        Defaults to None.
+    n_proc : int or None, optional
+        Number of processes reading the data and rendering the frames. Defaults to
+        the number of CPUs.
+    shared_clims : bool, optional
+        If True, the None limits of `clims` are those of all the scans, so that all
+        frames share the same colour scale. Otherwise each frame is scaled to its
+        own data. Defaults to True.
+    fmt : str, optional
+        Format of the animation, 'gif', 'apng' or 'mp4' (if ffmpeg is installed),
+        see `sxdm.plot.animation.AnimationWriter`. Defaults to that of the
+        extension of `outfile`, or 'gif'.
 
     Returns
     -------
     None
     """
+    if outfile is not None:
+        fmt_ext = _FORMATS.get(os.path.splitext(outfile)[1].lower())
+        if fmt is None:
+            fmt = fmt_ext
+        elif fmt != fmt_ext:
+            raise ValueError(f"The extension of {outfile} does not match fmt={fmt}.")
+    if fmt is None:
+        fmt = "gif"
+    if fmt not in _ANIMATION_EXTS:
+        raise ValueError(
+            f"Unknown format: {fmt}. Should be one of {list(_ANIMATION_EXTS)}."
+        )
+
     if scan_nos is None:
         scan_nos = get_sxdm_scan_numbers(path_dset)
 
@@ -568,59 +737,41 @@ def gif_sxdm(
     else:
         det = detector
 
-    @gif.frame
-    def plot_sxdm_sums(scan_no):
-        if detector_roi is None:
-            try:
-                dint = get_roidata(path_dset, scan_no, f"{det}_int")
-            except KeyError:
-                map_sh = get_scan_shape(path_dset, scan_no)
-                dint = get_sxdm_pos_sum(path_dset, scan_no, detector=det, pbar=False)
-                dint = dint.reshape(map_sh)
-        else:
-            dint = get_roidata(path_dset, scan_no, detector_roi)
-
-        fig, ax = plt.subplots(1, 1, **(fig_kwargs or {}))
-
-        m0name, m1name = get_piezo_motor_names(path_dset, scan_no)
-        try:
-            m0, m1 = [get_counter(path_dset, scan_no, f"{m}") for m in (m0name, m1name)]
-        except KeyError:  # handle old version of BLISS datasets
-            m0, m1 = [
-                get_counter(path_dset, scan_no, f"{m}_position")
-                for m in (m0name, m1name)
-            ]
-        pi_ext = [m0.min(), m0.max(), m1.min(), m1.max()]
-
-        if norm == "lin":
-            norm_mpl = mpl.colors.Normalize(*clims)
-        elif norm == "log":
-            norm_mpl = mpl.colors.LogNorm(*clims)
-        else:
-            raise ValueError(
-                f"Unknown normalisation type: {norm}. Should be one of ['lin', 'log']."
-            )
-
-        im = ax.imshow(dint, cmap=cmap, extent=pi_ext, norm=norm_mpl, origin="lower")
-
-        _ = add_colorbar(ax, im)
-
-        ax.set_title("Sum over (detx, dety)")
-        ax.set_xlabel(f"{m0name} (um)")
-        ax.set_ylabel(f"{m1name} (um)")
+    if norm not in ("lin", "log"):
+        raise ValueError(
+            f"Unknown normalisation type: {norm}. Should be one of ['lin', 'log']."
+        )
 
-        title = f"{os.path.basename(path_dset)} #{scan_no} | {detector_roi}"
-        if isinstance(moving_motor, str):
-            moving_mot = get_positioner(path_dset, scan_no, moving_motor)
-            title += f"@ {moving_motor}$={moving_mot:.3f}$"
+    counter = f"{det}_int" if detector_roi is None else detector_roi
+    scans = _read_gif_scans(path_dset, scan_nos, counter, moving_motor)
+
+    missing = [scan for scan in scans if scan["dint"] is None]
+    if detector_roi is not None and len(missing) > 0:
+        raise KeyError(f"No {detector_roi} counter in scan {missing[0]['scan_no']}")
+    elif len(missing) > 0:
+        _, dints = get_sxdm_sums_multi(
+            path_dset,
+            [scan["scan_no"] for scan in missing],
+            detector=det,
+            n_proc=n_proc,
+            pbar=False,
+        )
+        for scan, dint in zip(missing, dints):
+            scan["dint"] = dint
 
-        ax.set_title(title)
+    if shared_clims:
+        clims = get_shared_clims((s["dint"] for s in scans), clims, norm == "log")
 
-    frames = []
-    for s in tqdm(scan_nos):
-        frames.append(plot_sxdm_sums(s))
+    frame_args = [
+        (scan, path_dset, detector_roi, moving_motor, norm, clims, fig_kwargs, cmap)
+        for scan in scans
+    ]
 
     if outfile is None:
-        outfile = f"macro_{os.path.basename(path_dset)}_{detector_roi}.gif"
+        outfile = (
+            f"macro_{os.path.basename(path_dset)}_{detector_roi}{_ANIMATION_EXTS[fmt]}"
+        )
 
-    gif.save(frames, outfile, duration=time_between_frames)
+    _write_animation(
+        _render_gif_sxdm_frame, frame_args, outfile, time_between_frames, n_proc
+    )
@@ -1 +1 @@
-from . import math, xsocs
+from . import math, xsocs, qspace
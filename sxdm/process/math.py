@@ -10,15 +10,22 @@ from silx.math import fit
 from silx.math.fit import fittheories
 from numpy.linalg import LinAlgError
 
-from ..io.utils import _get_chunk_indexes
-from ..io.bliss import get_detector_aliases
+from ..io.utils import (
+    _get_chunk_indexes,
+    _get_row_chunk_indexes,
+    _read_qspace_sparse,
+    _bin_pixels,
+    _iter_binned_frames,
+)
+from ..io.bliss import get_detector_aliases, get_scan_shape
+from ..io.xsocs import is_qspace_sparse, get_qspace_shape, get_qspace_position
 
 _per_process_cache = None
 
 
 def _gauss_fit_point(path_qspace, roi_slice, rec_axis, qcoords, dir_mask, dir_idx):
     with h5py.File(path_qspace, "r") as h5f:
-        local_diffr = h5f["Data/qspace"][dir_idx][roi_slice]
+        local_diffr = get_qspace_position(h5f, dir_idx)[roi_slice]
 
     # load profile
     x, y = qcoords[rec_axis], project(local_diffr)[rec_axis]
@@ -48,7 +55,7 @@ def _gauss_fit_point(path_qspace, roi_slice, rec_axis, qcoords, dir_mask, dir_id
 
 def _gauss_fit_multi_point(path_qspace, roi_slice, rec_axis, qcoords, mask, dir_idx):
     with h5py.File(path_qspace, "r") as h5f:
-        local_diffr = h5f["Data/qspace"][dir_idx][roi_slice]
+        local_diffr = get_qspace_position(h5f, dir_idx)[roi_slice]
 
     # load profile
     x, y = qcoords[rec_axis], project(local_diffr)[rec_axis]
@@ -74,7 +81,7 @@ def _gauss_fit_multi_point(path_qspace, roi_slice, rec_axis, qcoords, mask, dir_
 
 def gauss_fit(path_qspace, rec_mask, dir_mask=None, multi=False):
     with h5py.File(path_qspace, "r") as h5f:
-        dir_idxs = range(h5f["Data/qspace"].shape[0])
+        dir_idxs = range(get_qspace_shape(h5f)[0])
         qx, qy, qz = [h5f[f"Data/{x}"][...] for x in "qx,qy,qz".split(",")]
 
     roi_slice = tuple([slice(x.min(), x.max() + 1) for x in np.where(~rec_mask)])
@@ -325,6 +332,59 @@ def _calc_com_qspace3d(
         return cx, cy, cz
 
 
+def _calc_coms_qspace3d_sparse_chunk(
+    path_qspace, mask_reciprocal, n_pix, std, spherical, idx_range
+):
+    """
+    Sparse counterpart of `_calc_com_qspace3d`: compute the q-space COM (and
+    standard deviation if `std` is True) of each of the (flattened) sample
+    positions in `idx_range`, using only the voxels stored in the q-space file.
+
+    Returns a (n_positions, 3) or (n_positions, 6) array.
+    """
+    axes = "pitch,roll,radial" if spherical else "qx,qy,qz"
+    with h5py.File(path_qspace, "r") as h5f:
+        counts, indices, values = _read_qspace_sparse(h5f, idx_range)
+        qcoords = [h5f[f"Data/{x}"][...] for x in axes.split(",")]
+
+    n_pos = counts.size
+    pos = np.repeat(np.arange(n_pos), counts)
+
+    keep = np.invert(mask_reciprocal.ravel()[indices])
+    pos, indices, values = pos[keep], indices[keep], values[keep].astype("float64")
+
+    # only keep the n_pix most intense voxels of each position
+    if n_pix is not None:
+        order = np.lexsort((-values, pos))
+        pos, indices, values = pos[order], indices[order], values[order]
+        rank = np.arange(pos.size) - np.searchsorted(pos, pos)
+        keep = rank < n_pix
+        pos, indices, values = pos[keep], indices[keep], values[keep]
+
+    qs = [
+        q[i] for q, i in zip(qcoords, np.unravel_index(indices, mask_reciprocal.shape))
+    ]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total = np.bincount(pos, weights=values, minlength=n_pos)
+        coms = [
+            np.bincount(pos, weights=values * q, minlength=n_pos) / total for q in qs
+        ]
+        out = coms
+        if std is True:
+            out = out + [
+                np.sqrt(
+                    np.bincount(
+                        pos, weights=values * (q - c[pos]) ** 2, minlength=n_pos
+                    )
+                    / total
+                )
+                for q, c in zip(qs, coms)
+            ]
+
+    return np.stack(out, axis=1)
+
+
 def calc_coms_qspace3d(
     path_qspace, mask_reciprocal, n_pix=None, std=False, spherical=False
 ):
@@ -355,8 +415,23 @@ def calc_coms_qspace3d(
     if type(mask_reciprocal) is not np.ndarray or len(mask_reciprocal.shape) < 3:
         raise TypeError("mask_reciprocal has to be a 3D numpy array")
 
-    with h5py.File(path_qspace, "r") as h5f:
-        map_shape_flat = h5f["Data/qspace"].shape[0]
+    map_shape_flat = get_qspace_shape(path_qspace)[0]
+
+    # sparse q-space file, one task per chunk of positions
+    if is_qspace_sparse(path_qspace):
+        idxs_list = _get_chunk_indexes(path_qspace, "Data/qspace_sum")
+        pfun = functools.partial(
+            _calc_coms_qspace3d_sparse_chunk,
+            path_qspace,
+            mask_reciprocal.astype("bool"),
+            n_pix,
+            std,
+            spherical,
+        )
+        with mp.Pool(processes=os.cpu_count()) as p:
+            coms = list(tqdm(p.imap(pfun, idxs_list), total=len(idxs_list)))
+
+        return tuple(np.concatenate(coms).T)
 
     if std is True:
         coms = []
@@ -431,6 +506,22 @@ def _calc_roi_sum_chunk(path_qspace, mask_reciprocal, mask_direct, idx_range):
     return np.ma.masked_where(mask_direct[i0:i1], arr)
 
 
+def _calc_roi_sum_chunk_sparse(path_qspace, mask_reciprocal, mask_direct, idx_range):
+    """
+    Sparse counterpart of `_calc_roi_sum_chunk`. Returns a `numpy.masked_array`.
+    """
+    i0, i1 = idx_range
+
+    with h5py.File(path_qspace, "r") as h5f:
+        counts, indices, values = _read_qspace_sparse(h5f, idx_range)
+
+    pos = np.repeat(np.arange(i1 - i0), counts)
+    keep = np.invert(mask_reciprocal.ravel()[indices])
+    arr = np.bincount(pos[keep], weights=values[keep], minlength=i1 - i0)
+
+    return np.ma.masked_where(mask_direct[i0:i1], arr)
+
+
 def calc_roi_sum(path_qspace, mask_reciprocal, mask_direct=None, n_proc=None):
     """
     Calculate the intensity in direct space integrated within `mask_reciprocal`
@@ -458,18 +549,27 @@ def calc_roi_sum(path_qspace, mask_reciprocal, mask_direct=None, n_proc=None):
         n_proc = os.cpu_count()
 
     # direct space shape (1D)
-    with h5py.File(path_qspace, "r") as h5f:
-        sh = h5f["Data/qspace"].shape[:1]
+    sh = get_qspace_shape(path_qspace)[:1]
+    sparse = is_qspace_sparse(path_qspace)
 
     # list of idx ranges [(i0, i1), (i0, i1), ...]
-    idxs_list = _get_chunk_indexes(path_qspace, "Data/qspace", n_proc=n_proc)
+    path_in_h5 = "Data/qspace_sum" if sparse else "Data/qspace"
+    idxs_list = _get_chunk_indexes(path_qspace, path_in_h5, n_proc=n_proc)
 
     # direct space mask
     mask_dir = mask_direct.flatten() if mask_direct is not None else np.zeros(sh)
 
-    pfun = functools.partial(
-        _calc_roi_sum_chunk, path_qspace, mask_reciprocal, mask_dir
-    )
+    if sparse:
+        pfun = functools.partial(
+            _calc_roi_sum_chunk_sparse,
+            path_qspace,
+            mask_reciprocal.astype("bool"),
+            mask_dir,
+        )
+    else:
+        pfun = functools.partial(
+            _calc_roi_sum_chunk, path_qspace, mask_reciprocal, mask_dir
+        )
     roi_sum_list = []
     with mp.Pool(processes=n_proc) as p:
         for res in tqdm(p.imap(pfun, idxs_list), total=len(idxs_list)):
@@ -478,15 +578,29 @@ def calc_roi_sum(path_qspace, mask_reciprocal, mask_direct=None, n_proc=None):
     return np.ma.concatenate(roi_sum_list)
 
 
-def _calc_com_idx(path_h5, path_in_h5, mask_idxs, qx, qy, qz, idx_list, **kwargs):
-    with h5py.File(path_h5, "r") as h5f:
-        i0, i1 = idx_list
-
-        roi = (slice(i0, i1, None), *mask_idxs)
-        frames = h5f[path_in_h5][roi]
+def _calc_com_idx(
+    path_h5,
+    path_in_h5,
+    mask_idxs,
+    qx,
+    qy,
+    qz,
+    idx_list,
+    det_bin=1,
+    pos_bin=1,
+    map_width=1,
+    **kwargs,
+):
+    qx, qy, qz = [_bin_pixels(q[mask_idxs], det_bin, np.mean) for q in (qx, qy, qz)]
 
+    with h5py.File(path_h5, "r") as h5f:
+        # read pos_bin map rows at a time
+        blocks = _iter_binned_frames(
+            h5f[path_in_h5], idx_list, mask_idxs, det_bin, pos_bin, map_width
+        )
         coms = [
-            calc_com_3d(frame, qx[mask_idxs], qy[mask_idxs], qz[mask_idxs], **kwargs)
+            calc_com_3d(frame, qx, qy, qz, **kwargs)
+            for frames in blocks
             for frame in frames
         ]
 
@@ -506,6 +620,8 @@ def calc_coms_qspace2d(
     std=None,
     path_data_h5="/{scan_no}/instrument/{detector}/data",
     pbar=True,
+    det_bin=1,
+    pos_bin=1,
 ):
     """
     Calculate center of masses (COMs) in reciprocal space for a 4D SXDM scan.
@@ -535,6 +651,13 @@ def calc_coms_qspace2d(
     path_data_h5 : str, optional
         Path within the .hdf5 BLISS dataset where to look for the raw data,
         by default "/{scan_no}/instrument/{detector}/data"
+    det_bin : int, optional
+        Bin the detector pixels (and `qx`, `qy`, `qz`) by `det_bin` x `det_bin`
+        blocks while reading. Defaults to 1 (no binning).
+    pos_bin : int, optional
+        Bin the map by `pos_bin` x `pos_bin` positions while reading, dropping the
+        rows and columns left over. The COMs are then those of a flattened map of
+        shape `(rows // pos_bin, cols // pos_bin)`. Defaults to 1 (no binning).
 
     Returns
     -------
@@ -560,7 +683,11 @@ def calc_coms_qspace2d(
     with h5py.File(path_dset, "r") as h5f:
         mask_sh = h5f[path_data_h5].shape[1:]
 
-    idx_list = _get_chunk_indexes(path_dset, path_data_h5, n_proc=n_threads)
+    map_shape = get_scan_shape(path_dset, scan_no)
+    if pos_bin == 1:
+        idx_list = _get_chunk_indexes(path_dset, path_data_h5, n_proc=n_threads)
+    else:
+        idx_list = _get_row_chunk_indexes(map_shape, pos_bin, n_proc=n_threads)
 
     mask = np.invert(mask_rec) if mask_rec is not None else np.ones(mask_sh)
     mask_idxs = tuple([slice(x.min(), x.max() + 1) for x in np.where(mask)])
@@ -574,6 +701,9 @@ def calc_coms_qspace2d(
         qx,
         qy,
         qz,
+        det_bin=det_bin,
+        pos_bin=pos_bin,
+        map_width=map_shape[1],
         n_pix=n_pix,
         std=std,
     )
@@ -0,0 +1,1312 @@
+"""
+Grid SXDM data stored in XSOCS-compatible HDF5 files onto a regular q-space grid
+without going through `xsocs.QSpaceConverter`.
+
+The detector pixel -> q-space mapping only depends on the angles of each scan, not
+on the sample position. Hence a pixel -> voxel look-up table (LUT) is computed once
+per scan and all the detector frames of that scan are binned through it.
+"""
+
+import os
+import json
+import numpy as np
+import h5py
+import hdf5plugin
+import multiprocessing as mp
+import time
+import warnings
+
+from functools import partial
+from tqdm.notebook import tqdm
+import scipy.ndimage as ndi
+
+import xrayutilities as xu
+
+from xsocs.io.XsocsH5 import XsocsH5
+from xsocs.io.QSpaceH5 import QSpaceCoordinates
+from xsocs.process.qspace import qspace_conversion
+
+from .xsocs import get_qspace_vals_xsocs
+from ..io.utils import (
+    _read_qspace_sparse,
+    _bin_pixels,
+    _bin_positions,
+    _get_shard_dir,
+    _write_shard,
+    _create_virtual_dataset,
+)
+from ..io.xsocs import get_piezo_motorpos
+from ..io.bliss import (
+    get_sxdm_sums_multi,
+    get_sxdm_scan_numbers,
+    get_detector_aliases,
+    get_positioner,
+)
+
+_lut_cache = None
+_mask_direct = None
+
+_QSPACE_AXES = {
+    "cartesian": ("qx", "qy", "qz"),
+    "spherical": ("pitch", "roll", "radial"),
+}
+
+
+def _get_qspace_bins(qs, nbins, valid=None, qspace_roi=None):
+    """
+    Return the bin centres of a q-space grid of shape `nbins` spanning the
+    extent of the q-space coordinate arrays `qs`, as XSOCS would, or the
+    bounding box `qspace_roi`.
+
+    Parameters
+    ----------
+    qs : list of numpy.ndarray
+        q-space coordinate arrays, each of shape (n_scans, n_pixels).
+    nbins : tuple of int
+        Number of bins along each q-space dimension.
+    valid : numpy.ndarray, optional
+        1D boolean array of length n_pixels, False for pixels to be ignored.
+    qspace_roi : list, optional
+        [[min, max], [min, max], [min, max]] centres of the first and last bins
+        along each q-space dimension. Any of them can be None to use the extent
+        of `qs` instead.
+
+    Returns
+    -------
+    centers : list of numpy.ndarray
+        Bin centres along each q-space dimension.
+    """
+    valid = np.s_[:] if valid is None else valid
+    qspace_roi = [[None, None]] * len(nbins) if qspace_roi is None else qspace_roi
+
+    centers = []
+    for q, n, (qmin, qmax) in zip(qs, nbins, qspace_roi):
+        qmin = q[:, valid].min() if qmin is None else qmin
+        qmax = q[:, valid].max() if qmax is None else qmax
+        if qmax < qmin:
+            raise ValueError(f"Empty q-space region of interest: {qmin} > {qmax}")
+        centers.append(np.linspace(qmin, qmax, n))
+
+    return centers
+
+
+def _get_qspace_lut(qs, centers, valid=None, mask_reciprocal=None):
+    """
+    Return the flat index of the q-space voxel each detector pixel falls into.
+
+    Parameters
+    ----------
+    qs : list of numpy.ndarray
+        q-space coordinates of each detector pixel, each of shape (n_pixels,).
+    centers : list of numpy.ndarray
+        Bin centres along each q-space dimension, as returned by
+        `_get_qspace_bins`.
+    valid : numpy.ndarray, optional
+        1D boolean array of length n_pixels, False for pixels to be ignored.
+    mask_reciprocal : numpy.ndarray, optional
+        Boolean array of the shape of the q-space grid, True for the voxels to be
+        ignored.
+
+    Returns
+    -------
+    lut : numpy.ndarray
+        1D array of length n_pixels. Pixels falling outside of the grid, in
+        a voxel masked by `mask_reciprocal` or masked by `valid` are set to -1.
+    """
+    nbins = [c.size for c in centers]
+    inside = np.ones(qs[0].shape, dtype=bool) if valid is None else valid.copy()
+
+    idxs = []
+    for q, c, n in zip(qs, centers, nbins):
+        step = (c[-1] - c[0]) / (n - 1) if n > 1 else 1.0
+        idx = np.floor((q - c[0]) / step + 0.5).astype(np.int64)
+        inside &= (idx >= 0) & (idx < n)
+        idxs.append(np.clip(idx, 0, n - 1))
+
+    lut = np.ravel_multi_index(idxs, nbins)
+    if mask_reciprocal is not None:
+        inside &= np.invert(mask_reciprocal.ravel()[lut])
+    lut[~inside] = -1
+
+    return lut
+
+
+def _crop_qspace_lut(lut, nbins, vox_sl):
+    """
+    Re-index the q-space LUT `lut` of a grid of shape `nbins` to the sub-grid
+    `vox_sl` (a tuple of slices). Pixels outside of the sub-grid are set to -1.
+    """
+    out = np.full_like(lut, -1)
+    inside = np.flatnonzero(lut >= 0)
+
+    idxs = np.unravel_index(lut[inside], nbins)
+    idxs = [i - s.start for i, s in zip(idxs, vox_sl)]
+    sub_nbins = [s.stop - s.start for s in vox_sl]
+    ok = np.all([(i >= 0) & (i < n) for i, n in zip(idxs, sub_nbins)], axis=0)
+
+    out[inside[ok]] = np.ravel_multi_index([i[ok] for i in idxs], sub_nbins)
+
+    return out
+
+
+def _get_read_window(used, det_roi, medfilt_dims=None, correct_mpx_gaps=False):
+    """
+    Return the [row_min, row_max, col_min, col_max] detector window enclosing the
+    pixels `used` (a 2D boolean array covering `det_roi`), grown so that the median
+    filter and the Maxipix gap correction give the same result as when reading the
+    whole `det_roi`.
+    """
+    pad = (0, 0) if medfilt_dims is None else [d // 2 for d in medfilt_dims]
+
+    window = []
+    for ax, (lo_roi, p) in enumerate(zip(det_roi[::2], pad)):
+        hi_roi = det_roi[2 * ax + 1]
+        idx = np.flatnonzero(used.any(axis=1 - ax))
+        lo, hi = lo_roi + idx[0] - p, lo_roi + idx[-1] + 1 + p
+        if correct_mpx_gaps:
+            # gap pixels are computed from the chip edge pixels 255 and 260
+            lo = 255 if 255 < lo < 258 else lo
+            hi = 261 if 258 < hi < 261 else hi
+        window += [max(lo, lo_roi), min(hi, hi_roi)]
+
+    return window
+
+
+def _correct_mpx_gaps(frames, offset=(0, 0)):
+    """
+    Share the intensity of the Maxipix pixels at the edge of each chip with the
+    gap pixels next to them, as XSOCS does. `frames` is a float stack of shape
+    (n_frames, rows, cols) whose first pixel is at `offset` on the detector.
+    """
+    row, col = offset
+    nrows, ncols = frames.shape[1:]
+
+    if row <= 255 < row + nrows:
+        frames[:, 255 - row : 258 - row] = frames[:, 255 - row, None] / 3
+    if row <= 260 < row + nrows:
+        frames[:, max(0, 258 - row) : 261 - row] = frames[:, 260 - row, None] / 3
+    if col <= 255 < col + ncols:
+        frames[:, :, 255 - col : 258 - col] = frames[:, :, 255 - col, None] / 3
+    if col <= 260 < col + ncols:
+        frames[:, :, max(0, 258 - col) : 261 - col] = frames[:, :, 260 - col, None] / 3
+
+    return frames
+
+
+def _init_lut_worker(luts, mask_direct=None):
+    """
+    Store the per-scan LUTs in each worker process, keeping only the pixels
+    that contribute to the q-space grid, and the sample positions to skip.
+    """
+    global _lut_cache, _mask_direct
+
+    _mask_direct = mask_direct
+    _lut_cache = []
+    for lut in luts:
+        pix_idx = np.flatnonzero(lut >= 0)
+        _lut_cache.append((pix_idx, lut[pix_idx]))
+
+
+def _grid_qspace_chunk(
+    path_master,
+    entries,
+    read_roi,
+    bin_roi,
+    binning,
+    nbins,
+    correct_mpx_gaps,
+    normalizer,
+    medfilt_dims,
+    sparse,
+    shard_dir,
+    idx_range,
+):
+    """
+    Grid onto q-space the frames of all `entries` for the (flattened) sample
+    positions in `idx_range`. Returns `idx_range`, the q-space intensity of each
+    position as a (n_positions, n_vox) array and its sum over q-space. If `sparse`
+    is True, the q-space intensity is returned as a (counts, indices, values) tuple
+    of the non-zero voxels instead, see `_to_sparse`.
+
+    The `read_roi` region of the frames is read and corrected, then its `bin_roi`
+    part binned according to `binning`, a (det_bin, pos_bin, map_width) tuple. If
+    pos_bin > 1, `idx_range` are binned positions made of whole binned map rows.
+    The positions masked in direct space are read but left empty.
+
+    If `shard_dir` is not None, the q-space intensity is instead written to a
+    shard file of `shard_dir`, whose path is returned in its place.
+    """
+    i0, i1 = idx_range
+    n_pos = i1 - i0
+    n_vox = int(np.prod(nbins))
+    r0, r1, c0, c1 = read_roi
+    det_bin, pos_bin, map_width = binning
+    bin_sl = np.s_[
+        :, bin_roi[0] - r0 : bin_roi[1] - r0, bin_roi[2] - c0 : bin_roi[3] - c0
+    ]
+
+    # raw positions to read
+    if pos_bin > 1:
+        i0, i1 = [i // (map_width // pos_bin) * pos_bin * map_width for i in (i0, i1)]
+
+    # positions to grid, within the block
+    sel = np.s_[:] if _mask_direct is None else ~_mask_direct[i0:i1]
+
+    pos_offset = (np.arange(n_pos)[sel] * n_vox)[:, None]
+    cumul = np.zeros(n_pos * n_vox)
+
+    with h5py.File(path_master, "r") as h5f:
+        for entry, (pix_idx, vox_idx) in zip(entries, _lut_cache):
+            frames = h5f[f"{entry}/measurement/image/data"][i0:i1, r0:r1, c0:c1]
+            frames = frames[sel].astype("float64")
+
+            if correct_mpx_gaps:
+                frames = _correct_mpx_gaps(frames, offset=(r0, c0))
+            if normalizer is not None:
+                norm = h5f[f"{entry}/measurement/{normalizer}"][i0:i1][sel]
+                frames /= norm[:, None, None]
+            if medfilt_dims is not None:
+                frames = ndi.median_filter(
+                    frames, size=(1, *medfilt_dims), mode="constant", cval=0
+                )
+            frames = _bin_pixels(frames[bin_sl], det_bin)
+            frames = _bin_positions(frames, map_width, pos_bin)
+
+            weights = frames.reshape(len(frames), -1)[:, pix_idx]
+            cumul += np.bincount(
+                (pos_offset + vox_idx).ravel(),
+                weights=weights.ravel(),
+                minlength=cumul.size,
+            )
+
+    cumul = cumul.reshape(n_pos, n_vox)
+    cumul_sum = cumul.sum(1)
+
+    if shard_dir is not None:
+        path_shard = _write_shard(
+            f"{shard_dir}/qspace_{idx_range[0]:08d}.h5",
+            "Data/qspace",
+            cumul.reshape(n_pos, *nbins).astype("float32"),
+            chunks=_get_dense_chunks(nbins),
+            **hdf5plugin.Bitshuffle(nelems=0, cname="lz4"),
+        )
+        return idx_range, path_shard, cumul_sum
+    elif sparse:
+        return idx_range, _to_sparse(cumul), cumul_sum
+    else:
+        return idx_range, cumul.astype("float32"), cumul_sum
+
+
+def _to_sparse(qspace):
+    """
+    Convert a (n_positions, n_vox) q-space intensity array to the number of
+    non-zero voxels of each position, their flat q-space indexes and intensity.
+    """
+    pos_idx, indices = np.nonzero(qspace)
+    counts = np.bincount(pos_idx, minlength=qspace.shape[0])
+    values = qspace[pos_idx, indices].astype("float32")
+
+    return counts, indices, values
+
+
+def _write_qspace_block(
+    h5f, idx_range, qspace, qspace_sum, sparse_group="Data/qspace_sparse"
+):
+    """
+    Write the q-space intensity of the sample positions in `idx_range` to the
+    q-space file `h5f`, dense or sparse (to `sparse_group`). Sparse blocks must be
+    written in order, and `indptr` made monotonic once done if some positions were
+    skipped.
+    """
+    i0, i1 = idx_range
+
+    if sparse_group in h5f:
+        grp = h5f[sparse_group]
+        counts, indices, values = qspace
+
+        nnz0 = grp["indices"].shape[0]
+        nnz1 = nnz0 + indices.size
+        for name, arr in zip(("indices", "data"), (indices, values)):
+            grp[name].resize((nnz1,))
+            grp[name][nnz0:nnz1] = arr
+        grp["indptr"][i0 + 1 : i1 + 1] = nnz0 + np.cumsum(counts)
+    else:
+        h5f["Data/qspace"][i0:i1] = qspace.reshape(i1 - i0, *h5f["Data/histo"].shape)
+
+    h5f["Data/qspace_sum"][i0:i1] = qspace_sum
+
+
+def _read_qspace_block(h5f, idx_range):
+    """
+    Return the q-space intensity of the sample positions in `idx_range` of the
+    q-space file `h5f`, dense or sparse, as a (n_positions, n_vox) array.
+    """
+    i0, i1 = idx_range
+    n_vox = int(np.prod(h5f["Data/histo"].shape))
+
+    if "Data/qspace_sparse" in h5f:
+        counts, indices, values = _read_qspace_sparse(h5f, idx_range)
+        qspace = np.zeros((i1 - i0, n_vox), dtype=np.float32)
+        qspace[np.repeat(np.arange(i1 - i0), counts), indices] = values
+        return qspace
+    else:
+        return h5f["Data/qspace"][i0:i1].reshape(i1 - i0, n_vox)
+
+
+def _get_dense_chunks(nbins):
+    """
+    Return the chunk shape of a dense `Data/qspace` dataset.
+    """
+    return (1, *[max(n // 4, 1) for n in nbins])
+
+
+def _create_qspace_sparse(grp, name, n_pos, nbins):
+    """
+    Create the empty `name` sparse q-space group in `grp`, see `_init_qspace_file`.
+    """
+    grp = grp.create_group(name)
+    grp.attrs["shape"] = (n_pos, *nbins)
+    grp.create_dataset("indptr", data=np.zeros(n_pos + 1, dtype=np.int64))
+    idx_dtype = np.int32 if np.prod(nbins) < 2**31 else np.int64
+    for name, dtype in zip(("indices", "data"), (idx_dtype, np.float32)):
+        grp.create_dataset(
+            name,
+            shape=(0,),
+            maxshape=(None,),
+            dtype=dtype,
+            chunks=(2**16,),
+            **hdf5plugin.Bitshuffle(nelems=0, cname="lz4"),
+        )
+
+    return grp
+
+
+def _get_append_entries(path_qconv, entries, n_pos, gridding, **masks):
+    """
+    Return the entries of the master file already gridded in the q-space file
+    `path_qconv`, after checking that it was gridded with the same `gridding`
+    parameters (a JSON string), masks and number of sample positions.
+    """
+    with h5py.File(path_qconv, "r") as h5f:
+        if "Params/gridding" not in h5f:
+            raise ValueError(
+                f"{path_qconv} does not record its gridding parameters, "
+                "it cannot be appended to."
+            )
+        if json.loads(h5f["Params/gridding"][()]) != json.loads(gridding):
+            raise ValueError(
+                f"Cannot append to {path_qconv}: the gridding parameters differ."
+            )
+        for key, mask in masks.items():
+            stored = h5f[f"Params/{key}"][()] if f"Params/{key}" in h5f else None
+            if (stored is None) != (mask is None) or (
+                mask is not None and not np.array_equal(stored, mask)
+            ):
+                raise ValueError(f"Cannot append to {path_qconv}: {key} differs.")
+        if h5f["Data/qspace_sum"].shape[0] != n_pos:
+            raise ValueError(
+                f"Cannot append to {path_qconv}: the number of positions differs."
+            )
+        done = [e.decode() for e in h5f["params/entries/selected"][()]]
+
+    missing = [e for e in done if e not in entries]
+    if missing:
+        raise ValueError(f"Entries {missing} of {path_qconv} not in the master file")
+
+    return done
+
+
+def _get_position_blocks(
+    n_pos, n_vals, n_proc, block_size=None, mask_direct=None, align=1, max_gap=None
+):
+    """
+    Split `n_pos` sample positions into a list of (i0, i1) index ranges of at most
+    `block_size` positions, skipping the positions where the flat boolean array
+    `mask_direct` is True. If `block_size` is None, blocks are sized to keep the
+    `n_vals` float64 values held per position by each process below ~256 MB while
+    spreading the work over `n_proc` processes. Block sizes are a multiple of
+    `align`.
+
+    With `mask_direct`, a block starts and ends at selected positions but may span
+    runs of up to `max_gap` masked ones, which are read and then discarded, so that
+    a scattered mask does not break the positions into many small blocks while
+    larger masked areas are not read. Defaults to `block_size` // 16.
+    """
+    if mask_direct is None:
+        mask_direct = np.zeros(n_pos, dtype=bool)
+    n_sel = np.count_nonzero(~mask_direct)
+
+    if block_size is None:
+        block_size = max(1, int(2**28 / (8 * n_vals)))
+        block_size = min(block_size, max(1, int(np.ceil(n_sel / n_proc))))
+    block_size = max(1, block_size // align) * align
+
+    if not mask_direct.any():
+        return [(i, min(i + block_size, n_pos)) for i in range(0, n_pos, block_size)]
+
+    if max_gap is None:
+        max_gap = block_size // 16
+
+    # groups of selected positions separated by at most max_gap masked ones
+    selected = np.flatnonzero(~mask_direct)
+    splits = np.flatnonzero(np.diff(selected) > max_gap + 1) + 1
+
+    blocks = []
+    for group in np.split(selected, splits):
+        j = 0
+        while j < group.size:
+            i0 = group[j]
+            # last selected position within block_size of the first one
+            j = np.searchsorted(group, i0 + block_size)
+            blocks.append((int(i0), int(group[j - 1]) + 1))
+
+    return blocks
+
+
+def _init_qspace_file(
+    path_qconv,
+    n_pos,
+    centers,
+    histo,
+    sample_x,
+    sample_y,
+    entries,
+    coordinates="cartesian",
+    overwrite=False,
+    sparse=False,
+    **params,
+):
+    """
+    Create a q-space file with the same layout as the one written by XSOCS, with
+    an empty `Data/qspace` dataset.
+
+    If `sparse` is True, `Data/qspace` is replaced by the `Data/qspace_sparse`
+    group storing the q-space intensity in compressed sparse row (CSR) format:
+    `indptr[i]:indptr[i + 1]` is the range of the `indices` (flat q-space voxel
+    indexes) and `data` (intensity) datasets belonging to the sample position `i`.
+    """
+    if os.path.isfile(path_qconv) and not overwrite:
+        raise FileExistsError(
+            f"{path_qconv} exists, use overwrite=True to overwrite it."
+        )
+
+    nbins = tuple(c.size for c in centers)
+    axes = _QSPACE_AXES[coordinates]
+
+    with h5py.File(path_qconv, "w") as h5f:
+        data = h5f.create_group("Data")
+        if sparse:
+            _create_qspace_sparse(data, "qspace_sparse", n_pos, nbins)
+        else:
+            data.create_dataset(
+                "qspace",
+                shape=(n_pos, *nbins),
+                dtype=np.float32,
+                chunks=_get_dense_chunks(nbins),
+                **hdf5plugin.Bitshuffle(nelems=0, cname="lz4"),
+            )
+        data.create_dataset("qspace_sum", shape=(n_pos,), dtype=np.float32)
+        data["histo"] = histo.astype(np.int32)
+        data["sample_x"] = np.asarray(sample_x, dtype=np.float64)
+        data["sample_y"] = np.asarray(sample_y, dtype=np.float64)
+        for name, c in zip(axes, centers):
+            data[name] = c
+
+        data.attrs["NX_class"] = "NXdata"
+        data.attrs["signal"] = "qspace"
+        data.attrs["axes"] = [".", *axes]
+
+        for key, val in params.items():
+            if val is not None:
+                h5f[f"Params/{key}"] = val
+        h5f["params/entries/selected"] = np.array(entries, dtype="S")
+        h5f["params/entries/discarded"] = np.array([], dtype="S")
+
+
+def grid_qspace(
+    path_qconv,
+    path_master,
+    nbins,
+    medfilt_dims=None,
+    offsets=None,
+    overwrite=False,
+    correct_mpx_gaps=True,
+    normalizer=None,
+    mask=None,
+    n_proc=None,
+    center_chan=None,
+    chan_per_deg=None,
+    beam_energy=None,
+    qconv=None,
+    sample_ip=[1, 0, 0],
+    sample_oop=[0, 0, 1],
+    det_ip="y+",
+    det_oop="z-",
+    sampleor="det",
+    det_roi=None,
+    coordinates="cartesian",
+    block_size=None,
+    sparse=False,
+    qspace_roi=None,
+    mask_reciprocal=None,
+    mask_direct=None,
+    append=False,
+    det_bin=1,
+    pos_bin=1,
+    shards=False,
+    pbar=True,
+):
+    """
+    Grid the SXDM data linked by an XSOCS master file onto a regular q-space grid.
+
+    A detector pixel -> q-space voxel look-up table is computed once per scan from
+    the geometry returned by `get_qspace_vals_xsocs`; the detector frames are then
+    binned through it in blocks of sample positions, in parallel. The output file
+    has the same `Data/qspace`, `Data/qx,qy,qz` and `Data/histo` layout as the one
+    written by `grid_qspace_xsocs`.
+
+    The conversion can be restricted to a region of interest in q-space
+    (`qspace_roi`, `mask_reciprocal`) and in direct space (`mask_direct`). Detector
+    pixels that never fall in the q-space region are not read, nor are the frames
+    of the excluded sample positions, except for short runs of them between
+    selected positions, read along with these and discarded so that scattered
+    masks are still read in large blocks.
+
+    With `append=True`, only the scans of `path_master` not yet gridded in an
+    existing `path_qconv` are gridded and added to its q-space intensity and
+    histogram, so that a growing series costs time proportional to the new scans.
+
+    Parameters
+    ----------
+    path_qconv : str
+        Path to the output q-space file.
+    path_master : str
+        Path to the XSOCS master file.
+    nbins : tuple of int
+        Number of q-space bins along each q-space dimension.
+    medfilt_dims : tuple of int, optional
+        Size of the median filter applied to each detector frame. Default: None
+        (no filter).
+    offsets : dict, optional
+        Angular offsets, e.g. {"eta": 0.1}, see `get_qspace_vals_xsocs`.
+    overwrite : bool, optional
+        Overwrite `path_qconv` if it exists. Default is False.
+    correct_mpx_gaps : bool, optional
+        Share the intensity of the Maxipix chip edge pixels with the gap pixels.
+        Default is True.
+    normalizer : str, optional
+        Name of the counter the detector frames are divided by.
+    mask : numpy.ndarray, optional
+        2D array of the same shape as a detector frame. Non-zero pixels are
+        ignored.
+    n_proc : int, optional
+        Number of processes to spawn. Defaults to the number of logical cores.
+    center_chan, chan_per_deg, beam_energy : optional
+        Override the values stored in the master file.
+    qconv, sample_ip, sample_oop, det_ip, det_oop, sampleor : optional
+        Diffractometer geometry, see `get_qspace_vals_xsocs`.
+    det_roi : list, optional
+        Detector region of interest as [row_min, row_max, col_min, col_max].
+    coordinates : str, optional
+        Either "cartesian" (default) or "spherical".
+    block_size : int, optional
+        Number of sample positions gridded at once by each process. Default is
+        None, i.e. computed from the size of the q-space grid.
+    sparse : bool, optional
+        Store only the non-zero q-space voxels of each sample position in the
+        `Data/qspace_sparse` group instead of the dense `Data/qspace` array. Disk
+        space and I/O then scale with the number of occupied voxels. Default is
+        False.
+    qspace_roi : list, optional
+        Restrict the q-space grid to the bounding box [[min, max], [min, max],
+        [min, max]] (centres of the first and last bins along each q-space
+        dimension, any of them can be None). Default is the extent of all pixels.
+    mask_reciprocal : numpy.ndarray, optional
+        Boolean array of shape `nbins`, True for the q-space voxels to be ignored.
+        The output grid is cropped to the bounding box of the unmasked voxels.
+    mask_direct : numpy.ndarray, optional
+        Boolean array with the shape of the sample map (or flat), True for the
+        sample positions to be ignored. Their q-space intensity is left at 0 and
+        takes no disk space.
+    append : bool, optional
+        If `path_qconv` exists, grid only the entries of `path_master` it does not
+        list in `params/entries/selected` and add them to it. All the other
+        parameters, and the q-space bins computed from the entries already
+        gridded, must match those of `path_qconv` (its dense / sparse format is
+        kept), and there must be entries left to grid. Otherwise a ValueError is
+        raised. Pixels of the new scans falling
+        outside of the existing grid are dropped with a warning. Dense files are
+        updated in place: regrid from scratch if an append is interrupted.
+        Default is False.
+    det_bin : int, optional
+        Bin the detector pixels by `det_bin` x `det_bin` blocks (after the gap
+        correction, normalisation and median filter), dropping the rows and
+        columns left over. Default is 1 (no binning).
+    pos_bin : int, optional
+        Bin the sample map by `pos_bin` x `pos_bin` positions, dropping the rows
+        and columns left over. The output then holds (rows // pos_bin) x
+        (cols // pos_bin) positions and the mean sample coordinates of each
+        block. Cannot be used with `mask_direct`. Default is 1 (no binning).
+    shards : bool, optional
+        Have each process write its blocks of positions to its own shard file in
+        the `<path_qconv>_shards` directory, and make `Data/qspace` a virtual
+        dataset stitching them together, so that writing scales with `n_proc`.
+        The shard directory must be kept (or moved) along with `path_qconv`; use
+        `sxdm.io.xsocs.rechunk_qspace` to get a self-contained copy. Cannot be
+        used with `sparse` or `append`. Default is False.
+    pbar : bool, optional
+        Display a progress bar. Default is True.
+
+    Returns
+    -------
+    None
+    """
+    if coordinates not in _QSPACE_AXES:
+        raise ValueError('Accepted coordinates: "cartesian", "spherical"')
+    if shards and (sparse or append):
+        raise ValueError("shards cannot be used with sparse or append")
+
+    if n_proc is None:
+        n_proc = os.cpu_count()
+
+    t0 = time.time()
+
+    entries = all_entries = XsocsH5(path_master).entries()
+    with h5py.File(path_master, "r") as h5f:
+        n_pos, *frame_shape = h5f[f"{entries[0]}/measurement/image/data"].shape
+
+    if det_roi is None:
+        det_roi = [0, frame_shape[0], 0, frame_shape[1]]
+    if mask_reciprocal is not None:
+        mask_reciprocal = np.asarray(mask_reciprocal, dtype=bool)
+        if mask_reciprocal.shape != tuple(nbins):
+            raise ValueError(f"mask_reciprocal must be of shape {tuple(nbins)}")
+        if mask_reciprocal.all():
+            raise ValueError("mask_reciprocal masks all the q-space voxels")
+    if mask_direct is not None:
+        mask_direct = np.asarray(mask_direct, dtype=bool).ravel()
+        if mask_direct.size != n_pos:
+            raise ValueError(f"mask_direct must have {n_pos} elements")
+
+    # raw positions are binned by whole blocks of pos_bin map rows
+    map_width = 1
+    n_out = n_pos
+    if pos_bin > 1:
+        if mask_direct is not None:
+            raise ValueError("mask_direct cannot be used with pos_bin > 1")
+        with h5py.File(path_master, "r") as h5f:
+            map_width = int(h5f[f"{entries[0]}/scan/motor_0_steps"][()])
+        n_out = (n_pos // map_width // pos_bin) * (map_width // pos_bin)
+
+    # everything the q-space grid and intensity depend on, bar the masks
+    gridding = json.dumps(
+        dict(
+            nbins=nbins,
+            medfilt_dims=medfilt_dims,
+            correct_mpx_gaps=correct_mpx_gaps,
+            normalizer=normalizer,
+            offsets=offsets,
+            center_chan=center_chan,
+            chan_per_deg=chan_per_deg,
+            beam_energy=beam_energy,
+            qconv=str(qconv) if qconv is not None else None,
+            sample_ip=sample_ip,
+            sample_oop=sample_oop,
+            det_ip=det_ip,
+            det_oop=det_oop,
+            sampleor=sampleor,
+            det_roi=det_roi,
+            coordinates=coordinates,
+            qspace_roi=qspace_roi,
+            det_bin=det_bin,
+            pos_bin=pos_bin,
+        ),
+        sort_keys=True,
+        default=lambda x: x.tolist() if hasattr(x, "tolist") else str(x),
+    )
+
+    # entries already gridded, used to compute the q-space bins
+    append = append and os.path.isfile(path_qconv)
+    bin_entries = entries
+    if append:
+        bin_entries = _get_append_entries(
+            path_qconv,
+            entries,
+            n_out,
+            gridding,
+            image_mask=mask,
+            mask_reciprocal=mask_reciprocal,
+            mask_direct=mask_direct,
+        )
+        entries = [e for e in entries if e not in bin_entries]
+        if not entries:
+            raise ValueError(
+                f"All the entries of {path_master} are already in {path_qconv}"
+            )
+        with h5py.File(path_qconv, "r") as h5f:
+            sparse = "Data/qspace_sparse" in h5f
+
+    # q-space coordinates of every pixel of every scan, in entry order
+    qs = get_qspace_vals_xsocs(
+        path_master,
+        offsets=offsets if offsets is not None else dict(),
+        center_chan=center_chan,
+        chan_per_deg=chan_per_deg,
+        beam_energy=beam_energy,
+        qconv=qconv,
+        det_roi=[0, frame_shape[0], 0, frame_shape[1]],
+        sample_ip=sample_ip,
+        sample_oop=sample_oop,
+        det_ip=det_ip,
+        det_oop=det_oop,
+        sampleor=sampleor,
+        coordinates=coordinates,
+        sort_angles=False,
+    )
+
+    roi_sl = np.s_[det_roi[0] : det_roi[1], det_roi[2] : det_roi[3]]
+    qs = [_bin_pixels(q[(slice(None), *roi_sl)], det_bin, np.mean) for q in qs]
+    roi_shape = qs[0].shape[1:]
+    qs = [q.reshape(q.shape[0], -1) for q in qs]
+    qs_bins = [q[[all_entries.index(e) for e in bin_entries]] for q in qs]
+    qs = [q[[all_entries.index(e) for e in entries]] for q in qs]
+
+    # binned pixels are ignored if any of their pixels is masked
+    if mask is not None:
+        valid = np.invert(mask[roi_sl].astype("bool"))
+        valid = _bin_pixels(valid, det_bin, np.all).ravel()
+    else:
+        valid = np.ones(qs[0].shape[1], dtype="bool")
+
+    # one LUT per scan, shared by all sample positions
+    centers = _get_qspace_bins(qs_bins, nbins, valid, qspace_roi)
+    luts = [
+        _get_qspace_lut([q[i] for q in qs], centers, valid, mask_reciprocal)
+        for i in range(len(entries))
+    ]
+
+    # crop the grid to the unmasked voxels
+    if mask_reciprocal is not None:
+        vox_sl = tuple(
+            slice(i.min(), i.max() + 1) for i in np.nonzero(~mask_reciprocal)
+        )
+        luts = [_crop_qspace_lut(lut, nbins, vox_sl) for lut in luts]
+        centers = [c[sl] for c, sl in zip(centers, vox_sl)]
+        nbins = tuple(c.size for c in centers)
+
+    if append:
+        n_outside = sum(np.count_nonzero(lut[valid] < 0) for lut in luts)
+        if n_outside:
+            warnings.warn(
+                f"{n_outside / (valid.sum() * len(luts)):.1%} of the pixels of the "
+                f"appended scans fall outside of the q-space grid of {path_qconv}."
+            )
+
+    # only read and bin the detector pixels falling in the q-space grid
+    used = np.any([lut >= 0 for lut in luts], axis=0).reshape(roi_shape)
+    if not used.any():
+        raise ValueError("No detector pixel falls within the q-space grid")
+    rows, cols = [np.flatnonzero(used.any(axis=1 - ax)) for ax in (0, 1)]
+    luts = [
+        lut.reshape(roi_shape)[rows[0] : rows[-1] + 1, cols[0] : cols[-1] + 1].ravel()
+        for lut in luts
+    ]
+    bin_roi = [
+        det_roi[0] + rows[0] * det_bin,
+        det_roi[0] + (rows[-1] + 1) * det_bin,
+        det_roi[2] + cols[0] * det_bin,
+        det_roi[2] + (cols[-1] + 1) * det_bin,
+    ]
+    used = np.zeros((det_roi[1] - det_roi[0], det_roi[3] - det_roi[2]), dtype=bool)
+    used[
+        bin_roi[0] - det_roi[0] : bin_roi[1] - det_roi[0],
+        bin_roi[2] - det_roi[2] : bin_roi[3] - det_roi[2],
+    ] = True
+    read_roi = _get_read_window(used, det_roi, medfilt_dims, correct_mpx_gaps)
+
+    n_vox = int(np.prod(nbins))
+    histo = np.zeros(n_vox, dtype=np.int64)
+    for lut in luts:
+        histo += np.bincount(lut[lut >= 0], minlength=n_vox)
+    histo = histo.reshape(nbins)
+
+    if append:
+        with h5py.File(path_qconv, "a") as h5f:
+            axes = [h5f[f"Data/{name}"][()] for name in _QSPACE_AXES[coordinates]]
+            if any(
+                c.shape != a.shape or not np.allclose(c, a)
+                for c, a in zip(centers, axes)
+            ):
+                raise ValueError(
+                    f"Cannot append to {path_qconv}: the q-space bins differ."
+                )
+            if sparse:
+                if "Data/qspace_sparse_new" in h5f:  # left by an interrupted append
+                    del h5f["Data/qspace_sparse_new"]
+                _create_qspace_sparse(h5f["Data"], "qspace_sparse_new", n_out, nbins)
+    else:
+        sample_x, sample_y = [
+            _bin_positions(m.ravel(), map_width, pos_bin, np.mean)
+            for m in get_piezo_motorpos(path_master)
+        ]
+        _init_qspace_file(
+            path_qconv,
+            n_out,
+            centers,
+            histo,
+            sample_x,
+            sample_y,
+            entries,
+            coordinates=coordinates,
+            overwrite=overwrite,
+            sparse=sparse,
+            medfilt_dims=medfilt_dims if medfilt_dims is not None else [1, 1],
+            maxipix_correction=int(correct_mpx_gaps),
+            image_normalizer=normalizer if normalizer is not None else "",
+            image_mask=mask,
+            det_roi=det_roi,
+            qspace_roi=(
+                None
+                if qspace_roi is None
+                else np.array(qspace_roi, dtype=float)  # None -> nan
+            ),
+            mask_reciprocal=mask_reciprocal,
+            mask_direct=mask_direct,
+            det_bin=det_bin,
+            pos_bin=pos_bin,
+            gridding=gridding,
+        )
+
+    t_lut = time.time() - t0
+    n_read = (read_roi[1] - read_roi[0]) * (read_roi[3] - read_roi[2])
+    blocks = _get_position_blocks(
+        n_out,
+        n_vox + n_read * pos_bin**2,
+        n_proc,
+        block_size,
+        mask_direct,
+        align=map_width // pos_bin if pos_bin > 1 else 1,
+    )
+    pfun = partial(
+        _grid_qspace_chunk,
+        path_master,
+        entries,
+        read_roi,
+        bin_roi,
+        (det_bin, pos_bin, map_width),
+        nbins,
+        correct_mpx_gaps,
+        normalizer,
+        medfilt_dims,
+        sparse and not append,
+        _get_shard_dir(path_qconv, clear=True) if shards else None,
+    )
+
+    with mp.Pool(
+        n_proc, initializer=_init_lut_worker, initargs=(luts, mask_direct)
+    ) as p:
+        gen = p.imap(pfun, blocks)
+        if pbar:
+            gen = tqdm(gen, total=len(blocks))
+        with h5py.File(path_qconv, "a") as h5f:
+            sparse_group = "Data/qspace_sparse"
+            if append:
+                # sparse data is rewritten to a new group, swapped in when done
+                sparse_group += "_new" if sparse else ""
+                for idx_range, qspace, qspace_sum in gen:
+                    i0, i1 = idx_range
+                    qspace = qspace + _read_qspace_block(h5f, idx_range)
+                    qspace_sum = qspace_sum + h5f["Data/qspace_sum"][i0:i1]
+                    qspace = _to_sparse(qspace) if sparse else qspace
+                    _write_qspace_block(
+                        h5f, idx_range, qspace, qspace_sum, sparse_group
+                    )
+            elif shards:
+                qspace_shards = []
+                for (i0, i1), path_shard, qspace_sum in gen:
+                    qspace_shards.append((path_shard, "Data/qspace", np.s_[i0:i1]))
+                    h5f["Data/qspace_sum"][i0:i1] = qspace_sum
+                _create_virtual_dataset(
+                    h5f,
+                    "Data/qspace",
+                    (n_out, *nbins),
+                    np.float32,
+                    qspace_shards,
+                )
+            else:
+                for idx_range, qspace, qspace_sum in gen:
+                    _write_qspace_block(h5f, idx_range, qspace, qspace_sum)
+            if sparse:
+                # skipped positions have no voxels
+                indptr = h5f[f"{sparse_group}/indptr"]
+                indptr[...] = np.maximum.accumulate(indptr[()])
+                if append:
+                    del h5f["Data/qspace_sparse"]
+                    h5f.move(sparse_group, "Data/qspace_sparse")
+            if append:
+                h5f["Data/histo"][...] = h5f["Data/histo"][()] + histo
+                del h5f["params/entries/selected"]
+                h5f["params/entries/selected"] = np.array(
+                    bin_entries + entries, dtype="S"
+                )
+
+    n_sel = n_out if mask_direct is None else np.count_nonzero(~mask_direct)
+    print(
+        f"Gridded {n_sel} positions x {len(entries)} scans in "
+        f"{(time.time() - t0) / 60:.2f}m (LUTs: {t_lut:.1f}s)"
+    )
+
+
+def _get_bliss_geometry(path_dset, scan_nums, detector):
+    """
+    Return the diffractometer angles of each of `scan_nums` and the beam energy,
+    direct beam position and channels per degree of `detector` read from the
+    BLISS dataset `path_dset`, as `make_xsocs_links` does.
+    """
+    with h5py.File(path_dset, "r") as h5f:
+        instr = h5f[f"{scan_nums[0]}/instrument"]
+        center_chan = [instr[f"{detector}/beam_center_{x}"][()] for x in ("y", "x")]
+        det_distance = instr[f"{detector}/distance"][()]
+        pix_sizes = [instr[f"{detector}/{m}_pixel_size"][()] for m in ("y", "x")]
+        chan_per_deg = [np.tan(np.radians(1)) * det_distance / p for p in pix_sizes]
+        beam_energy = xu.lam2en(instr["monochromator/WaveLength"][()] * 1e10)
+        angles = {
+            a: np.array([np.mean(get_positioner(h5f, s, a)) for s in scan_nums])
+            for a in ("phi", "eta", "nu", "delta")
+        }
+
+    return angles, beam_energy, center_chan, chan_per_deg
+
+
+def grid_qspace_integrated(
+    path_dset,
+    nbins,
+    scan_nums=None,
+    detector=None,
+    mask_sample=None,
+    mask=None,
+    offsets=None,
+    correct_mpx_gaps=True,
+    qconv=None,
+    sample_ip=[1, 0, 0],
+    sample_oop=[0, 0, 1],
+    det_ip="y+",
+    det_oop="z-",
+    sampleor="det",
+    det_roi=None,
+    coordinates="cartesian",
+    qspace_roi=None,
+    bin_norm=False,
+    n_proc=None,
+    pbar=True,
+):
+    """
+    Compute the 3D reciprocal space map (RSM) integrated over the sample map, or
+    over a sample mask, straight from a BLISS dataset.
+
+    Rather than gridding every sample position and averaging the result, the
+    detector frames of each scan are summed first, in a single pass over all the
+    scans with `get_sxdm_sums_multi`, and only these n_scans frame sums are
+    gridded onto q-space.
+
+    Parameters
+    ----------
+    path_dset : str
+        Path to the .h5 BLISS dataset.
+    nbins : tuple of int
+        Number of q-space bins along each q-space dimension.
+    scan_nums : list of str, optional
+        SXDM scans to use, e.g. ["1.1", "2.1"]. Defaults to all of them.
+    detector : str, optional
+        Detector alias. Defaults to the first one found.
+    mask_sample : numpy.ndarray, optional
+        Sample positions to exclude from the frame sums, as in
+        `get_sxdm_frame_sum`. Either one array with the shape of the sample map
+        used for all scans, or a list of one per scan, e.g. to follow a drifting
+        sample, see `get_sxdm_sums_multi`.
+    mask : numpy.ndarray, optional
+        2D array of the same shape as a detector frame. Non-zero pixels are
+        ignored.
+    offsets : dict, optional
+        Angular offsets, e.g. {"eta": 0.1}, see `get_qspace_vals_xsocs`.
+    correct_mpx_gaps : bool, optional
+        Share the intensity of the Maxipix chip edge pixels with the gap pixels.
+        Default is True.
+    qconv, sample_ip, sample_oop, det_ip, det_oop, sampleor : optional
+        Diffractometer geometry, see `get_qspace_vals_xsocs`.
+    det_roi : list, optional
+        Detector region of interest as [row_min, row_max, col_min, col_max]. Only
+        this region of the frames is read.
+    coordinates : str, optional
+        Either "cartesian" (default) or "spherical".
+    qspace_roi : list, optional
+        Restrict the q-space grid to a bounding box, see `grid_qspace`.
+    bin_norm : bool, optional
+        Divide the intensity of each voxel by the number of pixels falling in it.
+        Default is False.
+    n_proc : int, optional
+        Number of processes used to sum the frames of the scans.
+    pbar : bool, optional
+        Display a progress bar. Default is True.
+
+    Returns
+    -------
+    qx, qy, qz : numpy.ndarray
+        Bin centres along each q-space dimension (pitch, roll, radial if
+        `coordinates` is "spherical").
+    rsm : numpy.ndarray
+        Integrated RSM of shape `nbins`.
+    """
+    if coordinates not in _QSPACE_AXES:
+        raise ValueError('Accepted coordinates: "cartesian", "spherical"')
+
+    t0 = time.time()
+
+    if scan_nums is None:
+        scan_nums = get_sxdm_scan_numbers(path_dset)
+    if detector is None:
+        detector = get_detector_aliases(path_dset, scan_nums[0])[0]
+
+    with h5py.File(path_dset, "r") as h5f:
+        frame_shape = h5f[f"{scan_nums[0]}/instrument/{detector}/data"].shape[1:]
+    if det_roi is None:
+        det_roi = [0, frame_shape[0], 0, frame_shape[1]]
+    roi_sl = np.s_[det_roi[0] : det_roi[1], det_roi[2] : det_roi[3]]
+
+    # one masked frame sum per scan
+    frames, _ = get_sxdm_sums_multi(
+        path_dset,
+        scan_nums,
+        mask_sample=mask_sample,
+        detector=detector,
+        n_proc=n_proc,
+        pbar=pbar,
+        roi=det_roi,
+    )
+    if correct_mpx_gaps:
+        frames = _correct_mpx_gaps(frames, offset=det_roi[::2])
+
+    # q-space coordinates of each pixel of each scan
+    angles, beam_energy, center_chan, chan_per_deg = _get_bliss_geometry(
+        path_dset, scan_nums, detector
+    )
+    qs = qspace_conversion(
+        frame_shape,
+        center_chan,
+        chan_per_deg,
+        beam_energy,
+        *angles.values(),
+        offsets=offsets if offsets is not None else dict(),
+        qconv=qconv,
+        sample_ip=sample_ip,
+        sample_oop=sample_oop,
+        det_ip=det_ip,
+        det_oop=det_oop,
+        sampleor=sampleor,
+        coordinates=(
+            QSpaceCoordinates.CARTESIAN
+            if coordinates == "cartesian"
+            else QSpaceCoordinates.SPHERICAL
+        ),
+        verbose=False,
+    )
+    qs = [qs[(slice(None), *roi_sl, i)].reshape(len(scan_nums), -1) for i in range(3)]
+
+    if mask is not None:
+        valid = np.invert(mask[roi_sl].astype("bool")).ravel()
+    else:
+        valid = np.ones(qs[0].shape[1], dtype="bool")
+
+    # grid the frame sums
+    centers = _get_qspace_bins(qs, nbins, valid, qspace_roi)
+    n_vox = int(np.prod(nbins))
+    rsm, histo = np.zeros(n_vox), np.zeros(n_vox)
+    for i, frame in enumerate(frames.reshape(len(scan_nums), -1)):
+        lut = _get_qspace_lut([q[i] for q in qs], centers, valid)
+        inside = lut >= 0
+        rsm += np.bincount(lut[inside], weights=frame[inside], minlength=n_vox)
+        histo += np.bincount(lut[inside], minlength=n_vox)
+
+    rsm, histo = rsm.reshape(nbins), histo.reshape(nbins)
+    if bin_norm:
+        rsm = np.divide(rsm, histo, out=np.zeros_like(rsm), where=histo > 0)
+
+    print(f"Gridded {len(scan_nums)} frame sums in {time.time() - t0:.1f}s")
+
+    return (*centers, rsm)
+
+
+def preview_grid_qspace(
+    path_master,
+    nbins,
+    n_positions=100,
+    sampling="stride",
+    det_bin=1,
+    bins_scale=0.5,
+    medfilt_dims=None,
+    offsets=None,
+    correct_mpx_gaps=True,
+    normalizer=None,
+    mask=None,
+    n_proc=None,
+    center_chan=None,
+    chan_per_deg=None,
+    beam_energy=None,
+    qconv=None,
+    sample_ip=[1, 0, 0],
+    sample_oop=[0, 0, 1],
+    det_ip="y+",
+    det_oop="z-",
+    sampleor="det",
+    det_roi=None,
+    coordinates="cartesian",
+    qspace_roi=None,
+    seed=None,
+):
+    """
+    Quickly preview the result of `grid_qspace` on a subset of the data, to tune
+    `nbins`, `offsets`, `det_roi`, etc. before the full conversion.
+
+    About `n_positions` sample positions are gridded, optionally binning the
+    detector pixels, onto a grid `bins_scale` times coarser than `nbins`, and
+    summed. The time and output size of the full `grid_qspace` run with the same
+    parameters are estimated from the time taken.
+
+    Parameters
+    ----------
+    path_master : str
+        Path to the XSOCS master file.
+    nbins : tuple of int
+        Number of q-space bins of the full conversion.
+    n_positions : int, optional
+        Approximate number of sample positions to grid. Default is 100.
+    sampling : str, optional
+        "stride" (default) for evenly spaced positions or "random".
+    det_bin : int, optional
+        Bin the detector pixels by `det_bin` x `det_bin` blocks. Default is 1.
+    bins_scale : float, optional
+        Ratio of the number of q-space bins of the preview to `nbins`. Default is
+        0.5.
+    medfilt_dims, offsets, correct_mpx_gaps, normalizer, mask : optional
+        See `grid_qspace`.
+    n_proc : int, optional
+        Number of processes assumed for the full run time estimate. Defaults to
+        the number of logical cores.
+    center_chan, chan_per_deg, beam_energy, qconv, sample_ip, sample_oop, det_ip,
+    det_oop, sampleor, det_roi, coordinates, qspace_roi : optional
+        See `grid_qspace`.
+    seed : int, optional
+        Seed of the random sampling.
+
+    Returns
+    -------
+    qx, qy, qz : numpy.ndarray
+        Bin centres of the preview grid along each q-space dimension.
+    rsm : numpy.ndarray
+        q-space intensity summed over the previewed sample positions.
+    estimate : dict
+        Estimated duration (s) and uncompressed size (bytes) of the `Data/qspace`
+        dataset of the full conversion, and the fraction of occupied voxels of the
+        preview grid.
+    """
+    if coordinates not in _QSPACE_AXES:
+        raise ValueError('Accepted coordinates: "cartesian", "spherical"')
+    if sampling not in ("stride", "random"):
+        raise ValueError('Accepted sampling: "stride", "random"')
+
+    if n_proc is None:
+        n_proc = os.cpu_count()
+
+    t0 = time.time()
+
+    entries = XsocsH5(path_master).entries()
+    with h5py.File(path_master, "r") as h5f:
+        n_pos, *frame_shape = h5f[f"{entries[0]}/measurement/image/data"].shape
+
+    if det_roi is None:
+        det_roi = [0, frame_shape[0], 0, frame_shape[1]]
+    roi_sl = np.s_[det_roi[0] : det_roi[1], det_roi[2] : det_roi[3]]
+
+    if sampling == "stride":
+        positions = np.s_[:: max(1, n_pos // n_positions)]
+        n_sel = len(range(n_pos)[positions])
+    else:
+        rng = np.random.default_rng(seed)
+        positions = np.sort(rng.choice(n_pos, min(n_positions, n_pos), replace=False))
+        n_sel = positions.size
+
+    qs = get_qspace_vals_xsocs(
+        path_master,
+        offsets=offsets if offsets is not None else dict(),
+        center_chan=center_chan,
+        chan_per_deg=chan_per_deg,
+        beam_energy=beam_energy,
+        qconv=qconv,
+        det_roi=[0, frame_shape[0], 0, frame_shape[1]],
+        sample_ip=sample_ip,
+        sample_oop=sample_oop,
+        det_ip=det_ip,
+        det_oop=det_oop,
+        sampleor=sampleor,
+        coordinates=coordinates,
+        sort_angles=False,
+        verbose=False,
+    )
+    qs = [_bin_pixels(q[(slice(None), *roi_sl)], det_bin, np.mean) for q in qs]
+    qs = [q.reshape(len(entries), -1) for q in qs]
+
+    valid = np.ones(frame_shape, dtype=bool) if mask is None else mask == 0
+    valid = _bin_pixels(valid[roi_sl], det_bin, np.all).ravel()
+
+    nbins_preview = [max(1, int(round(n * bins_scale))) for n in nbins]
+    centers = _get_qspace_bins(qs, nbins_preview, valid, qspace_roi)
+    n_vox = int(np.prod(nbins_preview))
+
+    # grid the selected positions, timing the reading, LUT and binning steps
+    t_read, t_lut, t_bin = 0, 0, 0
+    rsm, histo = np.zeros(n_vox), np.zeros(n_vox)
+    with h5py.File(path_master, "r") as h5f:
+        for i, entry in enumerate(entries):
+            _t = time.time()
+            dset = h5f[f"{entry}/measurement/image/data"]
+            frames = dset[(positions, *roi_sl)].astype("float64")
+            if correct_mpx_gaps:
+                frames = _correct_mpx_gaps(frames, offset=det_roi[::2])
+            if normalizer is not None:
+                norm = h5f[f"{entry}/measurement/{normalizer}"][positions]
+                frames /= norm[:, None, None]
+            if medfilt_dims is not None:
+                frames = ndi.median_filter(
+                    frames, size=(1, *medfilt_dims), mode="constant", cval=0
+                )
+            frame = _bin_pixels(frames.sum(0), det_bin).ravel()
+            t_read += time.time() - _t
+
+            _t = time.time()
+            lut = _get_qspace_lut([q[i] for q in qs], centers, valid)
+            inside = lut >= 0
+            t_lut += time.time() - _t
+
+            _t = time.time()
+            rsm += np.bincount(lut[inside], weights=frame[inside], minlength=n_vox)
+            t_bin += time.time() - _t
+            histo += np.bincount(lut[inside], minlength=n_vox)
+
+    # the full run reads every position and bins every full resolution frame
+    t_positions = t_read * n_pos / n_sel + t_bin * det_bin**2 * n_pos
+    estimate = dict(
+        duration=t_lut * det_bin**2 + t_positions / n_proc,
+        size=n_pos * int(np.prod(nbins)) * 4,
+        occupancy=np.count_nonzero(histo) / n_vox,
+    )
+
+    print(
+        f"Preview of {n_sel}/{n_pos} positions x {len(entries)} scans in "
+        f"{time.time() - t0:.1f}s\n"
+        f"Estimated full run on {n_proc} processes: "
+        f"{estimate['duration'] / 60:.1f}m, "
+        f"{estimate['size'] / 1e9:.2f}GB uncompressed "
+        f"({estimate['occupancy']:.0%} of the voxels occupied)"
+    )
+
+    return (*centers, rsm.reshape(nbins_preview), estimate)
@@ -6,6 +6,10 @@ import h5py
 import hdf5plugin
 import time
 import concurrent.futures
+import functools
+import hashlib
+import collections
+import warnings
 
 from functools import partial
 import scipy.ndimage as ndi
@@ -17,7 +21,17 @@ from xsocs.io.QSpaceH5 import QSpaceCoordinates
 
 from id01lib.xrd.qspace.bliss import _det_aliases
 
-from ..io.utils import list_available_counters, _get_chunk_indexes_detector
+from ..io.utils import (
+    list_available_counters,
+    _get_chunk_indexes_detector,
+    _get_shard_dir,
+    _write_shard,
+    _create_virtual_dataset,
+)
+
+# q-space coordinates computed by get_qspace_vals_xsocs, keyed by geometry
+_QSPACE_VALS_CACHE_SIZE = 4
+_qspace_vals_cache = collections.OrderedDict()
 
 
 def grid_qspace_xsocs(
@@ -84,28 +98,20 @@ def grid_qspace_xsocs(
     rc = converter.status
     if rc != QSpaceConverter.DONE:
         raise ValueError(
-            "Conversion failed with CODE={0} :\n" "{1}" "" "".format(
-                converter.status, converter.status_msg
-            )
+            "Conversion failed with CODE={0} :\n"
+            "{1}"
+            ""
+            "".format(converter.status, converter.status_msg)
         )
 
 
-def get_qspace_vals_xsocs(
-    path_master,
-    offsets=dict(),
-    center_chan=None,
-    chan_per_deg=None,
-    beam_energy=None,
-    qconv=None,
-    det_roi=None,
-    sample_ip=[1, 0, 0],
-    sample_oop=[0, 0, 1],
-    det_ip="y+",
-    det_oop="z-",
-    sampleor="det",
-    coordinates="cartesian",
-    verbose=True,
-):
+@functools.lru_cache(maxsize=8)
+def _get_master_geometry(path_master, mtime):
+    """
+    Return the detector, the diffractometer angles of each entry (in entry order)
+    and the acquisition parameters stored in the XSOCS master file `path_master`.
+    Results are cached for each `mtime` of the master file.
+    """
     h5f = XsocsH5(path_master)
     entry0 = h5f.get_entry_name(entry_idx=0)
     with h5f:
@@ -129,9 +135,124 @@ def get_qspace_vals_xsocs(
 
     angles = {key: None for key in "phi,eta,nu,del".split(",")}
     for a in angles:
-        angles[a] = np.sort(np.array([h5f.positioner(e, a) for e in h5f.entries()]))
+        angles[a] = np.array([h5f.positioner(e, a) for e in h5f.entries()])
+
+    acq_params = tuple(h5f.acquisition_params().values())
+
+    return det, angles, acq_params
+
+
+def _get_qspace_vals_key(angles, img_size, **params):
+    """
+    Return a hash identifying the q-space coordinates computed from `angles`,
+    `img_size` and the remaining conversion `params`.
+    """
+    sha = hashlib.sha1()
+    for a in angles.values():
+        sha.update(np.ascontiguousarray(a, dtype="float64").tobytes())
+    sha.update(repr(tuple(int(x) for x in img_size)).encode())
+    for key in sorted(params):
+        val = params[key]
+        if isinstance(val, dict):
+            val = sorted(val.items())
+        elif isinstance(val, np.ndarray):
+            val = val.tolist()
+        sha.update(f"{key}={val!r}".encode())
+
+    return sha.hexdigest()
+
+
+def clear_qspace_vals_cache(cache_dir=None):
+    """
+    Empty the in-memory cache of q-space coordinates used by `get_qspace_vals_xsocs`
+    and, if `cache_dir` is given, delete the coordinates cached on disk there.
+    """
+    _qspace_vals_cache.clear()
+    _get_master_geometry.cache_clear()
 
-    nrj, cen_pix, cpd = h5f.acquisition_params().values()
+    if cache_dir is not None:
+        for path in glob.glob(f"{cache_dir}/qspace_vals_*.npy"):
+            os.remove(path)
+
+
+def get_qspace_vals_xsocs(
+    path_master,
+    offsets=dict(),
+    center_chan=None,
+    chan_per_deg=None,
+    beam_energy=None,
+    qconv=None,
+    det_roi=None,
+    sample_ip=[1, 0, 0],
+    sample_oop=[0, 0, 1],
+    det_ip="y+",
+    det_oop="z-",
+    sampleor="det",
+    coordinates="cartesian",
+    verbose=True,
+    sort_angles=True,
+    cache=True,
+    cache_dir=None,
+):
+    """
+    Return the q-space coordinates of each detector pixel for each scan linked
+    by the XSOCS master file `path_master`.
+
+    The coordinates of the whole detector, with the scans in entry order, are
+    memoised in memory, and in `cache_dir` on disk if given, keyed by the master
+    file and its modification time, the angles, the offsets, the detector
+    calibration, the energy and the sample/detector orientation. `det_roi` and
+    `sort_angles` are applied to the cached arrays, so that calling this function
+    again with the same geometry (e.g. `estimate_n_bins` then `grid_qspace`) is
+    near-instant.
+
+    Parameters
+    ----------
+    path_master : str
+        Path to the XSOCS master file.
+    offsets : dict, optional
+        Angular offsets subtracted from the diffractometer angles.
+    center_chan, chan_per_deg, beam_energy : optional
+        Override the detector calibration and energy stored in the master file.
+    qconv : xrayutilities.QConversion, optional
+        Diffractometer geometry.
+    det_roi : list, optional
+        Detector region of interest as [row_min, row_max, col_min, col_max].
+    sample_ip, sample_oop, det_ip, det_oop, sampleor : optional
+        Sample and detector orientation.
+    coordinates : str, optional
+        Either "cartesian" (default) or "spherical".
+    verbose : bool, optional
+        Print the calibration values used. Default is True.
+    sort_angles : bool, optional
+        Sort each angle independently. If False, the first dimension of the returned
+        arrays follows the order of the entries in `path_master`. Default is True.
+    cache : bool, optional
+        Use and update the in-memory and on-disk caches. Default is True.
+    cache_dir : str, optional
+        Directory of the on-disk cache. Default is None, i.e. memory only. Use
+        `clear_qspace_vals_cache` to empty it.
+
+    Returns
+    -------
+    qx, qy, qz : numpy.ndarray
+        Arrays of shape (n_scans, det_rows, det_cols). They are read-only, as they
+        are shared with the cache: copy them before modifying them in place.
+    """
+    path_master = os.path.abspath(path_master)
+    mtime = os.path.getmtime(path_master)
+    det, angles, acq_params = _get_master_geometry(path_master, mtime)
+    perm = None
+    if sort_angles:
+        # scans ordered by all the angles, if it sorts each of them
+        perm = np.lexsort(list(angles.values())[::-1])
+        if not all(np.array_equal(np.sort(v), v[perm]) for v in angles.values()):
+            angles = {key: np.sort(val) for key, val in angles.items()}
+            perm = None
+        elif (np.diff(perm) > 0).all():  # already in order
+            perm = None
+
+    nrj, cen_pix, cpd = acq_params
     if center_chan is None:
         center_chan = cen_pix
     if chan_per_deg is None:
@@ -150,6 +271,9 @@ def get_qspace_vals_xsocs(
         img_size = det.pixnum
     else:
         img_size = (det_roi[1] - det_roi[0], det_roi[3] - det_roi[2])
+    # the ROI only sets the number of pixels, its coordinates are those of the
+    # first pixels of the whole detector
+    full_size = tuple(int(max(a, b)) for a, b in zip(det.pixnum, img_size))
 
     if coordinates == "cartesian":
         coords = QSpaceCoordinates.CARTESIAN
@@ -158,24 +282,72 @@ def get_qspace_vals_xsocs(
     else:
         raise ValueError('Accepted coordinates: "cartesian", "spherical"')
 
-    q_array = qspace_conversion(
-        img_size,
-        center_chan,
-        chan_per_deg,
-        beam_energy,
-        *angles.values(),
+    key = _get_qspace_vals_key(
+        angles,
+        full_size,
+        master=(path_master, mtime),
         offsets=offsets,
-        qconv=qconv,
-        sample_ip=sample_ip,
-        sample_oop=sample_oop,
+        center_chan=np.asarray(center_chan, dtype="float64"),
+        chan_per_deg=np.asarray(chan_per_deg, dtype="float64"),
+        beam_energy=np.asarray(beam_energy, dtype="float64"),
+        qconv=str(qconv),
+        sample_ip=list(sample_ip),
+        sample_oop=list(sample_oop),
         det_ip=det_ip,
         det_oop=det_oop,
         sampleor=sampleor,
-        coordinates=coords,
-        verbose=verbose,
+        coordinates=coordinates,
     )
+    path_cache = None
+    if cache_dir is not None:
+        path_cache = os.path.join(cache_dir, f"qspace_vals_{key}.npy")
+
+    if cache and key in _qspace_vals_cache:
+        _qspace_vals_cache.move_to_end(key)
+        q_array = _qspace_vals_cache[key]
+    elif cache and path_cache is not None and os.path.isfile(path_cache):
+        if verbose:
+            print(f"Loading q-space coordinates from {path_cache}")
+        q_array = np.load(path_cache)
+        q_array.flags.writeable = False
+    else:
+        q_array = qspace_conversion(
+            full_size,
+            center_chan,
+            chan_per_deg,
+            beam_energy,
+            *angles.values(),
+            offsets=offsets,
+            qconv=qconv,
+            sample_ip=sample_ip,
+            sample_oop=sample_oop,
+            det_ip=det_ip,
+            det_oop=det_oop,
+            sampleor=sampleor,
+            coordinates=coords,
+            verbose=verbose,
+        )
+        q_array = q_array.transpose(3, 0, 1, 2)
+        q_array.flags.writeable = False  # shared by all callers when cached
+
+        if cache and path_cache is not None:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                np.save(path_cache, q_array)
+            except OSError as err:
+                warnings.warn(f"Could not cache q-space coordinates on disk: {err}")
+
+    if cache:
+        _qspace_vals_cache[key] = q_array
+        while len(_qspace_vals_cache) > _QSPACE_VALS_CACHE_SIZE:
+            _qspace_vals_cache.popitem(last=False)
 
-    qx, qy, qz = q_array.transpose(3, 0, 1, 2)
+    q_array = q_array[:, :, : img_size[0], : img_size[1]]
+    if perm is not None:
+        q_array = q_array[:, perm]
+        q_array.flags.writeable = False
+
+    qx, qy, qz = q_array
 
     return qx, qy, qz
 
@@ -233,6 +405,137 @@ def _get_motor_dict(path_master, ls, motor_name="eta"):
     return motor_dict
 
 
+def _get_shift_path(path_subh5):
+    """
+    Return the path of the shifted copy of `path_subh5`.
+    """
+    _name_base = os.path.abspath(path_subh5).split(".")[0]
+    return f"{_name_base}.1_shifted.h5"
+
+
+def _init_shift_file(path_subh5, roi):
+    """
+    Copy `path_subh5` to its shifted counterpart without the detector data, moving
+    the direct beam position to the origin of `roi`. Returns the path of the copy.
+    """
+    path_subh5_shift = shutil.copy(path_subh5, _get_shift_path(path_subh5))
+
+    with h5py.File(path_subh5_shift, "a", libver="latest") as f:
+        root = list(f.keys())[0]
+
+        # if ROI modify values of central pixel
+        if roi is not None:
+            cpy, cpx = [
+                f[f"/{root}/instrument/detector/center_chan_dim{i}"] for i in (0, 1)
+            ]
+            cpy[...] = cpy[()] - roi[0]
+            cpx[...] = cpx[()] - roi[2]
+
+        # delete original dataset and its link
+        del f[f"{root}/instrument/detector/data"]
+        del f[f"{root}/measurement/image/data"]
+
+    return path_subh5_shift
+
+
+def _shift_write_tile(path_master, shifts, path_subh5, shard_dir, tile):
+    """
+    Apply one of `shifts` to the detector pixels of `path_subh5` within `tile`,
+    i.e. [row_min, row_max, col_min, col_max], and write them to a shard file of
+    `shard_dir`. Returns `path_subh5`, the path of the shard and `tile`.
+    """
+    etashift = _get_motor_dict(path_master, shifts)
+    r0, r1, c0, c1 = tile
+
+    with h5py.File(path_subh5, "r") as h5f:
+        root = list(h5f.keys())[0]
+        eta = str(np.round(h5f[f"{root}/instrument/positioners/eta"][()], 4))
+        shift = etashift[eta]
+        sh_map = tuple([h5f[f"{root}/scan/motor_{i}_steps"][()] for i in (0, 1)])
+        chunk = h5f[f"/{root}/instrument/detector/data"][:, r0:r1, c0:c1]
+
+    chunk = chunk.reshape(sh_map[::-1] + (-1,))  # x,y,detx*dety
+    if not np.allclose(shift, 0, atol=1e-3):
+        for i in range(chunk.shape[-1]):
+            chunk[..., i] = ndi.shift(chunk[..., i], shift)
+
+    path_shard = _write_shard(
+        f"{shard_dir}/data_{r0:04d}_{c0:04d}.h5",
+        "data",
+        chunk.reshape(-1, r1 - r0, c1 - c0).astype(np.uint16),
+        chunks=(1, r1 - r0, c1 - c0),
+        **hdf5plugin.Bitshuffle(nelems=0, cname="lz4"),
+    )
+
+    return path_subh5, path_shard, tile
+
+
+def _shift_xsocs_data_shards(
+    path_master, shifts, subh5_list, n_chunks, roi, overwrite, n_proc
+):
+    """
+    Apply `shifts` to `subh5_list` one detector tile per process, each tile being
+    written to its own shard file. The detector data of each shifted file is a
+    virtual dataset stitching its tiles together.
+    """
+    tasks = []
+    for path_subh5 in subh5_list:
+        path_subh5_shift = _get_shift_path(path_subh5)
+        if os.path.isfile(path_subh5_shift) and overwrite is False:
+            print(f"\nNOT overwriting {os.path.basename(path_subh5)}!", flush=True)
+            continue
+
+        with h5py.File(path_subh5, "r") as h5f:
+            path_data = f"/{list(h5f.keys())[0]}/instrument/detector/data"
+        idx0, idx1 = _get_chunk_indexes_detector(
+            path_subh5, path_data, n_chunks=n_chunks, roi=roi
+        )
+
+        _init_shift_file(path_subh5, roi)
+        shard_dir = _get_shard_dir(path_subh5_shift, clear=True)
+        tasks += [(path_subh5, shard_dir, (*r, *c)) for r in idx0 for c in idx1]
+
+    if len(tasks) == 0:
+        return
+
+    pf = partial(_shift_write_tile, path_master, shifts)
+    shards = collections.defaultdict(list)
+    with concurrent.futures.ProcessPoolExecutor(n_proc) as exec:
+        for path_subh5, path_shard, tile in exec.map(pf, *zip(*tasks)):
+            shards[path_subh5].append((path_shard, tile))
+
+    for path_subh5, scan_shards in shards.items():
+        with h5py.File(_get_shift_path(path_subh5), "a", libver="latest") as f:
+            root = list(f.keys())[0]
+            n_pos = np.prod([f[f"{root}/scan/motor_{i}_steps"][()] for i in (0, 1)])
+            r_start, c_start = (0, 0) if roi is None else (roi[0], roi[2])
+            sh_data = (
+                n_pos,
+                max(t[1] for _, t in scan_shards) - r_start,
+                max(t[3] for _, t in scan_shards) - c_start,
+            )
+
+            data_shift = _create_virtual_dataset(
+                f,
+                f"{root}/instrument/detector/data",
+                sh_data,
+                np.uint16,
+                [
+                    (
+                        path_shard,
+                        "data",
+                        np.s_[
+                            :, r0 - r_start : r1 - r_start, c0 - c_start : c1 - c_start
+                        ],
+                    )
+                    for path_shard, (r0, r1, c0, c1) in scan_shards
+                ],
+            )
+            f[f"{root}/measurement/image/data"] = data_shift
+
+        print(f"\n{os.path.basename(path_subh5)} finished.", flush=True)
+
+
 def _shift_write_data(path_master, shifts, n_chunks, roi, path_subh5, overwrite=False):
     """
     Apply one of `shifts` to the chosen `path_subh5` file.
@@ -266,8 +569,7 @@ def _shift_write_data(path_master, shifts, n_chunks, roi, path_subh5, overwrite=
         )
 
         # establish shifted file name and get output directory name
-        _name_base = os.path.abspath(path_subh5).split(".")[0]
-        path_subh5_shift = f"{_name_base}.1_shifted.h5"
+        path_subh5_shift = _get_shift_path(path_subh5)
         path_out = os.path.dirname(path_subh5)
 
         # check if the shifted file exists in the output dir, if yes stop
@@ -277,7 +579,7 @@ def _shift_write_data(path_master, shifts, n_chunks, roi, path_subh5, overwrite=
             return
 
         # generate shifted file
-        path_subh5_shift = shutil.copy(path_subh5, path_subh5_shift)
+        path_subh5_shift = _init_shift_file(path_subh5, roi)
 
         # chunk size
         sh_chunk = np.diff(idx0)[0, 0], np.diff(idx1)[0, 0]
@@ -286,21 +588,9 @@ def _shift_write_data(path_master, shifts, n_chunks, roi, path_subh5, overwrite=
 
         t2 = 0
         with h5py.File(path_subh5_shift, "a", libver="latest") as f:
-            # if ROI modify values of central pixel
-            if roi is not None:
-                cpy, cpx = [
-                    f[f"/{root}/instrument/detector/center_chan_dim{i}"] for i in (0, 1)
-                ]
-                cpy[...] = cpy[()] - roi[0]
-                cpx[...] = cpx[()] - roi[2]
-
-            # delete original dataset and its link
             det_shift = f[f"{root}/instrument/detector/"]
             det_shift_link = f[f"{root}/measurement/image/"]
 
-            del det_shift["data"]
-            del det_shift_link["data"]
-
             # create empty dataset where the original was
             data_shift = det_shift.create_dataset(
                 "data",
@@ -380,10 +670,18 @@ def shift_xsocs_data(
     n_chunks=3,
     roi=None,
     overwrite=False,
+    shards=False,
+    n_proc=None,
 ):
     """
     Apply shifts to SXDM data that has been stored in XSOCS-compatible HDF5 files.
 
+    By default each scan is shifted by one process writing its shifted file. With
+    `shards=True` the work is instead split in (scan, detector tile) tasks, each
+    process writing its tile to its own shard file; the detector data of each
+    shifted file is then a virtual dataset stitching the tiles together. This
+    keeps all the processes busy even with fewer scans than processes.
+
     Parameters
     ----------
     path_master : str
@@ -403,6 +701,12 @@ def shift_xsocs_data(
     overwrite : bool, optional
         A flag to indicate whether existing files should be overwritten.
         Default is False.
+    shards : bool, optional
+        Write the shifted detector data as `n_chunks` x `n_chunks` shard files per
+        scan, in the `<scan>_shifted_shards` directories next to the shifted
+        files, with which they must be kept. Default is False.
+    n_proc : int, optional
+        Number of processes to spawn. Defaults to the number of logical cores.
 
     Returns
     -------
@@ -418,18 +722,27 @@ def shift_xsocs_data(
     if len(subh5_list) != len(shifts):
         raise ValueError("subh5_list and shifts are not the same length!")
 
-    pf = partial(
-        _shift_write_data, path_master, shifts, n_chunks, roi, overwrite=overwrite
-    )
-
-    with concurrent.futures.ProcessPoolExecutor() as exec:
-        try:
-            for result in exec.map(pf, subh5_list):
-                pass
-        except concurrent.futures.process.BrokenProcessPool:
-            print(
-                "\n >> You are probably out of memory! Try running the function "
-                "again with n_chunks=N with N greater than what was used here.\n"
+    try:
+        if shards:
+            _shift_xsocs_data_shards(
+                path_master, shifts, subh5_list, n_chunks, roi, overwrite, n_proc
             )
+        else:
+            pf = partial(
+                _shift_write_data,
+                path_master,
+                shifts,
+                n_chunks,
+                roi,
+                overwrite=overwrite,
+            )
+            with concurrent.futures.ProcessPoolExecutor(n_proc) as exec:
+                for result in exec.map(pf, subh5_list):
+                    pass
+    except concurrent.futures.process.BrokenProcessPool:
+        print(
+            "\n >> You are probably out of memory! Try running the function "
+            "again with n_chunks=N with N greater than what was used here.\n"
+        )
 
     _make_shift_master(path_master, path_out)
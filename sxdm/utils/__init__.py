@@ -7,5 +7,6 @@ from .general import (
     get_q_extents,
     get_qspace_coords,
     get_shift,
+    shift_maps,
     calc_refl_id01,
 )
@@ -4,14 +4,23 @@ import numpy as np
 import h5py
 import xrayutilities as xu
 import re
+import multiprocessing as mp
+
+from functools import partial
+from tqdm.notebook import tqdm
 
 from xsocs.io import XsocsH5
-from xsocs.util import project
 from ..io.bliss import get_positioner
+from ..io.xsocs import QSpaceReader
 
 from id01lib.io.bliss import get_detector_aliases
 
-__all__ = ["get_SXDM_info", "parse_scan_command", "make_xsocs_links"]
+__all__ = [
+    "get_SXDM_info",
+    "parse_scan_command",
+    "make_xsocs_links",
+    "make_sxdm_vds",
+]
 
 ScanRange = collections.namedtuple("ScanRange", ["name", "start", "stop", "numpoints"])
 
@@ -158,6 +167,193 @@ def parse_scan_command(command):
     return cmd_dict
 
 
+_PI_MOTOR_NAMES = {
+    "pix_position": "adcY",
+    "piy_position": "adcX",
+    "piz_position": "adcZ",
+    "pix": "adcY",
+    "piy": "adcX",
+    "piz": "adcZ",
+}
+
+
+def _select_sxdm_scans(h5f, scan_nums=None):
+    """
+    Return the "n.1" scan numbers and the commands of the SXDM scans of the open
+    BLISS dataset `h5f`: all of them if `scan_nums` is None, else those of
+    `scan_nums`.
+    """
+    name_dset = os.path.basename(h5f.filename).split(".")[0]
+
+    # using all scan numbers in file?
+    if scan_nums is None:
+        print(f"> Using all scan numbers in {name_dset}")
+        scan_idxs = range(1, len(list(h5f.keys())) + 1)
+        commands = [h5f[f"{s}.1/title"][()].decode() for s in scan_idxs]
+        selected = [
+            (f"{s}.1", c)
+            for s, c in zip(scan_idxs, commands)
+            if any([s in c for s in ("sxdm", "kmap")])
+        ]
+        scan_nums = [s for s, _ in selected]
+        commands = [c for _, c in selected]
+    else:
+        try:
+            scan_nums = [f"{int(x)}.1" for x in scan_nums]
+        except ValueError:  # not a list of int
+            scan_nums = scan_nums
+        print(f"> Selecting scans {scan_nums[0]} --> {scan_nums[-1]} in {name_dset}")
+        commands = [h5f[f"{s}/title"][()].decode() for s in scan_nums]
+
+    return scan_nums, commands
+
+
+def _select_detector(h5f, scan_num, detector=None):
+    """
+    Return `detector`, or if None the only detector of the scan `scan_num` of the
+    open BLISS dataset `h5f`.
+    """
+    if detector is None:
+        detector = get_detector_aliases(h5f, scan_num)
+        if len(detector) > 1:
+            msg = f"Found multiple detector groups: {detector}, select"
+            msg += "one by explicitly setting the `detector` keyword argument"
+            raise Exception(msg)
+        detector = detector[0]
+
+    return detector
+
+
+def _read_xsocs_link_params(h5f, scan_num, command, detector):
+    """
+    Return the metadata of the scan `scan_num` of the open BLISS dataset `h5f`
+    written by `_write_xsocs_link_file`.
+    """
+    entry = h5f[scan_num]
+    instr = entry["instrument/"]
+
+    # get some metadata
+    start_time = entry["start_time"][()].decode()
+    direct_beam = [instr[f"{detector}/beam_center_{x}"][()] for x in ("y", "x")]
+    det_distance = instr[f"{detector}/distance"][()]
+
+    pix_sizes = [instr[f"{detector}/{m}_pixel_size"][()] for m in ("y", "x")]
+    chan_per_deg = [np.tan(np.radians(1)) * det_distance / pxs for pxs in pix_sizes]
+    energy = xu.lam2en(instr["monochromator/WaveLength"][()] * 1e10)
+
+    # get counters
+    counters = [x for x in instr if instr[x].attrs.get("NX_class") == "NXdetector"]
+
+    # Why am I removing this? I forgot.
+    # In the new bliss files it does not seem to be there,
+    # hence the try / except
+    try:
+        counters.remove(f"{detector}_beam")
+    except ValueError:
+        pass
+
+    # get piezo coordinates
+    pi_positioners = [
+        x for x in instr if instr[x].attrs.get("NX_class") == "NXpositioner"
+    ]
+    positioners = {}
+    for p in instr["positioners"]:
+        try:
+            positioners[p] = get_positioner(h5f, scan_num, p)
+        except (KeyError, AttributeError):  # failed pos
+            pass
+
+    return dict(
+        scan_num=scan_num,
+        command=command,
+        command_params=parse_scan_command(command),
+        start_time=start_time,
+        direct_beam=direct_beam,
+        chan_per_deg=chan_per_deg,
+        energy=energy,
+        counters=counters,
+        pi_positioners=pi_positioners,
+        positioners=positioners,
+        n_images=entry[f"measurement/{detector}"].shape[0],
+    )
+
+
+def _write_xsocs_link_file(path_dset, detector, args):
+    """
+    Write the XSOCS-compatible file `out_h5f` of entry `entry_name`, linking to the
+    scan of `path_dset` described by `params` (see `_read_xsocs_link_params`).
+    """
+    out_h5f, entry_name, params = args
+    scan_num = params["scan_num"]
+
+    # write links to individual XSOCS-compatible files
+    with XsocsH5.XsocsH5Writer(out_h5f, "w") as xsocsh5f:  # overwrite
+        """
+        XsocsH5Writer methods
+        --> make links to scan parameters
+        """
+        xsocsh5f.create_entry(entry_name)  # creates NX skeleton
+        xsocsh5f.set_scan_params(
+            entry_name, **params["command_params"]
+        )  # "scan" folder contents
+
+        xsocsh5f.set_beam_energy(params["energy"], entry_name)
+        xsocsh5f.set_chan_per_deg(params["chan_per_deg"], entry_name)
+        xsocsh5f.set_direct_beam(params["direct_beam"], entry_name)
+        xsocsh5f.set_image_roi_offset([0, 0], entry_name)  # hardcoded for now
+
+        """
+        XsocsH5Base methods
+        --> make links to data and counters
+        """
+        xsocsh5f._set_scalar_data(f"{entry_name}/title", params["command"])
+        xsocsh5f._set_scalar_data(f"{entry_name}/start_time", params["start_time"])
+
+        for c in params["counters"]:
+            if c == detector:
+                xsocsh5f.add_file_link(
+                    f"{entry_name}/measurement/image/data",
+                    path_dset,
+                    f"{scan_num}/measurement/{c}",
+                )
+            else:
+                xsocsh5f.add_file_link(
+                    f"{entry_name}/measurement/{c}",
+                    path_dset,
+                    f"{scan_num}/measurement/{c}",
+                )
+        for p, pval in params["positioners"].items():
+            pw = p if p != "delta" else "del"
+
+            try:
+                xsocsh5f._set_array_data(
+                    f"{entry_name}/instrument/positioners/{pw}", pval
+                )
+            except ValueError:
+                xsocsh5f._set_scalar_data(
+                    f"{entry_name}/instrument/positioners/{pw}", pval
+                )
+            except AttributeError:  # failed pos
+                pass
+
+        for pp in params["pi_positioners"]:
+            if pp in _PI_MOTOR_NAMES:
+                xsocsh5f.add_file_link(
+                    f"{entry_name}/measurement/{_PI_MOTOR_NAMES[pp]}",
+                    path_dset,
+                    f"{scan_num}/instrument/{pp}/value",
+                )
+
+        _imgnr = np.arange(params["n_images"])
+        xsocsh5f._set_array_data(f"{entry_name}/measurement/imgnr", _imgnr)
+
+        xsocsh5f.add_file_link(
+            f"{entry_name}/technique", path_dset, f"{scan_num}/technique"
+        )
+
+    return out_h5f
+
+
 def make_xsocs_links(
     path_dset,
     path_out,
@@ -165,11 +361,16 @@ def make_xsocs_links(
     detector=None,
     name_outh5=None,
     stitch_counter=None,
+    incremental=False,
+    n_proc=None,
 ):
     """
     Generates a set of .h5 files to be fed to XSOCS from a 3D-SXDM dataset.
     The files contain *links* to the original data, not the data itself.
 
+    The metadata of all the scans is read in a single pass over `path_dset`, the
+    per-scan files are then written in parallel and the master file once.
+
     Parameters
     ----------
     path_dset : str
@@ -183,6 +384,12 @@ def make_xsocs_links(
     name_outh5 : str, default `None`
         Prefix of the XSOCS-compatible .h5 files generated. Defaults to the suffix of
         `path_dset`.
+    incremental : bool, default `False`
+        Keep an existing master file and only link the scans it does not contain
+        yet, e.g. those collected since the last call.
+    n_proc : int, default `None`
+        Number of processes writing the per-scan files. Defaults to the number of
+        CPUs.
 
     Returns
     -------
@@ -193,196 +400,178 @@ def make_xsocs_links(
     if not os.path.isdir(path_out):
         os.mkdir(path_out)
 
-    pi_motor_names = {
-        "pix_position": "adcY",
-        "piy_position": "adcX",
-        "piz_position": "adcZ",
-    }
-
-    pi_motor_names_new = {
-        "pix": "adcY",
-        "piy": "adcX",
-        "piz": "adcZ",
-    }
-
     # open the dataset file
     with h5py.File(path_dset, "r") as h5f:
         name_dset = os.path.basename(path_dset).split(".")[0]
-
-        # using all scan numbers in file?
-        if scan_nums is None:
-            print(f"> Using all scan numbers in {name_dset}")
-            scan_idxs = range(1, len(list(h5f.keys())) + 1)
-            commands = [h5f[f"{s}.1/title"][()].decode() for s in scan_idxs]
-            scan_nums = [
-                f"{s}.1"
-                for s, c in zip(scan_idxs, commands)
-                if any([s in c for s in ("sxdm", "kmap")])
-            ]
-        else:
-            try:
-                scan_nums = [f"{int(x)}.1" for x in scan_nums]
-            except ValueError:  # not a list of int
-                scan_nums = scan_nums
-            print(
-                f"> Selecting scans {scan_nums[0]} --> {scan_nums[-1]} in {name_dset}"
-            )
-            commands = [h5f[f"{s}/title"][()].decode() for s in scan_nums]
+        scan_nums, commands = _select_sxdm_scans(h5f, scan_nums)
 
         # name the output files
         if name_outh5 is None:
             name_outh5 = name_dset
 
         # detector?
-        if detector is None:
-            detector = get_detector_aliases(path_dset, scan_nums[0])
-            if len(detector) > 1:
-                msg = f"Found multiple detector groups: {detector}, select"
-                msg += "one by explicitly setting the `detector` keyword argument"
-                raise Exception(msg)
-            else:
-                detector = detector[0]
-        else:
-            detector = detector
+        detector = _select_detector(h5f, scan_nums[0], detector)
         print(f"> Selecting detector {detector}")
 
         out_h5f_master = f"{path_out}/{name_outh5}_master.h5"
-        if stitch_counter is None:
-            # generate output master file
-            with XsocsH5.XsocsH5MasterWriter(out_h5f_master, "w") as master:
-                pass  # overwrite master file
+        if incremental and os.path.isfile(out_h5f_master):
+            with h5py.File(out_h5f_master, "r") as master:
+                linked = set(master.keys())
         else:
-            pass
+            linked = set()
+            if stitch_counter is None:
+                # generate output master file
+                with XsocsH5.XsocsH5MasterWriter(out_h5f_master, "w") as master:
+                    pass  # overwrite master file
 
         # load counters, positioners, and other params for each scan
+        args = []
         for scan_num, command in zip(scan_nums, commands):
-            entry = h5f[scan_num]
-            instr = entry["instrument/"]
-
-            # get some metadata
-            start_time = entry["start_time"][()].decode()
-            direct_beam = [instr[f"{detector}/beam_center_{x}"] for x in ("y", "x")]
-            det_distance = instr[f"{detector}/distance"]
-
-            pix_sizes = [instr[f"{detector}/{m}_pixel_size"][()] for m in ("y", "x")]
-            chan_per_deg = [
-                np.tan(np.radians(1)) * det_distance / pxs for pxs in pix_sizes
-            ]
-            energy = xu.lam2en(instr["monochromator/WaveLength"][()] * 1e10)
-
-            # get counters
-            counters = [
-                x for x in instr if instr[x].attrs.get("NX_class") == "NXdetector"
-            ]
-
-            # Why am I removing this? I forgot.
-            # In the new bliss files it does not seem to be there,
-            # hence the try / except
-            try:
-                counters.remove(f"{detector}_beam")
-            except ValueError:
-                pass
-
-            # get piezo coordinates
-            pi_positioners = [
-                x for x in instr if instr[x].attrs.get("NX_class") == "NXpositioner"
-            ]
-            positioners = [x for x in instr["positioners"]]
-
-            # more parameters
             if stitch_counter is not None:
                 entry_name = f'{int(scan_num.split(".")[0]) + stitch_counter}.1'
             else:
                 entry_name = scan_num  # <-- ends up in output h5 fname
-            command_params = parse_scan_command(command)
-
             out_h5f = f"{path_out}/{name_outh5}_{entry_name}.h5"
 
-            # write links to individual XSOCS-compatible files
-            with XsocsH5.XsocsH5Writer(out_h5f, "w") as xsocsh5f:  # overwrite
-                """
-                XsocsH5Writer methods
-                --> make links to scan parameters
-                """
-                xsocsh5f.create_entry(entry_name)  # creates NX skeleton
-                xsocsh5f.set_scan_params(
-                    entry_name, **command_params
-                )  # "scan" folder contents
-
-                xsocsh5f.set_beam_energy(energy, entry_name)
-                xsocsh5f.set_chan_per_deg(chan_per_deg, entry_name)
-                xsocsh5f.set_direct_beam(direct_beam, entry_name)
-                xsocsh5f.set_image_roi_offset([0, 0], entry_name)  # hardcoded for now
-
-                """
-                XsocsH5Base methods
-                --> make links to data and counters
-                """
-                xsocsh5f._set_scalar_data(f"{entry_name}/title", command)
-                xsocsh5f._set_scalar_data(f"{entry_name}/start_time", start_time)
-
-                for c in counters:
-                    if c == detector:
-                        xsocsh5f.add_file_link(
-                            f"{entry_name}/measurement/image/data",
-                            path_dset,
-                            f"{scan_num}/measurement/{c}",
-                        )
-                    else:
-                        xsocsh5f.add_file_link(
-                            f"{entry_name}/measurement/{c}",
-                            path_dset,
-                            f"{scan_num}/measurement/{c}",
-                        )
-                for p in positioners:
-                    pval = get_positioner(path_dset, scan_num, p)
-                    pw = p if p != "delta" else "del"
-
-                    try:
-                        xsocsh5f._set_array_data(
-                            f"{entry_name}/instrument/positioners/{pw}", pval
-                        )
-                    except ValueError:
-                        xsocsh5f._set_scalar_data(
-                            f"{entry_name}/instrument/positioners/{pw}", pval
-                        )
-                    except AttributeError:  # failed pos
-                        pass
-
-                for pp in pi_positioners:
-                    try:
-                        new_c = pi_motor_names[pp]
-                        xsocsh5f.add_file_link(
-                            f"{entry_name}/measurement/{new_c}",
-                            path_dset,
-                            f"{scan_num}/instrument/{pp}/value",
-                        )
-                    except KeyError:
-                        try:
-                            new_c = pi_motor_names_new[pp]
-                            xsocsh5f.add_file_link(
-                                f"{entry_name}/measurement/{new_c}",
-                                path_dset,
-                                f"{scan_num}/instrument/{pp}/value",
-                            )
-                        except KeyError:
-                            pass
-
-                _imgnr = np.arange(entry[f"measurement/{detector}"].shape[0])
-                xsocsh5f._set_array_data(f"{entry_name}/measurement/imgnr", _imgnr)
+            if entry_name in linked and os.path.isfile(out_h5f):
+                continue
 
-                xsocsh5f.add_file_link(
-                    f"{entry_name}/technique", path_dset, f"{scan_num}/technique"
+            params = _read_xsocs_link_params(h5f, scan_num, command, detector)
+            args.append((out_h5f, entry_name, params))
+
+            # print
+            print(f"\r> Reading # {scan_num}/{scan_nums[-1]}", flush=True, end=" ")
+
+    print(f"\n> Linking {len(args)} scans")
+    pfun = partial(_write_xsocs_link_file, path_dset, detector)
+    with mp.Pool(processes=n_proc) as p:
+        for _ in tqdm(p.imap_unordered(pfun, args), total=len(args)):
+            pass
+
+    # write links to XSOCS master file
+    with XsocsH5.XsocsH5MasterWriter(out_h5f_master, "a") as master:
+        for out_h5f, entry_name, _ in args:
+            if entry_name in linked:  # file of an existing entry was missing
+                continue
+            master.add_entry_file(entry_name, os.path.basename(out_h5f))
+
+    print("\n> Done!\n")
+
+
+def _read_vds_sources(path_dset, scan_nums, detector):
+    """
+    Return, for each SXDM scan of the BLISS dataset `path_dset` selected as in
+    `make_xsocs_links`, the file and path of its detector dataset, its shape and
+    dtype and the (slow, fast) shape of its map.
+    """
+    sources = []
+    with h5py.File(path_dset, "r") as h5f:
+        scan_nums, commands = _select_sxdm_scans(h5f, scan_nums)
+
+        detector = _select_detector(h5f, scan_nums[0], detector)
+
+        for scan_num, command in zip(scan_nums, commands):
+            params = parse_scan_command(command)
+            map_shape = int(params["motor_1_steps"]), int(params["motor_0_steps"])
+
+            # resolve the external links to the scan files
+            dset = h5f[f"{scan_num}/instrument/{detector}/data"]
+            sources.append(
+                dict(
+                    path_dset=path_dset,
+                    scan_num=scan_num,
+                    filename=os.path.abspath(dset.file.filename),
+                    path_in_h5=dset.name,
+                    shape=dset.shape,
+                    dtype=dset.dtype,
+                    map_shape=map_shape,
                 )
+            )
 
-            # write links to XSOCS master file
-            with XsocsH5.XsocsH5MasterWriter(out_h5f_master, "a") as master:
-                master.add_entry_file(entry_name, os.path.basename(out_h5f))
+    return sources, detector
 
-            # print
-            print(f"\r> Linking # {scan_num}/{scan_nums[-1]}", flush=True, end=" ")
 
-        print("\n> Done!\n")
+def make_sxdm_vds(path_dset, path_out, scan_nums=None, detector=None):
+    """
+    Write an HDF5 virtual dataset of shape (n_scans, n_slow, n_fast, det_y, det_x)
+    stacking the detector frames of the SXDM scans of one or several BLISS
+    datasets, so that the frames of all scans can be sliced with a single read,
+    e.g. the rocking curve of a sample position with ``frames[:, i, j]``.
+
+    No frames are copied: the virtual dataset refers to the
+    ``{scan}/instrument/{detector}/data`` datasets of the scan files, relative to
+    the directory of `path_out`. Missing frames of interrupted scans read as 0.
+
+    Parameters
+    ----------
+    path_dset : str or list of str
+        Path to the .h5 dataset file, or list of paths to stitch several datasets.
+    path_out : str
+        Path to the output .h5 file, overwritten if it exists.
+    scan_nums : list, optional
+        Scan numbers to include, selected as in `make_xsocs_links`. If `path_dset`
+        is a list, a list with the scan numbers of each dataset (or None).
+        Defaults to all the SXDM scans.
+    detector : str, optional
+        The name of the detector used to collect the data.
+
+    Returns
+    -------
+    shape : tuple
+        The shape of the virtual dataset, `Data/frames` in `path_out`. The
+        dataset and scan number of each of its scans are stored in
+        `Data/datasets` and `Data/scan_nums`.
+    """
+    if isinstance(path_dset, str):
+        path_dset, scan_nums = [path_dset], [scan_nums]
+    elif scan_nums is None:
+        scan_nums = [None] * len(path_dset)
+    if len(scan_nums) != len(path_dset):
+        raise ValueError("scan_nums must hold the scan numbers of each dataset")
+
+    sources = []
+    for dset, scannos in zip(path_dset, scan_nums):
+        dset_sources, detector = _read_vds_sources(dset, scannos, detector)
+        sources += dset_sources
+    if len(sources) == 0:
+        raise ValueError("No SXDM scan selected")
+
+    map_shape, det_shape = sources[0]["map_shape"], sources[0]["shape"][1:]
+    for src in sources:
+        if src["map_shape"] != map_shape or src["shape"][1:] != det_shape:
+            raise ValueError(
+                f"Scan {src['scan_num']} of {src['path_dset']} does not have the "
+                f"map shape {map_shape} and frame shape {det_shape} of the first scan"
+            )
+
+    shape = (len(sources), *map_shape, *det_shape)
+    layout = h5py.VirtualLayout(shape=shape, dtype=sources[0]["dtype"])
+    dirname = os.path.dirname(os.path.abspath(path_out))
+    n_fast = map_shape[1]
+    for i, src in enumerate(sources):
+        n_frames = min(src["shape"][0], np.prod(map_shape))
+        vsource = h5py.VirtualSource(
+            os.path.relpath(src["filename"], dirname),
+            src["path_in_h5"],
+            shape=src["shape"],
+        )
+
+        # whole rows of the map, then the last incomplete one
+        n_rows, n_last = divmod(n_frames, n_fast)
+        if n_rows > 0:
+            layout[i, :n_rows] = vsource[: n_rows * n_fast]
+        if n_last > 0:
+            layout[i, n_rows, :n_last] = vsource[n_rows * n_fast : n_frames]
+
+    with h5py.File(path_out, "w") as h5f:
+        frames = h5f.create_virtual_dataset("Data/frames", layout, fillvalue=0)
+        frames.attrs["detector"] = detector
+        h5f["Data/datasets"] = [os.path.abspath(s["path_dset"]) for s in sources]
+        h5f["Data/scan_nums"] = [s["scan_num"] for s in sources]
+
+    print(f"> Wrote virtual dataset of shape {shape} to {path_out}")
+
+    return shape
 
 
 def make_xsocs_links_stitch(
@@ -391,7 +580,15 @@ def make_xsocs_links_stitch(
     path_out,
     name_outh5,
     detector=None,
+    path_vds=None,
 ):
+    """
+    Generates a single set of XSOCS-compatible .h5 files linking the scans of
+    several 3D-SXDM datasets, see `make_xsocs_links`.
+
+    If `path_vds` is given, the virtual dataset of the frames of all these scans
+    written by `make_sxdm_vds` is also saved there.
+    """
     if not os.path.isdir(path_out):
         os.mkdir(path_out)
 
@@ -412,17 +609,27 @@ def make_xsocs_links_stitch(
         )
         scan_counter += int(scannos[-1].split(".")[0])
 
+    if path_vds is not None:
+        make_sxdm_vds(dset_path_list, path_vds, scan_nums_list, detector)
+
 
 def get_qspace_proj(path_qspace, dir_idx, rec_ax, qspace_roi=None, bin_norm=False):
+    """
+    Return the projection onto `rec_ax` ('qx', 'qy' or 'qz') of the q-space
+    intensity at the (flattened) sample position `dir_idx`.
+
+    `path_qspace` is either the path to the q-space file or a `QSpaceReader`, to
+    be preferred when projecting many positions as it keeps the file open and
+    caches the volumes and projections read.
+    """
     rec_ax_idx = {"qx": 0, "qy": 1, "qz": 2}
     rec_idx = rec_ax_idx[rec_ax]
+    bin_norm = bin_norm is not False
 
-    if qspace_roi is None:
-        qspace_roi = np.s_[:, :, :]
+    if isinstance(path_qspace, QSpaceReader):
+        return path_qspace.projections(dir_idx, qspace_roi, bin_norm)[rec_idx]
 
-    with h5py.File(path_qspace, "r") as h5f:
-        local_qspace = h5f["Data/qspace"][dir_idx, ...][qspace_roi]
-        histo = h5f["Data/histo"][qspace_roi] if bin_norm is not False else None
-        proj = project(local_qspace, hits=histo)[rec_idx]
+    with QSpaceReader(path_qspace, cache_size=0) as reader:
+        proj = reader.projections(dir_idx, qspace_roi, bin_norm)[rec_idx]
 
     return proj
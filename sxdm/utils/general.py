@@ -5,42 +5,138 @@ Various functions to aid the analysis of SXDM data.
 import numpy as np
 import pandas as pd
 import os
+import json
+import warnings
+import multiprocessing as mp
 import xrayutilities as xu
 
 from skimage import registration
+from scipy import fft
 from scipy.ndimage import median_filter, shift
 from tqdm.notebook import tqdm
 
-from ..io.spec import FastSpecFile
-from ..io.bliss import ioh5, get_roidata
+from ..io.spec import read_spec_headers
+from ..io.bliss import ioh5, get_counters_sxdm
+from ..io.xsocs import get_qspace_axes
 
 from id01lib.xrd.geometries import ID01psic
 
+# version of the get_filelist catalog format
+_CATALOG_VERSION = 1
+
 
 @ioh5
 def get_qspace_coords(h5f):
-    return [h5f[f"Data/{x}"][...] for x in "qx,qy,qz".split(",")]
+    return [h5f[f"Data/{x}"][...] for x in get_qspace_axes(h5f)]
 
 
-def get_filelist(sample_dir):
+def _read_catalog_entry(path):
     """
-    SPEC.
+    Return the `get_filelist` catalog entry of the SPEC file `path`.
     """
-    data = {"path": [], "filename": [], "nscans": []}
+    stat = os.stat(path)
+    return dict(mtime=stat.st_mtime, size=stat.st_size, **read_spec_headers(path))
 
-    for root, _, files in os.walk(sample_dir):
-        files = [x for x in files if all(s in x for s in "spec,fast".split(","))]
-        if len(files) != 0:
-            for i, f in enumerate(files):
-                path = os.path.abspath("{}/{}".format(root, f))
 
-                fsf = FastSpecFile(path)
+def get_filelist(sample_dir, cache=True, cache_path=None, n_proc=None):
+    """
+    List the SPEC fast files (``*fast*.spec``) in `sample_dir` and its
+    subdirectories, along with the headers of their scans.
+
+    Only the scan headers are read, in parallel. If `cache` is True they are
+    stored in a JSON catalog, so that later calls only read the files that were
+    added or modified (different size or modification time) since.
+
+    Parameters
+    ----------
+    sample_dir : str
+        Path to the directory to look into.
+    cache : bool, optional
+        Use and update the catalog. Default is True.
+    cache_path : str, optional
+        Path to the catalog. Defaults to `_spec_catalog.json` in `sample_dir`.
+    n_proc : int, optional
+        Number of processes to spawn. Defaults to the number of logical cores.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per file, sorted by filename, with columns path, filename,
+        nscans, mtime, keys, commands, dates and shapes (lists with one item per
+        scan, see `sxdm.io.spec.read_spec_headers`).
+    """
 
-                data["path"].append(path)
-                data["filename"].append(f)
-                data["nscans"].append(len(fsf.keys()))
+    if cache_path is None:
+        cache_path = os.path.join(sample_dir, "_spec_catalog.json")
+    if n_proc is None:
+        n_proc = os.cpu_count()
 
-    data = pd.DataFrame(data, columns=["path", "filename", "nscans"])
+    paths = []
+    for root, _, files in os.walk(sample_dir):
+        files = [x for x in files if all(s in x for s in "spec,fast".split(","))]
+        paths += [os.path.abspath("{}/{}".format(root, f)) for f in files]
+
+    catalog = {}
+    if cache and os.path.isfile(cache_path):
+        try:
+            with open(cache_path) as f:
+                stored = json.load(f)
+            if stored.get("version") == _CATALOG_VERSION:
+                catalog = stored["files"]
+        except (OSError, ValueError) as err:
+            warnings.warn(f"Could not read the SPEC catalog {cache_path}: {err}")
+
+    # (re)read the new and modified files only
+    stale = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = catalog.get(path, {})
+        if (entry.get("mtime"), entry.get("size")) != (stat.st_mtime, stat.st_size):
+            stale.append(path)
+
+    if len(stale) > 1 and n_proc > 1:
+        with mp.Pool(min(n_proc, len(stale))) as p:
+            entries = p.map(_read_catalog_entry, stale)
+    else:
+        entries = [_read_catalog_entry(path) for path in stale]
+
+    n_cached = len(catalog)
+    catalog.update(zip(stale, entries))
+    catalog = {path: catalog[path] for path in paths}  # drop deleted files
+
+    if cache and (len(stale) > 0 or len(catalog) != n_cached):
+        try:
+            with open(f"{cache_path}.tmp", "w") as f:
+                json.dump(dict(version=_CATALOG_VERSION, files=catalog), f)
+            os.replace(f"{cache_path}.tmp", cache_path)
+        except OSError as err:
+            warnings.warn(f"Could not write the SPEC catalog {cache_path}: {err}")
+
+    data = pd.DataFrame(
+        dict(
+            path=paths,
+            filename=[os.path.basename(p) for p in paths],
+            nscans=[catalog[p]["n_scans"] for p in paths],
+            mtime=[catalog[p]["mtime"] for p in paths],
+            keys=[catalog[p]["keys"] for p in paths],
+            commands=[catalog[p]["commands"] for p in paths],
+            dates=[catalog[p]["dates"] for p in paths],
+            shapes=[
+                [None if sh is None else tuple(sh) for sh in catalog[p]["shapes"]]
+                for p in paths
+            ],
+        ),
+        columns=[
+            "path",
+            "filename",
+            "nscans",
+            "mtime",
+            "keys",
+            "commands",
+            "dates",
+            "shapes",
+        ],
+    )
     data = data.sort_values("filename").reset_index(drop=True)
 
     return data
@@ -101,7 +197,8 @@ def get_shift_dset(
     log=False,
     med_filt=None,
     return_maps=False,
-    **xcorr_kwargs,
+    shift_method="fourier",
+    **shift_kwargs,
 ):
     """ "
     Estimate shift in a list of scans.
@@ -110,8 +207,9 @@ def get_shift_dset(
     ----------
     path_dset : str
         Path to dataset.h5 file.
-    roi : str
-        Name of the ROI (e.g. "mpx1x4_roi2").
+    roi : str or list of str
+        Name of the ROI (e.g. "mpx1x4_roi2"). If a list is given, the shifts are
+        estimated on the first ROI and applied to the maps of all of them.
     scan_nums : list of str
         List of scan numbers in x.1 form (e.g., ['1.1', '2.1'])
     log : bool, default=False
@@ -120,9 +218,12 @@ def get_shift_dset(
         Size of the median filter kernel in pixels. Default: None (no filter).
     return_maps : bool, default=False
         If set to True, return the list of raw and shifted maps as well.
-    **xcorr_kwargs : dict, optional
-        Extra arguments to `skimage.registration.phase_cross_correlation`, refer to
-        its documentation for a list of possible arguments.
+    shift_method : str, default="fourier"
+        How the shifts are applied to the maps, see `shift_maps`.
+    **shift_kwargs : dict, optional
+        Extra arguments to `get_shift` and from there to
+        `skimage.registration.phase_cross_correlation`, refer to their
+        documentation for a list of possible arguments.
 
     Returns
     -------
@@ -131,10 +232,10 @@ def get_shift_dset(
         and columns (second col).
     raw_maps : list of np.ndarray
         List of *raw* SXDM maps of the specified ROI sorted according to the scan list
-        provided as input.
+        provided as input. A dict of such lists keyed by ROI if `roi` is a list.
     shifted_maps : list of np.ndarray
         List of *shifted* SXDM maps of the specified ROI sorted according to the scan
-        list provided as input.
+        list provided as input. A dict of such lists keyed by ROI if `roi` is a list.
 
     Example
     -------
@@ -148,40 +249,265 @@ def get_shift_dset(
         )
     """
 
-    # raw ROIs
-    sxdm_raw = [get_roidata(path_dset, i, roi) for i in scan_nums]
+    rois = [roi] if isinstance(roi, str) else list(roi)
+
+    # raw ROIs, (n_rois, n_scans, rows, cols)
+    sxdm_raw = get_counters_sxdm(path_dset, scan_nums, rois)
     if log:
-        sxdm_raw = [np.log(map, where=(map > 0)) for map in sxdm_raw]
+        sxdm_raw = np.log(sxdm_raw, where=(sxdm_raw > 0), out=np.zeros_like(sxdm_raw))
 
     # shifts
-    shifts = get_shift(sxdm_raw, med_filt=med_filt, **xcorr_kwargs)
+    shifts = get_shift(sxdm_raw[0], med_filt=med_filt, **shift_kwargs)
+
+    if not return_maps:
+        return shifts
 
     # shifted ROIs
-    sxdm_shifted = []
-    for i in range(len(scan_nums)):
-        sxdm_sh = shift(sxdm_raw[i], shifts[i])
-        sxdm_shifted.append(sxdm_sh)
+    sxdm_shifted = [shift_maps(maps, shifts, method=shift_method) for maps in sxdm_raw]
 
-    if return_maps:
-        return shifts, sxdm_raw, sxdm_shifted
+    if isinstance(roi, str):
+        return shifts, list(sxdm_raw[0]), list(sxdm_shifted[0])
     else:
-        return shifts
+        return (
+            shifts,
+            {r: list(m) for r, m in zip(rois, sxdm_raw)},
+            {r: list(m) for r, m in zip(rois, sxdm_shifted)},
+        )
 
 
-def get_shift(images, med_filt=None, **xcorr_kwargs):
+def shift_maps(maps, shifts, method="fourier"):
     """
-    Calculate the cumulative shifts between consecutive images in a sequence.
+    Shift a stack of maps, each by its own (rows, columns) shift, in one go.
+
+    Parameters
+    ----------
+    maps : np.ndarray
+        Array of shape (n_maps, rows, columns).
+    shifts : np.ndarray
+        Array of shape (n_maps, 2), e.g. as returned by `get_shift`.
+    method : str, optional
+        One of:
+
+        - "fourier" (default): sub-pixel shift by a phase ramp applied to the FFT
+          of the whole stack, which is zero-padded so that nothing wraps around.
+        - "integer": shift by the rounded shifts.
+        - "spline": `scipy.ndimage.shift` of each map (cubic spline).
+
+        Pixels shifted in from outside the maps are 0.
+
+    Returns
+    -------
+    np.ndarray
+        The shifted maps, of the same shape as `maps`.
+    """
+
+    maps = np.asarray(maps, dtype="float64")
+    shifts = np.asarray(shifts, dtype="float64")
+    n_maps, ny, nx = maps.shape
+
+    if method == "spline":
+        return np.array([shift(m, s) for m, s in zip(maps, shifts)])
+
+    elif method == "integer":
+        shifts = np.round(shifts).astype(int)
+        rows = np.arange(ny)[None, :] - shifts[:, :1]
+        cols = np.arange(nx)[None, :] - shifts[:, 1:]
+        out = maps[
+            np.arange(n_maps)[:, None, None],
+            np.clip(rows, 0, ny - 1)[:, :, None],
+            np.clip(cols, 0, nx - 1)[:, None, :],
+        ]
+        valid = ((rows >= 0) & (rows < ny))[:, :, None]
+        valid = valid & ((cols >= 0) & (cols < nx))[:, None, :]
+        return np.where(valid, out, 0)
+
+    elif method == "fourier":
+        pad = np.ceil(np.abs(shifts).max(0)).astype(int) + 1
+        padded = np.pad(maps, ((0, 0), (0, pad[0]), (0, pad[1])))
+        fy = fft.fftfreq(padded.shape[1])[None, :]
+        fx = fft.rfftfreq(padded.shape[2])[None, :]
+        ramp_y = np.exp(-2j * np.pi * fy * shifts[:, :1])[:, :, None]
+        ramp_x = np.exp(-2j * np.pi * fx * shifts[:, 1:])[:, None, :]
+        out = fft.irfft2(fft.rfft2(padded) * ramp_y * ramp_x, padded.shape[1:])
+        return out[:, :ny, :nx]
+
+    else:
+        raise ValueError('Accepted methods: "fourier", "integer", "spline"')
+
+
+def _get_shift_pairs(n_images, pairs="consecutive", k=2, reference=0):
+    """
+    Return the (n_pairs, 2) array of the (reference, moving) image indexes to be
+    cross-correlated by `get_shift`. `pairs` is one of, or a list of,
+    "consecutive", "reference" and "nearest".
+    """
+    pairs = [pairs] if isinstance(pairs, str) else pairs
+
+    idx = []
+    for mode in pairs:
+        if mode == "consecutive":
+            idx += [(i - 1, i) for i in range(1, n_images)]
+        elif mode == "reference":
+            idx += [(reference, i) for i in range(n_images) if i != reference]
+        elif mode == "nearest":
+            idx += [
+                (i, j)
+                for i in range(n_images)
+                for j in range(i + 1, min(i + k + 1, n_images))
+            ]
+        else:
+            raise ValueError('Accepted pairs: "consecutive", "reference", "nearest"')
+
+    return np.unique(np.array(idx, dtype=int).reshape(-1, 2), axis=0)
+
+
+def _upsampled_dft(data, region_size, upsample_factor, offsets):
+    """
+    Batched version of `skimage.registration._phase_cross_correlation._upsampled_dft`:
+    upsampled inverse DFT of each (ny, nx) array of `data` in a region of
+    `region_size` x `region_size` pixels starting at the (n, 2) `offsets`.
+    """
+    ny, nx = data.shape[1:]
+    kernels = [
+        np.exp(
+            -2j
+            * np.pi
+            * (np.arange(region_size)[None, :, None] - off[:, None, None])
+            * np.fft.fftfreq(n_items, upsample_factor)[None, None, :]
+        )
+        for n_items, off in zip((ny, nx), offsets.T)
+    ]
+
+    return kernels[0] @ (data @ kernels[1].transpose(0, 2, 1))
+
+
+def _full_spectrum(half, nx):
+    """
+    Return the full 2D FFTs of real images from their `half` spectra (`fft.rfft2`)
+    of `nx` columns.
+    """
+    ny = half.shape[-2]
+    cols = np.arange(half.shape[-1], nx)
+    mirror = half[:, (-np.arange(ny)) % ny][:, :, nx - cols].conj()
+
+    return np.concatenate([half, mirror], axis=-1)
+
+
+def _xcorr_pairs(freqs, pairs, nx, upsample_factor=1, normalization="phase", n_proc=-1):
+    """
+    Cross-correlate the images of `nx` columns whose half 2D FFTs (`fft.rfft2`) are
+    `freqs` for each of the (reference, moving) `pairs`, as
+    `registration.phase_cross_correlation` does. Returns the shifts registering
+    each moving image onto its reference and the correlation peak of each pair,
+    normalised to 1 for identical images.
+    """
+    n_img, ny = freqs.shape[:2]
+    shape = np.array((ny, nx))
+    midpoint = np.trunc(shape / 2)
+
+    if normalization == "phase":
+        norms = np.ones(n_img)
+    elif normalization is None:
+        power = np.abs(freqs) ** 2
+        power[:, :, 1 : (nx + 1) // 2] *= 2  # columns mirrored by rfft2
+        norms = np.sqrt(power.sum((1, 2)) / (ny * nx))
+    else:
+        raise ValueError("normalization must be either phase or None")
+
+    # cross power spectra are computed in batches of ~16 MB
+    batch = max(1, int(2**24 / (8 * ny * nx)))
+    pair_shifts, peaks = [], []
+    for b0 in range(0, len(pairs), batch):
+        ia, ib = pairs[b0 : b0 + batch].T
+        product = freqs[ia] * freqs[ib].conj()
+        if normalization == "phase":
+            eps = np.finfo(product.real.dtype).eps
+            product /= np.maximum(np.abs(product), 100 * eps)
+        xcorr = fft.irfft2(product, (ny, nx), workers=n_proc)
+        xcorr = np.abs(xcorr).reshape(len(ia), -1)
+
+        maxima = xcorr.argmax(1)
+        peak = xcorr[np.arange(len(ia)), maxima]
+        pair_shift = np.stack(np.unravel_index(maxima, (ny, nx)), axis=1).astype(float)
+        pair_shift = np.where(pair_shift > midpoint, pair_shift - shape, pair_shift)
+
+        # refine around the integer peak with a matrix multiply DFT
+        if upsample_factor > 1:
+            pair_shift = np.round(pair_shift * upsample_factor) / upsample_factor
+            region_size = np.ceil(upsample_factor * 1.5)
+            dftshift = np.trunc(region_size / 2.0)
+            xcorr = np.abs(
+                _upsampled_dft(
+                    _full_spectrum(product, nx).conj(),
+                    int(region_size),
+                    upsample_factor,
+                    dftshift - pair_shift * upsample_factor,
+                )
+            ).reshape(len(ia), -1)
+            maxima = xcorr.argmax(1)
+            peak = xcorr[np.arange(len(ia)), maxima] / (ny * nx)
+            maxima = np.stack(np.unravel_index(maxima, (int(region_size),) * 2), 1)
+            pair_shift += (maxima - dftshift) / upsample_factor
+
+        pair_shifts.append(pair_shift)
+        peaks.append(peak / (norms[ia] * norms[ib]))
+
+    return np.concatenate(pair_shifts), np.concatenate(peaks)
+
+
+def get_shift(
+    images,
+    med_filt=None,
+    pairs="consecutive",
+    k=2,
+    reference=0,
+    weighted=True,
+    n_proc=None,
+    upsample_factor=1,
+    normalization="phase",
+    **xcorr_kwargs,
+):
+    """
+    Calculate the shifts registering a sequence of images onto the first one.
+
+    The images are Fourier transformed once, then cross-correlated in batches for
+    all the chosen `pairs`. The shifts are the least-squares solution of the
+    system formed by all the measured pairwise shifts, weighted by their
+    correlation peak. With `pairs="consecutive"` this is the cumulative sum of the
+    shifts between consecutive images; adding redundant pairs (e.g.
+    `pairs="nearest"`) averages out the errors that otherwise drift along long
+    series.
 
     Parameters
     ----------
     images : List[np.ndarray]
         A list of 2D arrays representing consecutive images.
-    med_filt : int, optional
+    med_filt : int or tuple of int, optional
         The size of the median filter to be applied to each image before
         cross-correlation. If None, no median filter is applied. Default is None.
+    pairs : str or list of str, optional
+        The image pairs to cross-correlate, any of "consecutive" (each image with
+        the previous one), "reference" (each image with `reference`) and "nearest"
+        (each image with its `k` next ones). Default is "consecutive".
+    k : int, optional
+        Number of neighbours of each image for `pairs="nearest"`. Default is 2.
+    reference : int, optional
+        Index of the reference image for `pairs="reference"`. Default is 0.
+    weighted : bool, optional
+        Weight each pair by its correlation peak in the least-squares solution.
+        Default is True.
+    n_proc : int, optional
+        Number of threads used by the FFTs. Defaults to the number of logical
+        cores.
+    upsample_factor : int, optional
+        Images are registered to within 1 / `upsample_factor` of a pixel. Default
+        is 1 (whole pixels).
+    normalization : str or None, optional
+        Either "phase" (default, phase correlation) or None (cross-correlation).
     **xcorr_kwargs : dict
         Additional keyword arguments to be passed to
-        `registration.phase_cross_correlation`.
+        `registration.phase_cross_correlation`, which then computes each pair
+        instead of the batched engine.
 
     Returns
     -------
@@ -191,16 +517,47 @@ def get_shift(images, med_filt=None, **xcorr_kwargs):
         Column 0 corresponds to y-shifts, and column 1 corresponds to x-shifts.
     """
 
-    shifts = []
-    shifts.insert(0, np.array([0, 0]))
-    for i in tqdm(range(1, len(images))):
-        if med_filt is not None:
-            p, n = [median_filter(s, med_filt) for s in (images[i - 1], images[i])]
-        else:
-            p, n = [s for s in (images[i - 1], images[i])]
-        sh, _, _ = registration.phase_cross_correlation(p, n, **xcorr_kwargs)
-        shifts.append(sh + shifts[i - 1])
-    shifts = np.array(shifts)  # col0: y shifts. col1: x shifts
+    images = np.asarray(images, dtype="float64")
+    n_images = images.shape[0]
+    if n_proc is None:
+        n_proc = os.cpu_count()
+
+    if med_filt is not None:
+        images = median_filter(images, (1, *np.broadcast_to(med_filt, 2)))
+
+    idx_pairs = _get_shift_pairs(n_images, pairs, k, reference)
+    if len(idx_pairs) == 0:
+        return np.zeros((n_images, 2))
+
+    if xcorr_kwargs:
+        pair_shifts = np.array(
+            [
+                registration.phase_cross_correlation(
+                    images[a],
+                    images[b],
+                    upsample_factor=upsample_factor,
+                    normalization=normalization,
+                    **xcorr_kwargs,
+                )[0]
+                for a, b in tqdm(idx_pairs)
+            ]
+        )
+        peaks = np.ones(len(idx_pairs))
+    else:
+        freqs = fft.rfft2(images, workers=n_proc)
+        pair_shifts, peaks = _xcorr_pairs(
+            freqs, idx_pairs, images.shape[2], upsample_factor, normalization, n_proc
+        )
+
+    # shift[b] - shift[a] = pair shift, with the first image as origin
+    design = np.zeros((len(idx_pairs), n_images))
+    design[np.arange(len(idx_pairs)), idx_pairs[:, 1]] = 1
+    design[np.arange(len(idx_pairs)), idx_pairs[:, 0]] -= 1
+    w = np.sqrt(peaks)[:, None] if weighted else np.ones((len(idx_pairs), 1))
+    sol = np.linalg.lstsq(design[:, 1:] * w, pair_shifts * w, rcond=None)[0]
+
+    shifts = np.zeros((n_images, 2))  # col0: y shifts. col1: x shifts
+    shifts[1:] = sol
 
     return shifts
 
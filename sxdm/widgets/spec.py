@@ -38,6 +38,7 @@ class RoiPlotter(object):
         self.detector = detector
         self.fsf = fast_spec_file
         self.pscan = self.fsf[0]
+        self._pscans = {0: self.pscan}  # scans are parsed once
         self.motors = self.pscan.motor_names
         self.rois, self.roi_init = get_detector_roilist(self.pscan, detector)
 
@@ -221,7 +222,9 @@ class RoiPlotter(object):
     # updates the images
     def _update_pscan(self, change):
         scan_idx = change["new"]
-        self.pscan = self.fsf[scan_idx]
+        if scan_idx not in self._pscans:
+            self._pscans[scan_idx] = self.fsf[scan_idx]
+        self.pscan = self._pscans[scan_idx]
 
         _ = [
             self._update_roi({"new": x.value, "owner": x})
@@ -279,9 +282,12 @@ class RoiPlotter(object):
 
 
 class FramesExplorer(object):
-    def __init__(self, pscan, detector="maxipix", coms=None, img_dir=None):
+    def __init__(self, pscan, detector="maxipix", coms=None, img_dir=None, lazy=False):
         """
         TODO!
+
+        With `lazy=True` the frames are not loaded to memory but decompressed from
+        the .edf.gz file when displayed.
         """
 
         ## init variables
@@ -291,13 +297,12 @@ class FramesExplorer(object):
         try:
             self.frames = pscan.frames
         except AttributeError:
-            self.frames = pscan.get_detector_frames(img_dir=img_dir)
+            self.frames = pscan.get_detector_frames(img_dir=img_dir, lazy=lazy)
 
-        self.frames = self.frames.reshape(*pscan.shape, *self.frames.shape[1:])
         self.rois, self.roi_init = get_detector_roilist(pscan, detector)
         self.m1, self.m2 = pscan.get_piezo_coordinates()
         self.row, self.col = 0, 0
-        self.roi_idxs = np.s_[:, :]
+        self.roi_idxs = np.s_[:]
         self.newroi = None
 
         # init figure widget
@@ -310,7 +315,7 @@ class FramesExplorer(object):
         # populate axes with images
         self.imgroi = self.axs[0].imshow(pscan.get_roidata(self.roi_init))
         self.imgframe = self.axs[1].imshow(
-            self.frames[self.row, self.col, ...], cmap="magma"
+            self._get_frame(self.row, self.col), cmap="magma"
         )
 
         # init cursor pos on imgroi
@@ -387,6 +392,10 @@ class FramesExplorer(object):
 
         display(ipw.VBox([self.widgets, self.figout]))
 
+    def _get_frame(self, row, col):
+        # frames are stored flat, i.e. (n_points, rows, columns)
+        return self.frames[int(np.ravel_multi_index((row, col), self.pscan.shape))]
+
     def _line_select_callback(self, eclick, erelease):
         x, y = self.makeroi.corners
         x = [int(np.round(m, 0)) for m in x]
@@ -395,8 +404,10 @@ class FramesExplorer(object):
         col0, col1 = x[0], x[1]
         row0, row1 = y[0], y[-1]
 
-        self.roi_idxs = np.s_[:, :, row0:row1, col0:col1]
-        self.roidata_new = self.frames[self.roi_idxs].sum(axis=(2, 3))
+        self.roi_idxs = np.s_[:, row0:row1, col0:col1]
+        self.roidata_new = (
+            self.frames[self.roi_idxs].sum(axis=(1, 2)).reshape(self.pscan.shape)
+        )
         self.imgroi.axes.set_title(
             "custom: {}:{}, {}:{}".format(row0, row1, col0, col1)
         )
@@ -414,7 +425,7 @@ class FramesExplorer(object):
 
     def _update_plots(self):
         with self.figout:
-            _frame = self.frames[self.row, self.col, ...]
+            _frame = self._get_frame(self.row, self.col)
             self.imgframe.set_data(_frame)
             self._update_norm({"new": self.iflog.value})  # updates also clim
 
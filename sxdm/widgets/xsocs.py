@@ -1,4 +1,3 @@
-import h5py
 import ipywidgets as ipw
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -7,8 +6,8 @@ import numpy as np
 from IPython.display import display
 
 from ..plot.utils import add_colorbar
-from ..utils import get_qspace_coords, get_q_extents
-from ..utils.bliss import get_qspace_proj
+from ..utils import get_q_extents
+from ..io.xsocs import QSpaceReader
 
 from silx.math import fit
 from xsocs.util import gaussian
@@ -63,10 +62,10 @@ class Inspect5DQspace(object):
         self._figout = ipw.Output(layout=dict(border="1px solid grey"))
         self._init_darr = maps_dict[self.init_map_name]
         self.row, self.col = init_idx
-        self._h5f = path_qspace
+        self._reader = QSpaceReader(path_qspace)
         self._proj = projections
         self.maps_dict = maps_dict
-        self.qx, self.qy, self.qz = get_qspace_coords(path_qspace)
+        self.qx, self.qy, self.qz = self._reader.qx, self._reader.qy, self._reader.qz
         self.roi = qspace_roi
         self.relim_int = relim_int
         self.coms = coms
@@ -120,18 +119,17 @@ class Inspect5DQspace(object):
     def _get_rsm(self):
         row, col = self.row, self.col
 
-        with h5py.File(self._h5f, "r") as h5f:
-            idx = row * self._init_darr.shape[1] + col
-            if np.ma.is_masked(self._init_darr):
-                idx_allowed = np.where(~self._init_darr.mask.ravel())[0]
-            else:
-                idx_allowed = np.arange(self._init_darr.size)
-
-            rsm = np.ma.masked_array(
-                data=h5f["/Data/qspace"][idx], mask=self.mask_reciprocal
-            )[self.roi]
-            if idx not in idx_allowed:
-                rsm = np.ones_like(rsm)
+        idx = row * self._init_darr.shape[1] + col
+        if np.ma.is_masked(self._init_darr):
+            idx_allowed = np.where(~self._init_darr.mask.ravel())[0]
+        else:
+            idx_allowed = np.arange(self._init_darr.size)
+
+        rsm = np.ma.masked_array(
+            data=self._reader.volume(idx), mask=self.mask_reciprocal
+        )[self.roi]
+        if idx not in idx_allowed:
+            rsm = np.ones_like(rsm)
         self.selected_idx = idx
         with self._figout:
             print(f"\r{(row, col)} --> {idx}", end="", flush=True)
@@ -188,14 +186,8 @@ class Inspect5DQspace(object):
                 for i in range(3)
             ]
 
-            for i in range(3):
-                proj = get_qspace_proj(
-                    self._h5f,
-                    idx,
-                    self.rec_ax_idx[i],
-                    self.roi,
-                    bin_norm=self.xsocs_gauss,
-                )
+            projs = self._reader.projections(idx, self.roi, self.xsocs_gauss)
+            for i, proj in enumerate(projs):
                 (line_exp,) = ax[i + 1].plot(self.qcoords[i], proj, marker="o", mfc="w")
                 self.projs.append(line_exp)
 
@@ -215,6 +207,7 @@ class Inspect5DQspace(object):
 
         self.fig.canvas.mpl_connect("button_press_event", self._onclick)
         self.fig.canvas.mpl_connect("key_press_event", self._onkey)
+        self.fig.canvas.mpl_connect("close_event", lambda event: self._reader.close())
 
     def _change_plot(self, change):
         darr = self.maps_dict[self._select_plot.value]
@@ -274,14 +267,8 @@ class Inspect5DQspace(object):
             idx = row * self._init_darr.shape[1] + col
             ax = self.ax.ravel()
 
-            for i in range(3):
-                proj = get_qspace_proj(
-                    self._h5f,
-                    idx,
-                    self.rec_ax_idx[i],
-                    self.roi,
-                    bin_norm=self.xsocs_gauss,
-                )
+            projs = self._reader.projections(idx, self.roi, self.xsocs_gauss)
+            for i, proj in enumerate(projs):
                 self.projs[i].set_ydata(proj)
 
                 if self.gauss_fits is not None:
@@ -306,3 +293,10 @@ class Inspect5DQspace(object):
         )
         gui = ipw.VBox([selector, self._figout])
         display(gui)
+
+    def close(self):
+        """
+        Close the figure and the q-space file.
+        """
+        plt.close(self.fig)
+        self._reader.close()
@@ -6,3 +6,550 @@ import sxdm
 def test_version():
     """Test package version."""
     assert sxdm.__version__ == "0.1.0"
+
+
+def test_get_shift():
+    """Test registration of a shifted image series."""
+    import numpy as np
+    from scipy.ndimage import gaussian_filter, shift
+
+    rng = np.random.default_rng(0)
+    image = gaussian_filter(rng.random((64, 64)), 3)
+    true = np.cumsum(rng.normal(0, 1, (10, 2)), axis=0)
+    true -= true[0]
+    images = [shift(image, t, mode="grid-wrap") for t in true]
+
+    shifts = sxdm.utils.get_shift(images, pairs="nearest", k=3, upsample_factor=10)
+    assert shifts.shape == (10, 2)
+    assert np.allclose(shifts, -true, atol=0.2)
+
+
+def test_shift_maps():
+    """Test batched shifts of a stack of maps."""
+    import numpy as np
+
+    rng = np.random.default_rng(0)
+    maps = rng.random((4, 20, 30))
+    shifts = np.array([[0, 0], [2, -3], [-1, 4], [5, 1]])
+
+    fourier = sxdm.utils.shift_maps(maps, shifts, method="fourier")
+    integer = sxdm.utils.shift_maps(maps, shifts, method="integer")
+    assert np.allclose(fourier, integer)
+    assert np.allclose(integer[1, 2:, :-3], maps[1, :-2, 3:])
+
+
+def test_get_filelist(tmp_path):
+    """Test the SPEC fast files catalog."""
+    lines = ["#F sample_fast_00001.spec", "#D Mon Jan 01 00:00:00 2024", ""]
+    for n in (1, 2, 2):
+        lines += [f"#S {n}  pscan pix 0 10 3 piy 0 10 4 0.01", "#D Tue", "#L a"]
+        lines += ["0"] * 12 + [""]
+    (tmp_path / "sample_fast_00001.spec").write_text("\n".join(lines))
+
+    for _ in range(2):  # parsed, then read from the catalog
+        data = sxdm.utils.get_filelist(str(tmp_path))
+        assert data.nscans.tolist() == [3]
+        assert data["keys"][0] == ["1.1", "2.1", "2.2"]
+        assert data.shapes[0] == [(4, 3)] * 3
+    assert (tmp_path / "_spec_catalog.json").is_file()
+
+
+def _write_edf_gz(path, frames):
+    """Write a stack of uint16 frames to a gzipped EDF file."""
+    import gzip
+
+    raw = b""
+    for frame in frames:
+        header = f"{{\nDim_1 = {frame.shape[1]} ;\nDim_2 = {frame.shape[0]} ;\n"
+        header += "DataType = UnsignedShort ;\nByteOrder = LowByteFirst ;\n"
+        header = header.ljust(510) + "}\n"
+        raw += header.encode() + frame.astype("<u2").tobytes()
+    path.write_bytes(gzip.compress(raw))
+
+
+def test_edf_frames(tmp_path):
+    """Test the lazy EDF frame reader on a multi-frame gzipped file."""
+    import numpy as np
+    from sxdm.io.edf import EdfFrames
+
+    frames = np.random.default_rng(0).integers(0, 1000, (20, 30, 40), dtype="u2")
+    path = tmp_path / "frames.edf.gz"
+    _write_edf_gz(path, frames)
+
+    edf = EdfFrames(str(path), spacing=2**14)
+    assert edf[13].tolist() == frames[13].tolist()
+    assert edf.shape == frames.shape
+    assert (edf[[15, 2, 7]] == frames[[15, 2, 7]]).all()
+    assert (edf[:, 5:10, 20:30] == frames[:, 5:10, 20:30]).all()
+
+    # frame table read from the index file
+    edf = EdfFrames(str(path))
+    assert edf._complete and (edf[-1] == frames[-1]).all()
+
+
+def test_transcode_edf(tmp_path):
+    """Test the EDF -> HDF5 transcoding of the frames of a pscan."""
+    import h5py
+    import numpy as np
+    from sxdm.io.spec import _transcode_edf
+
+    frames = np.random.default_rng(0).integers(0, 1000, (12, 30, 40), dtype="u2")
+    path_edf, path_h5 = tmp_path / "frames.edf.gz", str(tmp_path / "frames.h5")
+    _write_edf_gz(path_edf, frames)
+
+    counters = dict(mpx4int=np.arange(12.0))
+    args = (str(path_edf), path_h5, "1.1", "pscan", "today", counters)
+    _transcode_edf("maxipix", None, 2**12, args)
+
+    with h5py.File(path_h5, "r") as h5f:
+        dset = h5f["1.1/instrument/maxipix/data"]
+        assert dset.chunks == (1, 30, 40)
+        assert (dset[()] == frames).all()
+        assert (h5f["1.1/measurement/image"][()] == frames).all()
+        assert (h5f["1.1/measurement/mpx4int"][()] == counters["mpx4int"]).all()
+
+
+def test_calc_coms():
+    """Test the block-wise COMs and STDs of the frames of a pscan."""
+    from types import SimpleNamespace
+
+    import numpy as np
+    from sxdm.io.spec import PiezoScan
+
+    y, z = np.indices((40, 50))
+    cy, cz = np.meshgrid(np.linspace(10, 30, 3), np.linspace(15, 35, 4), indexing="ij")
+    frames = np.stack(
+        [np.exp(-((y - a) ** 2 + (z - b) ** 2) / 8) for a, b in zip(cy.flat, cz.flat)]
+    )
+    pscan = SimpleNamespace(shape=(3, 4), frames=frames)
+
+    coms_y, coms_z, std_y, std_z = PiezoScan.calc_coms(
+        pscan, calc_std=True, block_size=frames[0].nbytes * 5
+    )
+    assert np.allclose(coms_y, cy.T) and np.allclose(coms_z, cz.T)
+    assert np.allclose(std_y, 2, atol=1e-3) and np.allclose(std_z, 2, atol=1e-3)
+
+
+def test_fit_gaussian_map():
+    """Test the Gaussian fits of the frame projections of a whole pscan."""
+    import numpy as np
+    from sxdm.io.spec import PiezoScan
+
+    class Scan:
+        _get_projection_axes = PiezoScan._get_projection_axes
+        _calc_projections = PiezoScan._calc_projections
+        fit_gaussian_map = PiezoScan.fit_gaussian_map
+
+    y, z = np.indices((50, 60))
+    cy, cz = np.linspace(15, 35, 6), np.linspace(20, 40, 6)
+    pscan = Scan()
+    pscan.shape = (2, 3)
+    pscan.frames = np.stack(
+        [1e3 * np.exp(-((y - a) ** 2 + (z - b) ** 2) / 18) for a, b in zip(cy, cz)]
+    )
+    pscan.qy, pscan.qz = np.meshgrid(np.arange(60.0), np.arange(50.0))
+
+    fits = pscan.fit_gaussian_map(n_proc=1)
+    assert fits["qy"].shape == fits["qz"].shape == (3, 2, 3)
+    assert np.allclose(fits["qy"][1].ravel(), cz, atol=1e-3)
+    assert np.allclose(fits["qz"][1].ravel(), cy, atol=1e-3)
+    assert np.allclose(fits["qy"][2], 2 * np.sqrt(2 * np.log(2)) * 3, atol=1e-2)
+
+
+def test_counters_cache(tmp_path):
+    """Test the counters of a SPEC file cached in memory and in a .npz file."""
+    import numpy as np
+    from sxdm.io.spec import FastSpecFile
+
+    lines = ["#F sample_fast_00001.spec", "#D Mon Jan 01 00:00:00 2024", ""]
+    for n in (1, 2):
+        lines += [f"#S {n}  pscan pix 0 10 3 piy 0 10 2 0.01", "#D Tue"]
+        lines += ["#L adcX  adcY  mpx4int"]
+        lines += [f"{i} {i + 1} {n * i}" for i in range(6)] + [""]
+    path = tmp_path / "sample_fast_00001.spec"
+    path.write_text("\n".join(lines))
+    cache_path = str(tmp_path / "counters.npz")
+
+    for _ in range(2):  # parsed, then read from the .npz file
+        fsf = FastSpecFile(str(path), cache_path=cache_path)
+        assert list(fsf.get_counters()) == ["1.1", "2.1"]
+        pscan = fsf["2.1"]
+        assert (pscan.get_roidata("mpx4int") == 2 * np.arange(6).reshape(2, 3)).all()
+        assert (pscan.get_piezo_coordinates()[0] == np.arange(1, 7).reshape(2, 3)).all()
+
+
+def test_reduce_frames(tmp_path):
+    """Test the single-pass reductions of the frames of an interrupted pscan."""
+    import numpy as np
+    from sxdm.io.edf import EdfFrames
+    from sxdm.io.spec import PiezoScan
+
+    class Scan:
+        reduce_frames = PiezoScan.reduce_frames
+
+    frames = np.random.default_rng(0).integers(0, 1000, (10, 30, 40), dtype="u2")
+    path = tmp_path / "frames.edf.gz"
+    _write_edf_gz(path, frames)
+    pscan = Scan()
+    pscan.shape = (3, 4)
+    pscan.frames = EdfFrames(str(path))
+
+    res = pscan.reduce_frames(
+        rois={"roi1": [5, 25, 10, 20]}, coms=True, block_size=frames[0].nbytes * 12
+    )
+    assert np.allclose(res["frame_sum"], frames.sum(0))
+    roi1 = np.zeros(12)
+    roi1[:10] = frames[:, 10:20, 5:25].sum(axis=(1, 2))
+    assert np.allclose(res["rois"]["roi1"], roi1.reshape(3, 4))
+
+    y, z = np.indices(frames.shape[1:])
+    coms_y = (frames * y).sum(axis=(1, 2)) / frames.sum(axis=(1, 2))
+    assert np.allclose(res["coms"][0].T.ravel()[:10], coms_y)
+    assert np.isnan(res["coms"][0].T.ravel()[10:]).all()
+
+
+def test_qspace_coords_cache(tmp_path):
+    """Test the memoised q-space coordinates of pscans sharing a geometry."""
+    import numpy as np
+    from sxdm.io.spec import FastSpecFile, clear_qspace_coords_cache
+
+    lines = ["#F sample_fast_00001.spec", "#D Mon Jan 01 00:00:00 2024"]
+    lines += ["#O0 eta  del  phi  nu", ""]
+    for n, eta in ((1, 10), (2, 10), (3, 11)):
+        lines += [f"#S {n}  pscan pix 0 10 3 piy 0 10 2 0.01", "#D Tue"]
+        lines += [f"#P0 {eta} 30 0 1", "#L adcX  adcY  mpx4int"]
+        lines += [f"{i} {i} {i}" for i in range(6)] + [""]
+    path = tmp_path / "sample_fast_00001.spec"
+    path.write_text("\n".join(lines))
+
+    fsf = FastSpecFile(str(path))
+    kwargs = dict(cen_pix=(250, 260), detector_distance=0.5, energy=9000)
+    kwargs["cache_dir"] = str(tmp_path / "cache")
+    clear_qspace_coords_cache()
+    q1, q2, q3 = [fsf[i].calc_qspace_coordinates(**kwargs) for i in range(3)]
+    assert np.shares_memory(q1[0], q2[0])
+    assert not np.allclose(q1[0], q3[0])
+
+    clear_qspace_coords_cache()  # read from disk
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+    assert np.array_equal(fsf[0].calc_qspace_coordinates(**kwargs)[2], q1[2])
+
+
+def test_qspace_reader(tmp_path):
+    """Test the cached projections of a q-space file read position by position."""
+    import h5py
+    import numpy as np
+    from xsocs.util import project
+    from sxdm.io.xsocs import QSpaceReader
+    from sxdm.utils.bliss import get_qspace_proj
+
+    rng = np.random.default_rng(0)
+    qspace = rng.random((6, 5, 4, 3))
+    histo = rng.integers(0, 3, (5, 4, 3))
+    path = tmp_path / "qspace.h5"
+    with h5py.File(path, "w") as h5f:
+        h5f["Data/qspace"] = qspace
+        h5f["Data/histo"] = histo
+        for x, n in zip(("qx", "qy", "qz"), qspace.shape[1:]):
+            h5f[f"Data/{x}"] = np.linspace(0, 1, n)
+
+    roi = np.s_[1:4, :, 1:]
+    with QSpaceReader(str(path), cache_size=2) as reader:
+        projs = reader.projections(3, roi, bin_norm=True)
+        for p, ref in zip(projs, project(qspace[3][roi], hits=histo[roi])):
+            assert np.allclose(p, ref)
+        assert reader.projections(3, np.s_[1:4, :, 1:], bin_norm=True) is projs
+        assert np.array_equal(get_qspace_proj(reader, 3, "qy", roi, True), projs[1])
+        assert np.array_equal(get_qspace_proj(str(path), 3, "qy", roi, True), projs[1])
+
+        for i in range(3):
+            reader.volume(i)
+        assert list(reader._volumes) == [1, 2]
+        assert reader.qz.shape == (3,)
+
+    # spherical coordinates
+    with h5py.File(path, "a") as h5f:
+        for x, y in zip(("qx", "qy", "qz"), ("pitch", "roll", "radial")):
+            h5f.move(f"Data/{x}", f"Data/{y}")
+    with QSpaceReader(str(path)) as reader:
+        assert reader.axes == ("pitch", "roll", "radial")
+        assert reader.qx.shape == (5,)
+
+
+def test_sxdm_vds(tmp_path):
+    """Test the virtual dataset of the frames of the scans of two BLISS datasets."""
+    import h5py
+    import numpy as np
+    from sxdm.utils.bliss import make_sxdm_vds
+
+    rng = np.random.default_rng(0)
+    frames, paths = [], []
+    for d in range(2):
+        path = tmp_path / f"sample_000{d}.h5"
+        with h5py.File(path, "w") as h5f:
+            for s in (1, 2, 3):
+                # scan 2 is not an SXDM scan, scan 3 of dataset 1 is interrupted
+                cmd = (
+                    "ct( 0.1 )" if s == 2 else "sxdm( pix, 0, 1, 4, piy, 0, 1, 3, 0.1 )"
+                )
+                n = 10 if (d, s) == (1, 3) else 12
+                data = rng.integers(0, 100, (n, 5, 6))
+                path_scan = tmp_path / f"scan000{d}{s}.h5"
+                with h5py.File(path_scan, "w") as f:
+                    f[f"{s}.1/instrument/mpx1x4/data"] = data
+                    f[f"{s}.1/title"] = cmd.encode()
+                h5f[f"{s}.1"] = h5py.ExternalLink(path_scan.name, f"{s}.1")
+                if s != 2:
+                    frames.append(data)
+        paths.append(str(path))
+
+    path_vds = tmp_path / "vds" / "frames.h5"
+    path_vds.parent.mkdir()
+    shape = make_sxdm_vds(paths, str(path_vds), detector="mpx1x4")
+    assert shape == (4, 3, 4, 5, 6)
+
+    with h5py.File(path_vds, "r") as h5f:
+        vds = h5f["Data/frames"][...]
+        assert list(h5f["Data/scan_nums"].asstr()) == ["1.1", "3.1"] * 2
+    for i, data in enumerate(frames):
+        assert np.array_equal(vds[i].reshape(-1, 5, 6)[: len(data)], data)
+    assert (vds[3, 2, 2:] == 0).all()
+
+
+def test_animation_writer(tmp_path):
+    """Test the streaming GIF and APNG writers against the frames written."""
+    import numpy as np
+    from PIL import Image
+    from sxdm.plot.animation import AnimationWriter
+
+    y, x = np.mgrid[:40, :60]
+    frames = [
+        np.stack([(x * 4 + i * 10) % 256, y * 6, np.full_like(x, 128)], -1).astype("u1")
+        for i in range(12)
+    ]
+
+    for ext, tol in (("gif", 8), ("png", 0)):
+        path = str(tmp_path / f"anim.{ext}")
+        with AnimationWriter(path, duration=100, window=4) as writer:
+            for frame in frames:
+                writer.append(frame)
+
+        im = Image.open(path)
+        assert im.n_frames == len(frames)
+        for i, frame in enumerate(frames):
+            im.seek(i)
+            err = np.abs(np.asarray(im.convert("RGB"), dtype=int) - frame)
+            assert err.mean() <= tol
+
+
+def _write_xsocs_master(path_dir, n_scans, frames):
+    """
+    Write an XSOCS master file linking `n_scans` scans of the (n_scans, n_pos,
+    rows, cols) `frames`, rocking eta, and return its path.
+    """
+    import os
+    import numpy as np
+    from xsocs.io.XsocsH5 import XsocsH5Writer, XsocsH5MasterWriter
+
+    path_master = f"{path_dir}/sample_master.h5"
+    with XsocsH5MasterWriter(path_master, "w"):
+        pass
+    for i in range(n_scans):
+        entry = f"{i + 1}.1"
+        path_entry = f"{path_dir}/sample_{entry}.h5"
+        with XsocsH5Writer(path_entry, "w") as h5f:
+            h5f.create_entry(entry)
+            h5f.set_scan_params(entry, "pix", 0, 1, 3, "piy", 0, 1, 2, 0.1)
+            h5f.set_beam_energy(9000.0, entry)
+            h5f.set_chan_per_deg([100.0, 100.0], entry)
+            h5f.set_direct_beam([8.0, 8.0], entry)
+            h5f._set_array_data(f"{entry}/measurement/image/data", frames[i])
+            h5f._set_array_data(
+                f"{entry}/measurement/mpx1x4_int", frames[i].sum(axis=(1, 2))
+            )
+            for motor, pos in (("eta", 10 + 0.2 * i), ("del", 30), ("phi", 0)):
+                h5f._set_scalar_data(f"{entry}/instrument/positioners/{motor}", pos)
+            h5f._set_scalar_data(f"{entry}/instrument/positioners/nu", 0.0)
+            for motor in ("pix", "piy"):
+                pos = np.random.default_rng(i).random(frames.shape[1])
+                h5f._set_array_data(f"{entry}/instrument/positioners/{motor}", pos)
+        with XsocsH5MasterWriter(path_master, "a") as master:
+            master.add_entry_file(entry, os.path.basename(path_entry))
+
+    return path_master
+
+
+def test_grid_qspace(tmp_path):
+    """Test the gridded intensity and histogram against a direct histogram."""
+    import h5py
+    import numpy as np
+    from sxdm.process.qspace import grid_qspace
+    from sxdm.process.xsocs import get_qspace_vals_xsocs
+
+    frames = np.random.default_rng(0).integers(0, 100, (5, 6, 16, 16))
+    path_master = _write_xsocs_master(tmp_path, 5, frames.astype("float32"))
+    path_qspace = f"{tmp_path}/qspace.h5"
+    nbins = (6, 5, 4)
+    grid_qspace(
+        path_qspace, path_master, nbins, correct_mpx_gaps=False, n_proc=1, pbar=False
+    )
+
+    qs = get_qspace_vals_xsocs(path_master, sort_angles=False, verbose=False)
+    with h5py.File(path_qspace, "r") as h5f:
+        centers = [h5f[f"Data/{x}"][()] for x in ("qx", "qy", "qz")]
+        qspace, histo = h5f["Data/qspace"][()], h5f["Data/histo"][()]
+
+    edges = [np.linspace(c[0], c[-1], c.size) for c in centers]
+    edges = [np.append(e - (e[1] - e[0]) / 2, e[-1] + (e[1] - e[0]) / 2) for e in edges]
+    qspace_ref, histo_ref = np.zeros((6, *nbins)), np.zeros(nbins)
+    for i in range(5):
+        sample = np.stack([q[i, :16, :16].ravel() for q in qs], axis=1)
+        histo_ref += np.histogramdd(sample, edges)[0]
+        for idx in range(6):
+            weights = frames[i, idx].ravel()
+            qspace_ref[idx] += np.histogramdd(sample, edges, weights=weights)[0]
+
+    assert histo.sum() == 5 * 16 * 16  # the grid spans all the pixels
+    assert np.array_equal(histo, histo_ref)
+    assert np.allclose(qspace, qspace_ref)
+
+
+def test_grid_qspace_append(tmp_path):
+    """Test that appending scans to a q-space file matches gridding them all."""
+    import h5py
+    import numpy as np
+    import pytest
+    from sxdm.io.xsocs import get_qspace_avg, get_qspace_position
+    from sxdm.process.qspace import grid_qspace
+
+    frames = np.random.default_rng(0).integers(0, 100, (5, 6, 16, 16))
+    frames = frames.astype("float32")
+    kwargs = dict(nbins=(6, 5, 4), correct_mpx_gaps=False, n_proc=1, pbar=False)
+
+    # fix the q-space bins, otherwise computed from the scans already gridded
+    path_full = f"{tmp_path}/full.h5"
+    path_master = _write_xsocs_master(tmp_path, 5, frames)
+    grid_qspace(path_full, path_master, **kwargs)
+    with h5py.File(path_full, "r") as h5f:
+        kwargs["qspace_roi"] = [
+            h5f[f"Data/{q}"][[0, -1]].tolist() for q in "qx,qy,qz".split(",")
+        ]
+
+    for sparse in (False, True):
+        path_full = f"{tmp_path}/full_{sparse}.h5"
+        path_append = f"{tmp_path}/append_{sparse}.h5"
+        grid_qspace(path_full, path_master, sparse=sparse, **kwargs)
+
+        path_master = _write_xsocs_master(tmp_path, 3, frames)
+        grid_qspace(path_append, path_master, sparse=sparse, **kwargs)
+        path_master = _write_xsocs_master(tmp_path, 5, frames)
+        grid_qspace(path_append, path_master, sparse=sparse, append=True, **kwargs)
+
+        with h5py.File(path_full, "r") as h5f, h5py.File(path_append, "r") as h5a:
+            assert np.allclose(h5f["Data/histo"][()], h5a["Data/histo"][()])
+            selected = h5a["params/entries/selected"][()]
+            assert list(selected) == list(h5f["params/entries/selected"][()])
+            assert len(selected) == 5
+        for idx in range(6):
+            assert np.allclose(
+                get_qspace_position(path_full, idx),
+                get_qspace_position(path_append, idx),
+            )
+        assert np.allclose(get_qspace_avg(path_full, 1), get_qspace_avg(path_append, 1))
+
+        with pytest.raises(ValueError):
+            grid_qspace(path_append, path_master, sparse=sparse, append=True, **kwargs)
+
+
+def test_grid_qspace_mask_direct(tmp_path):
+    """Test the gridding of the positions of a scattered direct space mask."""
+    import numpy as np
+    from sxdm.io.xsocs import get_qspace_position
+    from sxdm.process.qspace import grid_qspace, _get_position_blocks
+
+    # scattered mask: large blocks; 20 x 20 ROI of a 200 x 200 map: only the ROI
+    rng = np.random.default_rng(0)
+    roi = np.ones((200, 200), dtype=bool)
+    roi[50:70, 100:120] = False
+    for mask, max_blocks, max_read in [
+        (rng.random(10000) > 0.1, 15, 10000),
+        (roi.ravel(), 20, 400),
+    ]:
+        blocks = _get_position_blocks(mask.size, 1, 1, 1000, mask)
+        assert len(blocks) <= max_blocks
+        assert sum(i1 - i0 for i0, i1 in blocks) <= max_read
+        assert all(
+            i1 - i0 <= 1000 and not mask[[i0, i1 - 1]].any() for i0, i1 in blocks
+        )
+        covered = np.zeros(mask.size, dtype=bool)
+        for i0, i1 in blocks:
+            covered[i0:i1] = True
+        assert covered[~mask].all()
+
+    frames = np.random.default_rng(0).integers(0, 100, (3, 6, 16, 16))
+    path_master = _write_xsocs_master(tmp_path, 3, frames.astype("float32"))
+    kwargs = dict(nbins=(6, 5, 4), correct_mpx_gaps=False, n_proc=1, pbar=False)
+    mask_direct = np.array([1, 0, 1, 0, 0, 1], dtype=bool)
+
+    path_full = f"{tmp_path}/full.h5"
+    grid_qspace(path_full, path_master, **kwargs)
+    for sparse in (False, True):
+        path_mask = f"{tmp_path}/mask_{sparse}.h5"
+        grid_qspace(
+            path_mask,
+            path_master,
+            mask_direct=mask_direct,
+            block_size=4,
+            sparse=sparse,
+            **kwargs,
+        )
+        for idx in range(6):
+            qspace = get_qspace_position(path_mask, idx)
+            if mask_direct[idx]:
+                assert not qspace.any()
+            else:
+                assert np.allclose(qspace, get_qspace_position(path_full, idx))
+
+
+def test_qspace_vals_cache(tmp_path, monkeypatch):
+    """Test the in-memory and on-disk caches of get_qspace_vals_xsocs."""
+    import os
+    import numpy as np
+    import sxdm.process.xsocs as xsocs
+    from sxdm.process.xsocs import get_qspace_vals_xsocs, clear_qspace_vals_cache
+
+    frames = np.zeros((3, 6, 16, 16), dtype="float32")
+    path_master = _write_xsocs_master(tmp_path, 3, frames)
+    cache_dir = f"{tmp_path}/cache"
+    kwargs = dict(verbose=False, cache_dir=cache_dir)
+
+    # estimate_n_bins, then grid_qspace: one conversion of the whole detector
+    clear_qspace_vals_cache()
+    qx, qy, qz = get_qspace_vals_xsocs(path_master, det_roi=[0, 8, 0, 4], **kwargs)
+    qs = get_qspace_vals_xsocs(path_master, sort_angles=False, **kwargs)
+    assert len(xsocs._qspace_vals_cache) == 1
+    assert len(os.listdir(cache_dir)) == 1
+    assert all(np.shares_memory(a, b) for a, b in zip((qx, qy, qz), qs))
+    assert np.array_equal(qx, qs[0][:, :8, :4])
+    assert not qx.flags.writeable
+
+    def no_conversion(*args, **kwargs):
+        raise AssertionError("q-space coordinates computed again")
+
+    # reloaded from disk
+    clear_qspace_vals_cache()
+    monkeypatch.setattr(xsocs, "qspace_conversion", no_conversion)
+    assert np.array_equal(get_qspace_vals_xsocs(path_master, **kwargs)[2], qs[2])
+    monkeypatch.undo()
+
+    # a different offset or a modified master file
+    qx_offset = get_qspace_vals_xsocs(path_master, offsets={"eta": 0.1}, **kwargs)[0]
+    assert not np.shares_memory(qx_offset, qs[0])
+    mtime = os.path.getmtime(path_master)
+    os.utime(path_master, (mtime + 10, mtime + 10))
+    assert not np.shares_memory(get_qspace_vals_xsocs(path_master, **kwargs)[0], qx)
+    assert len(xsocs._qspace_vals_cache) == 3
+
+    clear_qspace_vals_cache(cache_dir)
+    assert len(xsocs._qspace_vals_cache) == 0
+    assert os.listdir(cache_dir) == []
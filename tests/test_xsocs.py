@@ -1,6 +1,7 @@
 import sxdm
 import os
 import numpy as np
+import h5py
 
 print("\n\n", os.path.abspath("."), "\n\n")
 
@@ -26,6 +27,56 @@ def test_xsocs_shift():
     assert ret is None  # TODO this is baaaaaad
 
 
+def test_xsocs_links_incremental(tmp_path):
+    path_dset = "doc/source/examples/data/MA1234/id01/20230710/RAW_DATA/InGaN/InGaN_0001/InGaN_0001.h5"
+    path_master = f"{tmp_path}/InGaN_0001_master.h5"
+
+    sxdm.utils.bliss.make_xsocs_links(path_dset, str(tmp_path), None)
+    with h5py.File(path_master, "r") as h5f:
+        entries = sorted(h5f.keys(), key=lambda e: int(e.split(".")[0]))
+
+    # unlink the last scan, then link only this one again
+    with h5py.File(path_master, "a") as h5f:
+        del h5f[entries[-1]]
+    path_first = f"{tmp_path}/InGaN_0001_{entries[0]}.h5"
+    mtime = os.path.getmtime(path_first)
+
+    sxdm.utils.bliss.make_xsocs_links(path_dset, str(tmp_path), None, incremental=True)
+    with h5py.File(path_master, "r") as h5f:
+        assert sorted(h5f.keys(), key=lambda e: int(e.split(".")[0])) == entries
+    assert os.path.getmtime(path_first) == mtime
+
+
+def test_sxdm_sums_multi():
+    path_dset = "doc/source/examples/data/MA1234/id01/20230710/RAW_DATA/InGaN/InGaN_0001/InGaN_0001.h5"
+    scan_nos = sxdm.io.bliss.get_sxdm_scan_numbers(path_dset)[:2]
+
+    frame_sums, pos_sums = sxdm.io.bliss.get_sxdm_sums_multi(
+        path_dset, scan_nos, pbar=False, block_size=1e6
+    )
+
+    for i, scan_no in enumerate(scan_nos):
+        fint = sxdm.io.bliss.get_sxdm_frame_sum(path_dset, scan_no, pbar=False)
+        dint = sxdm.io.bliss.get_sxdm_pos_sum(path_dset, scan_no, pbar=False)
+        assert np.allclose(frame_sums[i], fint)
+        if dint.size == pos_sums[i].size:
+            assert np.allclose(pos_sums[i], dint.reshape(pos_sums[i].shape))
+        else:  # interrupted scan, padded with zeros
+            assert np.allclose(pos_sums[i].ravel()[: dint.size], dint.ravel())
+            assert not pos_sums[i].ravel()[dint.size :].any()
+
+    # a list of flat masks, one per scan
+    masks = [np.arange(s.size) % 3 == 0 for s in pos_sums]
+    frame_sums, _ = sxdm.io.bliss.get_sxdm_sums_multi(
+        path_dset, scan_nos, mask_sample=masks, pbar=False
+    )
+    for i, scan_no in enumerate(scan_nos):
+        fint = sxdm.io.bliss.get_sxdm_frame_sum(
+            path_dset, scan_no, mask_sample=masks[i], pbar=False
+        )
+        assert np.allclose(frame_sums[i], fint)
+
+
 def test_xsocs_qconv():
     path_out = (
         "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
@@ -44,3 +95,171 @@ def test_xsocs_qconv():
     assert qx.shape == (10,)
     assert qy.shape == (10,)
     assert qz.shape == (10,)
+
+
+def test_qspace_grid():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+    path_qspace = f"{path_out}/InGaN_qspace_shift.h5"
+    path_qspace_lut = f"{path_out}/InGaN_qspace_shift_lut.h5"
+
+    offsets = {"eta": 0, "delta": 0, "phi": 0, "roby": 1, "nu": 0.5}
+
+    sxdm.process.qspace.grid_qspace(
+        path_qspace_lut, path_master, (10, 10, 10), overwrite=True, offsets=offsets
+    )
+
+    for q, q_lut in zip(
+        sxdm.utils.get_qspace_coords(path_qspace),
+        sxdm.utils.get_qspace_coords(path_qspace_lut),
+    ):
+        assert np.allclose(q, q_lut)
+
+    with h5py.File(path_qspace, "r") as h5f, h5py.File(path_qspace_lut, "r") as h5l:
+        assert np.allclose(h5f["Data/histo"][()], h5l["Data/histo"][()])
+        assert np.allclose(h5f["Data/qspace"][()], h5l["Data/qspace"][()])
+
+
+def test_qspace_grid_sparse():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+    path_dense = f"{path_out}/InGaN_qspace_shift_lut.h5"
+    path_sparse = f"{path_out}/InGaN_qspace_shift_lut_sparse.h5"
+
+    for path, sparse in zip((path_dense, path_sparse), (False, True)):
+        sxdm.process.qspace.grid_qspace(
+            path, path_master, (10, 10, 10), overwrite=True, sparse=sparse
+        )
+
+    assert np.allclose(
+        sxdm.io.xsocs.get_qspace_avg(path_dense),
+        sxdm.io.xsocs.get_qspace_avg(path_sparse),
+    )
+
+    mask = np.zeros((10, 10, 10), dtype=bool)
+    for com, com_sparse in zip(
+        sxdm.process.math.calc_coms_qspace3d(path_dense, mask),
+        sxdm.process.math.calc_coms_qspace3d(path_sparse, mask),
+    ):
+        assert np.allclose(com, com_sparse, equal_nan=True)
+
+
+def test_qspace_rechunk():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_qspace = f"{path_out}/InGaN_qspace_shift.h5"
+    path_rechunk = f"{path_out}/InGaN_qspace_shift_rechunk.h5"
+
+    chunks, _ = sxdm.io.xsocs.benchmark_qspace_chunks(path_qspace, n_reads=2)
+    assert (
+        sxdm.io.xsocs.rechunk_qspace(
+            path_qspace, path_rechunk, chunks=chunks, overwrite=True
+        )
+        == chunks
+    )
+
+    assert np.allclose(
+        sxdm.io.xsocs.get_qspace_avg(path_qspace),
+        sxdm.io.xsocs.get_qspace_avg(path_rechunk),
+    )
+
+
+def test_qspace_grid_roi():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+    path_qspace = f"{path_out}/InGaN_qspace_shift_lut.h5"
+    path_qspace_roi = f"{path_out}/InGaN_qspace_shift_lut_roi.h5"
+
+    sxdm.process.qspace.grid_qspace(
+        path_qspace, path_master, (10, 10, 10), overwrite=True
+    )
+
+    mask_reciprocal = np.ones((10, 10, 10), dtype=bool)
+    mask_reciprocal[2:8, 3:7, 4:6] = False
+    n_pos = sxdm.io.xsocs.get_qspace_shape(path_qspace)[0]
+    mask_direct = np.arange(n_pos) % 2 == 1
+
+    sxdm.process.qspace.grid_qspace(
+        path_qspace_roi,
+        path_master,
+        (10, 10, 10),
+        overwrite=True,
+        mask_reciprocal=mask_reciprocal,
+        mask_direct=mask_direct,
+    )
+
+    for idx in range(2):
+        qspace = sxdm.io.xsocs.get_qspace_position(path_qspace, idx)[2:8, 3:7, 4:6]
+        qspace_roi = sxdm.io.xsocs.get_qspace_position(path_qspace_roi, idx)
+        assert np.allclose(qspace_roi, 0 if mask_direct[idx] else qspace)
+
+
+def test_qspace_grid_integrated():
+    path_dset = "doc/source/examples/data/MA1234/id01/20230710/RAW_DATA/InGaN/InGaN_0001/InGaN_0001.h5"
+
+    qx, qy, qz, rsm = sxdm.process.qspace.grid_qspace_integrated(
+        path_dset, (10, 10, 10), pbar=False
+    )
+
+    assert rsm.shape == (10, 10, 10)
+    assert [q.size for q in (qx, qy, qz)] == [10, 10, 10]
+    assert rsm.sum() > 0
+
+
+def test_qspace_grid_preview():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+
+    *qcoords, rsm, estimate = sxdm.process.qspace.preview_grid_qspace(
+        path_master, (10, 10, 10), n_positions=10, det_bin=2
+    )
+
+    assert rsm.shape == (5, 5, 5)
+    assert estimate["size"] > 0 and estimate["duration"] > 0
+
+
+def test_qspace_grid_binned():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+    path_qspace = f"{path_out}/InGaN_0001_qspace_binned.h5"
+
+    sxdm.process.qspace.grid_qspace(
+        path_qspace, path_master, (10, 10, 10), overwrite=True, det_bin=2, pos_bin=2
+    )
+
+    n_pos = sxdm.io.xsocs.get_qspace_shape(path_qspace)[0]
+    with h5py.File(path_master, "r") as h5f:
+        entry = list(h5f.keys())[0]
+        ny, nx = [h5f[f"{entry}/scan/motor_{i}_steps"][()] for i in (1, 0)]
+
+    assert n_pos == (ny // 2) * (nx // 2)
+
+
+def test_qspace_grid_shards():
+    path_out = (
+        "doc/source/examples/data/MA1234/id01/20230710/PROCESSED_DATA/InGaN_processed/"
+    )
+    path_master = f"{path_out}/InGaN_0001_master_shifted.h5"
+    path_qspace = f"{path_out}/InGaN_qspace_shift_lut.h5"
+    path_qspace_shards = f"{path_out}/InGaN_qspace_shift_shards.h5"
+
+    for path, shards in zip((path_qspace, path_qspace_shards), (False, True)):
+        sxdm.process.qspace.grid_qspace(
+            path, path_master, (10, 10, 10), overwrite=True, shards=shards
+        )
+
+    assert np.allclose(
+        sxdm.io.xsocs.get_qspace_avg(path_qspace),
+        sxdm.io.xsocs.get_qspace_avg(path_qspace_shards),
+    )